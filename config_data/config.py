@@ -5,10 +5,38 @@ import yaml
 from environs import Env
 
 
+@dataclass(frozen=True)
+class CertificateLayout:
+    """
+    Разметка шаблона сертификата (координаты в pt, цвета в RGB 0-255).
+    Значения по умолчанию совпадают с текущими шаблонами, в config.yaml
+    задаются только отличия в секции `layout` курса.
+    name_font_ladder: пары (макс. длина ФИО, размер шрифта) по возрастанию.
+    name_font_fallback: размер шрифта для ФИО длиннее последней ступени
+    (как в исходных шаблонах — 16).
+    """
+    page_size: tuple[float, float] = (612.0, 792.0)
+    name_center_x: float = 461.0
+    name_y: float = 306.0
+    name_font_ladder: tuple[tuple[int, int], ...] = (
+        (23, 16), (25, 15), (27, 14), (30, 13))
+    name_font_fallback: int = 16
+    number_x: float = 440.0
+    number_y: float = 373.0
+    number_font_size: int = 21
+    number_color: tuple[int, int, int] = (230, 230, 230)
+    watermark_text: str = 'TEST VERSION'
+    watermark_x: float = 110.0
+    watermark_y: float = 60.0
+    watermark_font_size: int = 50
+    watermark_angle: float = 45.0
+
+
 @dataclass
 class Course:
     name: str
     templates: dict[str, str]
+    layout: CertificateLayout = field(default_factory=CertificateLayout)
 
 
 @dataclass
@@ -19,14 +47,55 @@ class CourseData:
 
 @dataclass
 class TgBot:
+    """
+    admins: ID администраторов из id_admins (через пробел), разбираются
+    один раз при загрузке конфига.
+    """
     token: str
     id_admins: str
+    admins: frozenset[int] = field(init=False)
+
+    def __post_init__(self) -> None:
+        tokens = self.id_admins.split()
+        invalid = [token for token in tokens if not token.isdigit()]
+        if invalid:
+            raise ValueError(f'ID_ADMIN: ожидаются числовые Telegram ID '
+                             f'через пробел, некорректные значения: '
+                             f'{", ".join(invalid)}')
+        self.admins = frozenset(map(int, tokens))
+
+
+@dataclass
+class StepikRateLimit:
+    rate: float
+    burst: int
+    max_retries: int
 
 
 @dataclass
 class Stepik:
     client_id: str
     client_secret: str
+    rate_limit: StepikRateLimit
+
+
+@dataclass
+class CertRender:
+    workers: int
+    queue_size: int
+    timeout: float
+
+
+@dataclass
+class Throttling:
+    """
+    mode: ttl или gcra (см. middlewares.outer.ThrottlingMiddleware);
+    rate_limit, period (мс) и burst используются в режиме gcra.
+    """
+    mode: str
+    rate_limit: int
+    period: int
+    burst: int
 
 
 @dataclass
@@ -36,6 +105,9 @@ class Config:
     stepik: Stepik
     level_log: str
     w_text: bool
+    cert_render_to_disk: bool
+    cert_render: CertRender
+    throttling: Throttling
     tg_target_channel: int | None
     pragmatic_target_channel: int | None
     log_tg_cert_enabled: bool
@@ -47,6 +119,30 @@ class Config:
     pragmatic_courses: str | None
     courses_data: CourseData
 
+    def is_admin(self, user_id: int) -> bool:
+        """
+        Проверка администратора по множеству tg_bot.admins.
+        :param user_id: TG_ID пользователя.
+        """
+        return user_id in self.tg_bot.admins
+
+
+def load_layout(layout_data: dict | None) -> CertificateLayout:
+    """
+    Собирает CertificateLayout из секции `layout` курса в config.yaml.
+    Списки из yaml приводятся к кортежам, чтобы разметка была хэшируемой.
+    """
+    if not layout_data:
+        return CertificateLayout()
+
+    values = dict(layout_data)
+    for key, value in layout_data.items():
+        if key == 'name_font_ladder':
+            values[key] = tuple(tuple(step) for step in value)
+        elif isinstance(value, list):
+            values[key] = tuple(value)
+    return CertificateLayout(**values)
+
 
 def load_courses_from_yaml(path: str = 'config.yaml') -> CourseData:
     with open(path, encoding='utf-8') as f:
@@ -56,7 +152,9 @@ def load_courses_from_yaml(path: str = 'config.yaml') -> CourseData:
     courses = {}
     for course_id, course_info in courses_data.items():
         courses[int(course_id)] = Course(
-            name=course_info['name'], templates=course_info['templates']
+            name=course_info['name'],
+            templates=course_info['templates'],
+            layout=load_layout(course_info.get('layout')),
         )
     courses_data = CourseData(
         courses=courses,
@@ -79,8 +177,30 @@ def load_config(path: str | None = None) -> Config:
     stepik_client_id = env('STEPIK_CLIENT_ID')
     stepik_client_secret = env('STEPIK_CLIENT_SECRET')
     level_log = env.str('LOG_LEVEL', 'INFO')
+    # Shared budget of Stepik API requests for all bot replicas
+    stepik_rate_limit = StepikRateLimit(
+        rate=env.float('STEPIK_RATE_LIMIT', 5),
+        burst=env.int('STEPIK_RATE_BURST', 10),
+        max_retries=env.int('STEPIK_MAX_RETRIES', 3),
+    )
 
     w_text = env.bool('W_TEXT_ENABLED', False)
+    # Debug mode: certificates are written to CERTIFICATE_DATA_DIR
+    cert_render_to_disk = env.bool('CERT_RENDER_TO_DISK', False)
+    # 0 workers: render in asyncio.to_thread instead of a process pool
+    cert_render = CertRender(
+        workers=env.int('CERT_RENDER_WORKERS', 1),
+        queue_size=env.int('CERT_RENDER_QUEUE_SIZE', 20),
+        timeout=env.float('CERT_RENDER_TIMEOUT', 30),
+    )
+
+    # Anti-flood: ttl - one event per interval, gcra - average rate + burst
+    throttling = Throttling(
+        mode=env.str('THROTTLE_MODE', 'ttl'),
+        rate_limit=env.int('THROTTLE_RATE_LIMIT', 3),
+        period=env.int('THROTTLE_PERIOD_MS', 2000),
+        burst=env.int('THROTTLE_BURST', 3),
+    )
 
     tg_target_channel = env.int('TG_TARGET_CHANNEL', None)
     pragmatic_target_channel = env.int('PRAGMATIC_TARGET_CHANNEL', None)
@@ -103,11 +223,16 @@ def load_config(path: str | None = None) -> Config:
     return Config(
         tg_bot=tg_bot,
         stepik=Stepik(
-            client_id=stepik_client_id, client_secret=stepik_client_secret
+            client_id=stepik_client_id,
+            client_secret=stepik_client_secret,
+            rate_limit=stepik_rate_limit,
         ),
         redis_host=redis_host,
         level_log=level_log,
         w_text=w_text,
+        cert_render_to_disk=cert_render_to_disk,
+        cert_render=cert_render,
+        throttling=throttling,
         tg_target_channel=tg_target_channel,
         pragmatic_target_channel=pragmatic_target_channel,
         log_tg_cert_enabled=log_tg_cert_enabled,
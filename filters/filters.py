@@ -101,12 +101,8 @@ class IsAdmins(BaseFilter):
     async def __call__(self, msg: Message, config: Config) -> bool:
         logger_filters.debug('Entry')
 
-        user_id = str(msg.from_user.id)
-        admins_id = config.tg_bot.id_admins
-        logger_filters.debug(f'{admins_id=}')
-
         logger_filters.debug('Exit')
-        return user_id in admins_id
+        return config.is_admin(msg.from_user.id)
 
 
 class IsFullName(BaseFilter):
@@ -1,10 +1,10 @@
 import logging
 
 from aiogram import F, Router
-from aiogram.filters import StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message
-from arq.connections import RedisSettings
+from arq import ArqRedis
 from redis.asyncio import Redis
 
 from config_data.config import Config
@@ -12,9 +12,15 @@ from filters.filters import IsAdmins
 from keyboards import kb_back_cancel, kb_butt_quiz, kb_done_newsletter
 from keyboards.keyboards import kb_admin
 from lexicon import LexiconRu
-from queues.que_utils import mass_mailing
+from queues.que_utils import start_mailing_campaign
 from states.states import FSMAdminPanel
-from utils import MessageProcessor, get_data_users, get_username
+from utils import (
+    MessageProcessor,
+    StepikService,
+    get_data_users,
+    get_username,
+    render_pool,
+)
 
 admin_router = Router()
 admin_router.message.filter(IsAdmins())
@@ -79,6 +85,57 @@ async def cmd_admin(
     await state.set_state(FSMAdminPanel.admin_menu)
 
 
+@admin_router.message(Command('recheck'))
+async def cmd_recheck(
+    msg: Message,
+    command: CommandObject,
+    stepik_service: StepikService,
+) -> None:
+    """
+    /recheck <stepik_id> — сбрасывает кэш проверок ученика, следующее
+    нажатие «Готово» проверит сертификат на Stepik заново.
+    /recheck — статистика кэша проверок, кэша шаблонов сертификатов
+    и пула генерации.
+    """
+    stepik_user_id = (command.args or '').strip()
+    if not stepik_user_id:
+        stats = stepik_service.verification_stats()
+        templates = render_pool.template_cache_stats()
+        pool = render_pool.stats()
+        await msg.answer(
+            'Кэш проверок Stepik:\n'
+            f'Попаданий: {stats["hits"]}\n'
+            f'Промахов: {stats["misses"]}\n'
+            f'Обходов: {stats["bypassed"]}\n'
+            f'Доля попаданий: {stats["hit_rate"]:.0%}\n\n'
+            'Кэш шаблонов сертификатов:\n'
+            f'Попаданий: {templates["hits"]}\n'
+            f'Промахов: {templates["misses"]}\n'
+            f'Шаблонов: {templates["templates"]} '
+            f'в {templates["processes"]} процессах\n\n'
+            'Пул генерации сертификатов:\n'
+            f'В очереди: {pool["queue_depth"]}\n'
+            f'В работе: {pool["in_flight"]} из {pool["workers"]}\n'
+            f'Готово: {pool["completed"]}\n'
+            f'Отклонено: {pool["rejected"]}\n'
+            f'Таймаутов: {pool["timeouts"]}\n'
+            f'Перезапусков пула: {pool["restarts"]}\n\n'
+            'Сброс для ученика: /recheck <i>stepik_id</i>'
+        )
+        return
+
+    if not stepik_user_id.isdigit():
+        await msg.answer('Stepik ID должен состоять из цифр.')
+        return
+
+    logger_admin.info(
+        f'Сброс кэша проверок STEPIK_ID:{stepik_user_id}:'
+        f'{msg.from_user.id}:{await get_username(msg)}'
+    )
+    await stepik_service.invalidate_verification(stepik_user_id)
+    await msg.answer(f'Кэш проверок STEPIK_ID:{stepik_user_id} сброшен✅')
+
+
 @admin_router.callback_query(F.data == 'exit')
 async def cmd_exit(
     clbk: CallbackQuery, state: FSMContext, msg_processor: MessageProcessor
@@ -100,15 +157,17 @@ async def cmd_exit(
     F.data == 'certs_data', StateFilter(FSMAdminPanel.admin_menu)
 )
 async def clbk_check_data_certs(
-    clbk: CallbackQuery, state: FSMContext, redis_data: Redis
+    clbk: CallbackQuery, state: FSMContext, redis_data: Redis, config: Config
 ) -> None:
     logger_admin.info(
         f'Запрос данных по сертификатам:'
         f'{clbk.from_user.id}:{await get_username(clbk)}'
     )
     await clbk.answer('Сбор данных…')
-    text = await get_data_users(clbk, redis_data=redis_data)
-    await clbk.message.edit_text(text=text)
+    pages = await get_data_users(redis_data, config.courses_data.courses)
+    await clbk.message.edit_text(text=pages[0])
+    for page in pages[1:]:
+        await clbk.message.answer(text=page)
     await state.clear()
 
 
@@ -172,7 +231,7 @@ async def msg_for_newsletter(
 async def clbk_done_newsletter(
     clbk: CallbackQuery,
     redis_data: Redis,
-    redis_que: RedisSettings,
+    arq_pool: ArqRedis,
     state: FSMContext,
     msg_processor: MessageProcessor,
     config: Config,
@@ -182,22 +241,19 @@ async def clbk_done_newsletter(
     await msg_processor.delete_message()
 
     msg_letter: str = await state.get_value('msg_letter')
-    user_ids = set(
-        map(int, filter(lambda _id: _id.isdigit(), await redis_data.keys()))
-    )
     end_cert = str(await redis_data.get('end_number')).zfill(6)
-    admin_ids: str = config.tg_bot.id_admins
     try:
-        await mass_mailing(
-            redis_que=redis_que,
-            user_ids=user_ids,
+        await start_mailing_campaign(
+            arq_pool=arq_pool,
             message=msg_letter,
-            admin_ids=admin_ids,
+            admins=config.tg_bot.admins,
             end_cert=end_cert,
         )
     except Exception as err:
         logger_admin.error(f'Ошибка при рассылке: {err}', exc_info=True)
+        await clbk.answer('Не удалось запустить рассылку😯', show_alert=True)
+    else:
+        await clbk.answer('Рассылка запущена📨')
     await state.set_state(FSMAdminPanel.admin_menu)
-    await clbk.answer()
 
     logger_admin.debug('Exit')
@@ -1,13 +1,12 @@
-import asyncio
 import logging
 
-from aiogram import F, Router
+from aiogram import Bot, F, Router
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import StateFilter, or_f
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, FSInputFile, Message
-from aiohttp import ConnectionTimeoutError
-from redis import Redis
+from arq import ArqRedis
+from redis.asyncio import Redis
 
 from config_data.config import Config
 from filters.filters import (
@@ -24,8 +23,13 @@ from keyboards import (
     kb_end_quiz,
 )
 from keyboards.buttons import BUTT_COURSES
-from keyboards.keyboards import get_kb_courses, kb_butt_quiz
+from keyboards.keyboards import get_kb_courses
 from lexicon import LexiconRu
+from queues.issuance import (
+    IssueCertificateJob,
+    enqueue_issue_certificate,
+    on_certificate_issued,
+)
 from states.states import FSMPragmaticGetCert, FSMQuiz
 from utils import (
     MessageProcessor,
@@ -41,22 +45,20 @@ router.callback_query.filter(or_f(IsPragmaticCoursesFilter(),
 router.message.filter(IsPrivateChat())
 logger = logging.getLogger(__name__)
 
+# Пауза перед предложением скидки после выдачи сертификата, секунд
+GIT_DISCOUNT_DELAY = 5
+
 
 @router.callback_query(IsPragmaticCoursesFilter())
 async def get_pragmatic_certificates(
         clbk: CallbackQuery,
         state: FSMContext,
         config: Config,
-        redis_data: Redis,
+        stepik_service: StepikService,
         msg_processor: MessageProcessor) -> None:
     logger.debug('Entry')
 
     tg_username = await get_username(clbk)
-    stepik_service = StepikService(
-        client_id=config.stepik.client_id,
-        client_secret=config.stepik.client_secret,
-        redis_client=redis_data,
-        courses=config.courses_data.courses)
 
     # TODO: временная заглушка в ожидании сертификата для static
     logger.warning(
@@ -79,18 +81,12 @@ async def get_pragmatic_certificates(
         value = await clbk.message.edit_text(
             'У вас есть сертификат этого курса 🤓\nВысылаем...📜☺️\n')
         try:
-            path = await stepik_service.generate_certificate(
-                state_data=state,
-                type_update=clbk,
-                w_text=config.w_text,
-                exist_cert=True)
-
-            await stepik_service.send_certificate(
+            await stepik_service.send_certificate_copy(
                 clbk=clbk,
-                output_file=path,
                 state=state,
-                is_copy=True,
-                course_id=course_id)
+                course_id=course_id,
+                w_text=config.w_text,
+                to_disk=config.cert_render_to_disk)
 
         except Exception as err:
             logger.debug(f'{err.__class__.__name__}', exc_info=True)
@@ -218,16 +214,12 @@ async def clbk_back_to_sent_stepik_link(clbk: CallbackQuery,
 async def clbk_done(
         clbk: CallbackQuery,
         state: FSMContext,
-        redis_data: Redis,
         config: Config,
-        msg_processor: MessageProcessor) -> None:
+        msg_processor: MessageProcessor,
+        stepik_service: StepikService,
+        arq_pool: ArqRedis) -> None:
     logger.debug('Entry')
 
-    stepik_service = StepikService(
-        client_id=config.stepik.client_id,
-        client_secret=config.stepik.client_secret,
-        redis_client=redis_data,
-        courses=config.courses_data.courses)
     logger.info(
         f'Анкета проверяется:{clbk.from_user.id}'
         f':{await get_username(clbk)}')
@@ -238,233 +230,162 @@ async def clbk_done(
     stepik_user_id = await state.get_value('stepik_user_id')
     tg_username = await get_username(clbk)
 
-    # Проверяем, есть ли у пользователя уже сохраненный Stepik ID
-    existing_stepik_id = await redis_data.hget(
-        name=str(clbk.from_user.id),
-        key='stepik_user_id')
-    if existing_stepik_id:
-        if existing_stepik_id != stepik_user_id:
-            await clbk.message.edit_text(
-                'Вы пытаетесь использовать другой Stepik-аккаунт. '
-                'Если вы ошиблись - повторите или обратитесь '
-                'к администратору.')
-            logger.warning(
-                f'Попытка смены Stepik ID для '
-                f'TG_ID:{clbk.from_user.id}:{tg_username}. '
-                f'Привязанный SEPIK_ID:{existing_stepik_id}, Новый SEPIK_ID:'
-                f'{stepik_user_id}')
-            await state.clear()
-            await clbk.answer()
-            return
-    else:
-        # Проверяем, не занят ли этот Stepik ID другим пользователем
-        all_user_hashes = await redis_data.keys('*')
-        for user_key in all_user_hashes:
-            if user_key.isdigit() and user_key != str(clbk.from_user.id):
-                other_user_stepik_id = await redis_data.hget(
-                    user_key,
-                    'stepik_user_id')
-                if other_user_stepik_id == stepik_user_id:
-                    await clbk.message.edit_text(
-                        'Этот Stepik-аккаунт уже используется '
-                        'другим пользователем. '
-                        'Обратитесь к администратору.')
-                    logger.warning(
-                        f'Попытка TG_ID:{clbk.from_user.id}:'
-                        f'{tg_username} использовать '
-                        f'занятый STEPIK ID:{stepik_user_id}')
-                    await state.clear()
-                    await clbk.answer()
-                    return
-
-        # Если все проверки пройдены, сохраняем Stepik ID
-        await redis_data.hset(
-            name=str(clbk.from_user.id),
-            key='stepik_user_id',
-            value=stepik_user_id)
+    # Проверяем привязку Stepik ID к пользователю и закрепляем его
+    claim_status, claim_value = await stepik_service.claim_stepik_id(
+        str(clbk.from_user.id), stepik_user_id)
+    if claim_status == 'BOUND':
+        await clbk.message.edit_text(
+            'Вы пытаетесь использовать другой Stepik-аккаунт. '
+            'Если вы ошиблись - повторите или обратитесь '
+            'к администратору.')
+        logger.warning(
+            f'Попытка смены Stepik ID для '
+            f'TG_ID:{clbk.from_user.id}:{tg_username}. '
+            f'Привязанный SEPIK_ID:{claim_value}, Новый SEPIK_ID:'
+            f'{stepik_user_id}')
+        await state.clear()
+        await clbk.answer()
+        return
+
+    if claim_status == 'TAKEN':
+        await clbk.message.edit_text(
+            'Этот Stepik-аккаунт уже используется '
+            'другим пользователем. '
+            'Обратитесь к администратору.')
+        logger.warning(
+            f'Попытка TG_ID:{clbk.from_user.id}:'
+            f'{tg_username} использовать '
+            f'занятый STEPIK ID:{stepik_user_id}')
+        await state.clear()
+        await clbk.answer()
+        return
 
     course_clbk_data = await state.get_value('course')
     course_id = (course_clbk_data.split('_')[-1]
                  if '_' in course_clbk_data else course_clbk_data)
 
+    data = await state.get_data()
+    job = IssueCertificateJob(
+        tg_user_id=clbk.from_user.id,
+        chat_id=clbk.message.chat.id,
+        progress_message_id=value1.message_id,
+        tg_username=tg_username,
+        stepik_user_id=stepik_user_id,
+        course_id=course_id,
+        full_name=data.get('full_name'),
+        gender=data.get('gender'),
+        flow='pragmatic',
+        bypass_cache=config.is_admin(clbk.from_user.id))
+    # Выдача продолжается в задаче arq, анкета больше не нужна
+    await state.clear()
     try:
-        access_token = await stepik_service.get_stepik_access_token()
-        certificates = await stepik_service.check_cert_in_stepik(
-            stepik_user_id=stepik_user_id,
-            course_id=course_id,
-            access_token=access_token,
-            tg_username=tg_username,
-            config=config)
-    except ConnectionTimeoutError as e:
-        logger.error(
-            f'Не удалось проверить сертификат на Stepik для'
-            f' TG_ID:{clbk.from_user.id}:{tg_username},'
-            f' STEPIK_USER_ID:{stepik_user_id},'
-            f' COURSE_ID:{course_id}, '
-            f'из-за ошибки передачи данных! Сертификат выдан без проверки!,'
-            f' {e}')
-        certificates = True
-
-    if certificates == 'PRIVATE':
-        value = await clbk.message.edit_text(
-            f'{tg_username},'
-            f'{LexiconRu.text_privacy_instructions}')
-        await state.clear()
+        queued = await enqueue_issue_certificate(arq_pool, job)
+    except Exception as err:
+        logger.error(f'{err=}', exc_info=True)
+        value = await clbk.message.answer(
+            'Произошла не предвиденная ошибка,'
+            ' обратитесь к администратору.')
         await msg_processor.save_msg_id(value, msgs_for_del=True)
+        await msg_processor.deletes_msg_a_delay(value1, delay=5)
         await clbk.answer()
+        logger.debug('Exit:error')
         return
-    if certificates:
-        try:
-            if int(course_id) in config.courses_data.best_in_python_courses:
-                number = await redis_data.incr('end_number')
-            else:
-                number = await redis_data.incr(f'end_number_{course_id}')
 
-            number_str = str(number).zfill(6)
-            await state.update_data(end_number=number_str)
+    if not queued:
+        logger.info(
+            f'Повторная выдача отклонена, задача уже в очереди:'
+            f'{clbk.from_user.id}:{tg_username}:COURSE_ID:{course_id}')
+        await clbk.answer('Сертификат уже выдаётся, ожидайте⌛')
+        return
 
-        except Exception as err:
-            logger.error(f'{err=}', exc_info=True)
-            value = await clbk.message.answer(
-                'Произошла не предвиденная ошибка,'
-                ' обратитесь к администратору.')
-            await msg_processor.save_msg_id(value, msgs_for_del=True)
-            await state.clear()
-            await msg_processor.deletes_msg_a_delay(value1, delay=5)
-            logger.debug('Exit:error')
-            return
+    await clbk.answer('Идет проверка…')
+    logger.debug('Exit')
 
-        try:
-            await clbk.answer('Идет проверка…')
-            # генерация сертификата
-            logger.info(
-                f'Генерация сертификата для'
-                f' :{clbk.from_user.id}:{tg_username}')
-            path = await stepik_service.generate_certificate(
-                state,
-                type_update=clbk,
-                w_text=config.w_text)
 
-        except Exception as err:
-            logger.error(f'{err=}', exc_info=True)
-            value = await clbk.message.answer(
-                'Произошла ошибка😯\nПопробуйте '
-                'позже или обратитесь к администратору🤖')
-            await msg_processor.deletes_msg_a_delay(value=value1, delay=2)
-            await msg_processor.deletes_msg_a_delay(value, 20, indication=True)
-            await state.clear()
-            return
+@on_certificate_issued('pragmatic', delay=GIT_DISCOUNT_DELAY)
+async def offer_git_discount(ctx: dict,
+                             job: IssueCertificateJob,
+                             state: FSMContext) -> None:
+    """
+    После выдачи сертификата предлагает скидку на полный курс Git + GitHub.
+    Выполняется отдельной задачей arq через GIT_DISCOUNT_DELAY секунд
+    после выдачи (queues.issuance).
+    """
+    bot: Bot = ctx['bot']
+    redis_data: Redis = ctx['redis_data']
+
+    text = ('Хотите получить скидку 45%\n'
+            'На полную часть курса:\n'
+            '<b>Git + GitHub. Полный курс</b>\n\n'
+            'Для этого нужно быть подписанным на:\n'
+            '<a href="https://t.me/pragmatic_programmer">'
+            'Pragmatic Programmer</a>')
+    kb_yes = create_inline_kb(yes='Да',
+                              cancel_butt=False,
+                              exit=True)
+
+    photo_file_id = await redis_data.get(name='pragmatic_photo')
+    photo_file = FSInputFile("static/pragmatic_git_photo.jpg")
+    if not photo_file_id:
 
-        try:
-            # отправка сертификата
-            await stepik_service.send_certificate(
-                clbk=clbk,
-                output_file=path,
-                state=state,
-                course_id=course_id)
-            await msg_processor.deletes_msg_a_delay(value=value1, delay=1)
-
-            text = ('Хотите получить скидку 45%\n'
-                    'На полную часть курса:\n'
-                    '<b>Git + GitHub. Полный курс</b>\n\n'
-                    'Для этого нужно быть подписанным на:\n'
-                    '<a href="https://t.me/pragmatic_programmer">'
-                    'Pragmatic Programmer</a>')
-            kb_yes = create_inline_kb(yes='Да',
-                                      cancel_butt=False,
-                                      exit=True)
-            await asyncio.sleep(5)
-
-            photo_file_id = await redis_data.get(name='pragmatic_photo')
-            photo_file = FSInputFile("static/pragmatic_git_photo.jpg")
-            if not photo_file_id:
-
-                logger.info(
-                    "Photo ID not found in Redis. "
-                    "Booting from disk to get ID.")
-
-                msg = await clbk.bot.send_photo(
-                    chat_id=clbk.message.chat.id,
-                    photo=photo_file,
-                    caption=text,
-                    reply_markup=kb_yes)
-
-                photo_id_for_course_pragmatic = msg.photo[-1].file_id
-
-                await redis_data.set(
-                    name='pragmatic_photo',
-                    value=photo_id_for_course_pragmatic)
-                await msg_processor.save_msg_id(value=msg, msgs_for_del=True)
-                logger.debug('Photo sent by file')
-            else:
-                try:
-                    msg = await clbk.bot.send_photo(
-                        chat_id=clbk.message.chat.id,
-                        photo=photo_file_id,
-                        caption=text,
-                        reply_markup=kb_yes)
-                    await msg_processor.save_msg_id(value=msg,
-                                                    msgs_for_del=True)
-                    logger.debug('Photo sent by id')
-                except TelegramBadRequest as e:
-                    logger.error(f'Error sending message-photo: {e}')
-                    msg = await clbk.bot.send_photo(
-                        chat_id=clbk.message.chat.id,
-                        photo=photo_file,
-                        caption=text,
-                        reply_markup=kb_yes)
-
-                    photo_id_for_course_pragmatic = msg.photo[-1].file_id
-                    await redis_data.set(
-                        name='pragmatic_photo',
-                        value=photo_id_for_course_pragmatic)
-                    await msg_processor.save_msg_id(value=msg,
-                                                    msgs_for_del=True)
-                    logger.debug('Photo sent by file (ID refreshed).')
-            await state.set_state(
-                state=FSMPragmaticGetCert.fill_get_discount_on_git)
-        except Exception as err:
-            logger.error(f'{err=}', exc_info=True)
-            await state.clear()
-        finally:
-            await clbk.answer()
-    else:
         logger.info(
-            f'Отсутствует серт на Stepik'
-            f':{clbk.from_user.id}:{tg_username}')
-        value = await clbk.message.answer(
-            f'{tg_username}, у вас '
-            f'пока нет сертификата этого курса '
-            f'на Stepik🙁\n'
-            f'Наберите нужное для сертификата '
-            f'количество баллов, получите '
-            f'сертификат на платформе и приходите '
-            f'снова, за экземпляром от команды '
-            f'курса😉')
-        await msg_processor.deletes_msg_a_delay(value, delay=10,
-                                                indication=True)
-        value = await clbk.message.answer(
-            LexiconRu.text_survey,
-            reply_markup=kb_butt_quiz,
-            disable_web_page_preview=True)
-        await msg_processor.deletes_msg_a_delay(value1, delay=5)
-        await msg_processor.save_msg_id(value, msgs_for_del=True)
-        await state.clear()
-        await clbk.answer()
-    logger.debug('Exit')
+            "Photo ID not found in Redis. "
+            "Booting from disk to get ID.")
+
+        msg = await bot.send_photo(
+            chat_id=job.chat_id,
+            photo=photo_file,
+            caption=text,
+            reply_markup=kb_yes)
+
+        photo_id_for_course_pragmatic = msg.photo[-1].file_id
+
+        await redis_data.set(
+            name='pragmatic_photo',
+            value=photo_id_for_course_pragmatic)
+        logger.debug('Photo sent by file')
+    else:
+        try:
+            msg = await bot.send_photo(
+                chat_id=job.chat_id,
+                photo=photo_file_id,
+                caption=text,
+                reply_markup=kb_yes)
+            logger.debug('Photo sent by id')
+        except TelegramBadRequest as e:
+            logger.error(f'Error sending message-photo: {e}')
+            msg = await bot.send_photo(
+                chat_id=job.chat_id,
+                photo=photo_file,
+                caption=text,
+                reply_markup=kb_yes)
+
+            photo_id_for_course_pragmatic = msg.photo[-1].file_id
+            await redis_data.set(
+                name='pragmatic_photo',
+                value=photo_id_for_course_pragmatic)
+            logger.debug('Photo sent by file (ID refreshed).')
+
+    await MessageProcessor(msg, state).save_msg_id(value=msg,
+                                                   msgs_for_del=True)
+    await state.set_state(
+        state=FSMPragmaticGetCert.fill_get_discount_on_git)
 
 @router.callback_query(F.data == 'yes',
                        StateFilter(FSMPragmaticGetCert.fill_get_discount_on_git))
 async def clbk_get_discount_on_git(clbk: CallbackQuery,
                                    state: FSMContext,
                                    config: Config,
-                                   msg_processor: MessageProcessor) -> None:
+                                   msg_processor: MessageProcessor,
+                                   redis_data: Redis) -> None:
     logger.debug('Entry')
 
     is_subscribe = None
     try:
-        is_subscribe = await check_user_in_group(clbk,
-                              tg_target_channel=config.pragmatic_target_channel)
+        is_subscribe = await check_user_in_group(
+            clbk,
+            tg_target_channel=config.pragmatic_target_channel,
+            redis_client=redis_data)
     except Exception as e:
         logger.error(f'Error checking user in: {e}')
 
@@ -3,8 +3,9 @@ import logging
 from aiogram import F, Router
 from aiogram.filters import or_f
 from aiogram.types import Message
+from redis.asyncio import Redis
 
-from utils import get_username
+from utils import cache_membership, get_username
 
 temp_router = Router()
 temp_router.message.filter(or_f(F.new_chat_members, F.left_chat_member))
@@ -13,10 +14,12 @@ logger = logging.getLogger(__name__)
 
 
 @temp_router.message(F.new_chat_members)
-async def delete_join_message(msg: Message) -> None:
+async def delete_join_message(msg: Message, redis_data: Redis) -> None:
     logger.info(
         f'{await get_username(msg)}:{msg.from_user.id} joined the chat!'
     )
+    for member in msg.new_chat_members:
+        await cache_membership(redis_data, msg.chat.id, member.id, True)
     try:
         await msg.delete()
     except Exception as e:
@@ -24,8 +27,10 @@ async def delete_join_message(msg: Message) -> None:
 
 
 @temp_router.message(F.left_chat_member)
-async def delete_exit_message(msg: Message) -> None:
+async def delete_exit_message(msg: Message, redis_data: Redis) -> None:
     logger.info(f'{await get_username(msg)}:{msg.from_user.id} exit the chat!')
+    await cache_membership(redis_data, msg.chat.id,
+                           msg.left_chat_member.id, False)
     try:
         await msg.delete()
     except Exception as e:
@@ -5,8 +5,8 @@ from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import default_state
 from aiogram.types import CallbackQuery, Message
-from aiohttp import ConnectionTimeoutError
-from redis import Redis
+from arq import ArqRedis
+from redis.asyncio import Redis
 
 from config_data.config import Config
 from filters.filters import (
@@ -28,6 +28,7 @@ from keyboards import (
 )
 from keyboards.keyboards import get_kb_courses, kb_butt_quiz
 from lexicon.lexicon_ru import LexiconRu
+from queues.issuance import IssueCertificateJob, enqueue_issue_certificate
 from states.states import FSMQuiz
 from utils import StepikService, check_user_in_group, get_username
 from utils.utils import MessageProcessor
@@ -267,12 +268,15 @@ async def clbk_get_cert(
     state: FSMContext,
     msg_processor: MessageProcessor,
     config: Config,
+    redis_data: Redis,
 ) -> None:
     logger_user_hand.info(
         f'Запрос сертификата:{clbk.from_user.id}:{await get_username(clbk)}'
     )
     if not await check_user_in_group(
-        clbk, tg_target_channel=config.tg_target_channel
+        clbk,
+        tg_target_channel=config.tg_target_channel,
+        redis_client=redis_data,
     ):
         logger_user_hand.info(
             f'Юзер {clbk.from_user.id}:{await get_username(clbk)} отсутствует '
@@ -316,15 +320,9 @@ async def clbk_select_course(
     clbk: CallbackQuery,
     state: FSMContext,
     config: Config,
-    redis_data: Redis,
+    stepik_service: StepikService,
     msg_processor: MessageProcessor,
 ) -> None:
-    stepik_service = StepikService(
-        client_secret=config.stepik.client_secret,
-        client_id=config.stepik.client_id,
-        redis_client=redis_data,
-        courses=config.courses_data.courses,
-    )
     tg_id = str(clbk.from_user.id)
     course_id = clbk.data
     logger_user_hand.info(
@@ -339,12 +337,12 @@ async def clbk_select_course(
             'У вас есть сертификат этого курса 🤓\nВысылаем... 📜☺️\n'
         )
         try:
-            path = await stepik_service.generate_certificate(
-                state, clbk, w_text=config.w_text, exist_cert=True
-            )
-            # отправка сертификата
-            await stepik_service.send_certificate(
-                clbk, path, state, is_copy=True, course_id=course_id
+            await stepik_service.send_certificate_copy(
+                clbk,
+                state,
+                course_id=course_id,
+                w_text=config.w_text,
+                to_disk=config.cert_render_to_disk,
             )
         except Exception as err:
             logger_user_hand.debug(f'{err.__class__.__name__=}', exc_info=True)
@@ -446,33 +444,29 @@ async def msg_sent_date(
 async def clbk_done(
     clbk: CallbackQuery,
     state: FSMContext,
-    redis_data: Redis,
     config: Config,
     msg_processor: MessageProcessor,
+    stepik_service: StepikService,
+    arq_pool: ArqRedis,
 ) -> None:
     """
     Handles the final confirmation step of the quiz.
 
-    This handler processes the user's quiz data, verifies the Stepik account,
-    checks for existing certificates, and generates a new certificate if all
-    conditions are met.
+    This handler binds the Stepik account to the user and enqueues the
+    certificate issuance job (Stepik check, number allocation, rendering and
+    delivery run in the arq worker, see queues.issuance).
 
     Args:
         clbk (CallbackQuery): The callback query object from the user's action.
         state (FSMContext): The state of the finite state machine.
-        redis_data (Redis): The Redis client for data storage.
         config (Config): The application's configuration object.
         msg_processor (MessageProcessor):
             The message processor for handling messages.
+        stepik_service (StepikService): The shared Stepik API client.
+        arq_pool (ArqRedis): The arq queue for the issuance job.
     """
     logger_user_hand.debug('Entry')
 
-    stepik_service = StepikService(
-        client_id=config.stepik.client_id,
-        client_secret=config.stepik.client_secret,
-        redis_client=redis_data,
-        courses=config.courses_data.courses,
-    )
     logger_user_hand.info(
         f'Анкета проверяется:{clbk.from_user.id}:{await get_username(clbk)}'
     )
@@ -483,53 +477,38 @@ async def clbk_done(
     stepik_user_id = await state.get_value('stepik_user_id')
     tg_username = await get_username(clbk)
 
-    # Проверяем, есть ли у пользователя уже сохраненный Stepik ID
-    existing_stepik_id = await redis_data.hget(
-        name=str(clbk.from_user.id), key='stepik_user_id'
+    # Проверяем привязку Stepik ID к пользователю и закрепляем его
+    claim_status, claim_value = await stepik_service.claim_stepik_id(
+        str(clbk.from_user.id), stepik_user_id
     )
-    if existing_stepik_id:
-        if existing_stepik_id != stepik_user_id:
-            await clbk.message.edit_text(
-                'Вы пытаетесь использовать другой Stepik-аккаунт. '
-                'Если вы ошиблись - повторите или обратитесь к администратору.'
-            )
-            logger_user_hand.warning(
-                f'Попытка смены Stepik ID для '
-                f'TG_ID:{clbk.from_user.id}:{tg_username}. '
-                f'Привязанный SEPIK_ID:{existing_stepik_id}, Новый SEPIK_ID:'
-                f'{stepik_user_id}'
-            )
-            await state.clear()
-            await clbk.answer()
-            return
-    else:
-        # Проверяем, не занят ли этот Stepik ID другим пользователем
-        all_user_hashes = await redis_data.keys('*')
-        for user_key in all_user_hashes:
-            if user_key.isdigit() and user_key != str(clbk.from_user.id):
-                other_user_stepik_id = await redis_data.hget(
-                    user_key, 'stepik_user_id'
-                )
-                if other_user_stepik_id == stepik_user_id:
-                    await clbk.message.edit_text(
-                        'Этот Stepik-аккаунт уже используется другим'
-                        ' пользователем. Обратитесь к администратору.'
-                    )
-                    logger_user_hand.warning(
-                        f'Попытка TG_ID:{clbk.from_user.id}:'
-                        f'{tg_username} использовать '
-                        f'занятый STEPIK ID:{stepik_user_id}'
-                    )
-                    await state.clear()
-                    await clbk.answer()
-                    return
-
-        # Если все проверки пройдены, сохраняем Stepik ID
-        await redis_data.hset(
-            name=str(clbk.from_user.id),
-            key='stepik_user_id',
-            value=stepik_user_id,
+    if claim_status == 'BOUND':
+        await clbk.message.edit_text(
+            'Вы пытаетесь использовать другой Stepik-аккаунт. '
+            'Если вы ошиблись - повторите или обратитесь к администратору.'
+        )
+        logger_user_hand.warning(
+            f'Попытка смены Stepik ID для '
+            f'TG_ID:{clbk.from_user.id}:{tg_username}. '
+            f'Привязанный SEPIK_ID:{claim_value}, Новый SEPIK_ID:'
+            f'{stepik_user_id}'
         )
+        await state.clear()
+        await clbk.answer()
+        return
+
+    if claim_status == 'TAKEN':
+        await clbk.message.edit_text(
+            'Этот Stepik-аккаунт уже используется другим'
+            ' пользователем. Обратитесь к администратору.'
+        )
+        logger_user_hand.warning(
+            f'Попытка TG_ID:{clbk.from_user.id}:'
+            f'{tg_username} использовать '
+            f'занятый STEPIK ID:{stepik_user_id}'
+        )
+        await state.clear()
+        await clbk.answer()
+        return
 
     course_clbk_data = await state.get_value('course')
     course_id = (
@@ -538,118 +517,43 @@ async def clbk_done(
         else course_clbk_data
     )
 
+    data = await state.get_data()
+    job = IssueCertificateJob(
+        tg_user_id=clbk.from_user.id,
+        chat_id=clbk.message.chat.id,
+        progress_message_id=value1.message_id,
+        tg_username=tg_username,
+        stepik_user_id=stepik_user_id,
+        course_id=course_id,
+        full_name=data.get('full_name'),
+        gender=data.get('gender'),
+        bypass_cache=config.is_admin(clbk.from_user.id),
+    )
+    # Выдача продолжается в задаче arq, анкета больше не нужна
+    await state.clear()
     try:
-        access_token = await stepik_service.get_stepik_access_token()
-        certificates = await stepik_service.check_cert_in_stepik(
-            stepik_user_id=stepik_user_id,
-            course_id=course_id,
-            access_token=access_token,
-            tg_username=tg_username,
-            config=config,
-        )
-    except ConnectionTimeoutError as e:
-        logger_user_hand.error(
-            f'Не удалось проверить сертификат на Stepik для'
-            f' TG_ID:{clbk.from_user.id}:{tg_username},'
-            f' STEPIK_USER_ID:{stepik_user_id},'
-            f' COURSE_ID:{course_id}, '
-            f'из-за ошибки передачи данных! Сертификат выдан без проверки!,'
-            f' {e}'
-        )
-        certificates = True
-
-    if certificates == 'PRIVATE':
-        value = await clbk.message.edit_text(
-            f'{tg_username},{LexiconRu.text_privacy_instructions}'
+        queued = await enqueue_issue_certificate(arq_pool, job)
+    except Exception as err:
+        logger_user_hand.error(f'{err=}', exc_info=True)
+        value = await clbk.message.answer(
+            'Произошла не предвиденная ошибка,'
+            ' обратитесь к администратору.'
         )
-        await state.clear()
         await msg_processor.save_msg_id(value, msgs_for_del=True)
+        await msg_processor.deletes_msg_a_delay(value1, delay=5)
         await clbk.answer()
+        logger_user_hand.debug('Exit:error')
         return
 
-    if certificates:
-        try:
-            if int(course_id) in config.courses_data.best_in_python_courses:
-                number = await redis_data.incr('end_number')
-            else:
-                number = await redis_data.incr(f'end_number_{course_id}')
-
-            number_str = str(number).zfill(6)
-            await state.update_data(end_number=number_str)
-
-        except Exception as err:
-            logger_user_hand.error(f'{err=}', exc_info=True)
-            value = await clbk.message.answer(
-                'Произошла не предвиденная ошибка,'
-                ' обратитесь к администратору.'
-            )
-            await msg_processor.save_msg_id(value, msgs_for_del=True)
-            await state.clear()
-            await msg_processor.deletes_msg_a_delay(value1, delay=5)
-            logger_user_hand.debug('Exit:error')
-            return
-
-        try:
-            await clbk.answer('Идет проверка…')
-            # генерация сертификата
-            logger_user_hand.info(
-                f'Генерация сертификата для:{clbk.from_user.id}:{tg_username}'
-            )
-            path = await stepik_service.generate_certificate(
-                state, type_update=clbk, w_text=config.w_text
-            )
-
-        except Exception as err:
-            logger_user_hand.error(f'{err=}', exc_info=True)
-            value = await clbk.message.answer(
-                'Произошла ошибка😯\nПопробуйте '
-                'позже или обратитесь к администратору🤖'
-            )
-            await msg_processor.deletes_msg_a_delay(value=value1, delay=2)
-            await msg_processor.deletes_msg_a_delay(
-                value=value, delay=20, indication=True
-            )
-            await state.clear()
-            return
-
-        try:
-            # отправка сертификата
-            await stepik_service.send_certificate(
-                clbk=clbk, output_file=path, state=state, course_id=course_id
-            )
-            await msg_processor.deletes_msg_a_delay(value=value1, delay=1)
-
-        except Exception as err:
-            logger_user_hand.error(f'{err=}', exc_info=True)
-        finally:
-            await state.clear()
-            await clbk.answer()
-    else:
+    if not queued:
         logger_user_hand.info(
-            f'Отсутствует серт на Stepik:{clbk.from_user.id}:{tg_username}'
-        )
-        value = await clbk.message.answer(
-            f'{tg_username}, у вас '
-            f'пока нет сертификата этого курса '
-            f'на Stepik🙁\n'
-            f'Наберите нужное для сертификата '
-            f'количество баллов, получите '
-            f'сертификат на платформе и приходите '
-            f'снова, за экземпляром от команды '
-            f'курса😉'
-        )
-        await msg_processor.deletes_msg_a_delay(
-            value, delay=15, indication=True
+            f'Повторная выдача отклонена, задача уже в очереди:'
+            f'{clbk.from_user.id}:{tg_username}:COURSE_ID:{course_id}'
         )
-        value = await clbk.message.answer(
-            LexiconRu.text_survey,
-            reply_markup=kb_butt_quiz,
-            disable_web_page_preview=True,
-        )
-        await msg_processor.deletes_msg_a_delay(value1, delay=5)
-        await msg_processor.save_msg_id(value, msgs_for_del=True)
-        await state.clear()
-        await clbk.answer()
+        await clbk.answer('Сертификат уже выдаётся, ожидайте⌛')
+        return
+
+    await clbk.answer('Идет проверка…')
     logger_user_hand.debug('Exit')
 
 
@@ -9,6 +9,7 @@ from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.redis import Redis, RedisStorage
+from arq import create_pool
 from arq.connections import RedisSettings
 
 from config_data.config import Config, load_config
@@ -26,9 +27,21 @@ from keyboards.set_menu import set_main_menu
 from middlewares.outer import (
     MsgProcMiddleware,
     RedisMiddleware,
+    StepikMiddleware,
     ThrottlingMiddleware,
+    UsernameMiddleware,
 )
 from queues.que_utils import run_arq_worker
+from utils import (
+    RedisTokenBucket,
+    StepikService,
+    UsernameCache,
+    create_stepik_session,
+    deletion_scheduler,
+    render_pool,
+    template_cache,
+)
+from utils.migrations import run_migrations
 
 logger_main = logging.getLogger(__name__)
 
@@ -102,6 +115,22 @@ async def setup_redis(config: Config) -> tuple[
     return redis_fsm, redis_throttling, redis_data, redis_que
 
 
+def create_throttling(storage: RedisStorage,
+                      config: Config,
+                      ttl: int) -> ThrottlingMiddleware:
+    """
+    Троттлинг в режиме из конфига (THROTTLE_MODE).
+    :param ttl: Интервал режима ttl (мс).
+    """
+    throttling = config.throttling
+    return ThrottlingMiddleware(storage=storage,
+                                ttl=ttl,
+                                mode=throttling.mode,
+                                rate_limit=throttling.rate_limit,
+                                period=throttling.period,
+                                burst=throttling.burst)
+
+
 async def main() -> None:
     config: Config = load_config()
 
@@ -109,14 +138,36 @@ async def main() -> None:
 
     await setup_logging(config)
 
+    template_cache.preload(config.courses_data.courses)
+    await render_pool.start(config.cert_render, config.courses_data.courses)
+
     bot = Bot(token=config.tg_bot.token,
               default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     
     redis_fsm, storage_throttling, redis_data, redis_que = await setup_redis(
             config)
-    
+    await run_migrations(redis_data)
+    
+    stepik_service = StepikService(
+        client_id=config.stepik.client_id,
+        client_secret=config.stepik.client_secret,
+        redis_client=redis_data,
+        courses=config.courses_data.courses,
+        session=create_stepik_session(),
+        rate_limiter=RedisTokenBucket(
+            redis_data,
+            name='stepik',
+            rate=config.stepik.rate_limit.rate,
+            capacity=config.stepik.rate_limit.burst),
+        max_retries=config.stepik.rate_limit.max_retries)
+    username_cache = UsernameCache(redis_data,
+                                   config.courses_data.courses)
+    msg_throttling = create_throttling(storage_throttling, config, ttl=700)
+    clbk_throttling = create_throttling(storage_throttling, config, ttl=500)
+
     storage = RedisStorage(redis=redis_fsm)
     dp = Dispatcher(storage=storage)
+    arq_pool = await create_pool(redis_que)
     
     await set_main_menu(bot)
     
@@ -129,11 +180,11 @@ async def main() -> None:
         # Приносим извинения за неудобства!")
         # dp.update.outer_middleware(maintenance_middleware)
         dp.update.middleware(RedisMiddleware(redis=redis_data))
+        dp.update.middleware(StepikMiddleware(stepik_service))
         dp.update.middleware(MsgProcMiddleware())
-        dp.message.outer_middleware(ThrottlingMiddleware(
-            storage=storage_throttling, ttl=700))
-        dp.callback_query.outer_middleware(ThrottlingMiddleware(
-            storage=storage_throttling, ttl=500))
+        dp.update.middleware(UsernameMiddleware(username_cache))
+        dp.message.outer_middleware(msg_throttling)
+        dp.callback_query.outer_middleware(clbk_throttling)
         
         # routers
         # TODO: using include_routers
@@ -146,15 +197,31 @@ async def main() -> None:
         dp.include_router(admin_handlers.admin_router)
 
         await bot.delete_webhook(drop_pending_updates=True)
+        stepik_service.start_token_refresher()
+        username_cache.start_refresher(bot)
         logger_main.info('Start bot')
 
-        await asyncio.gather(dp.start_polling(bot, config=config),
-                             run_arq_worker(redis_que, bot=bot))
+        await asyncio.gather(dp.start_polling(bot,
+                                              config=config,
+                                              arq_pool=arq_pool),
+                             run_arq_worker(redis_que,
+                                            bot=bot,
+                                            config=config,
+                                            stepik_service=stepik_service,
+                                            redis_data=redis_data,
+                                            storage=storage))
     
     except Exception as err:
         logger_main.exception(err)
         raise
     finally:
+        render_pool.shutdown()
+        await deletion_scheduler.shutdown()
+        await stepik_service.close()
+        await username_cache.close()
+        logger_main.info(f'Троттлинг сообщений: {msg_throttling.stats}, '
+                         f'колбэков: {clbk_throttling.stats}')
+        await arq_pool.aclose()
         await redis_fsm.aclose()
         await redis_data.aclose()
         await storage_throttling.redis.aclose()
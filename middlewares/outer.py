@@ -1,6 +1,7 @@
-import asyncio
 import logging
+import time
 
+from collections import OrderedDict
 from collections.abc import Awaitable, Callable
 from pathlib import Path
 from typing import Any
@@ -16,7 +17,8 @@ from redis.asyncio import Redis
 from config_data.config import Config
 from lexicon.lexicon_ru import LexiconRu
 from utils import get_username
-from utils.utils import MessageProcessor
+from utils.usernames import UsernameCache
+from utils.utils import MessageProcessor, StepikService
 
 logger_middl_outer = logging.getLogger(__name__)
 PROJECT_ROOT = Path(__file__).parent.parent
@@ -35,26 +37,173 @@ class RedisMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+class StepikMiddleware(BaseMiddleware):
+    """
+    Передает общий StepikService в контекст, для доступа в хэндлерах
+    """
+
+    def __init__(self, stepik_service: StepikService):
+        self.stepik_service = stepik_service
+
+    async def __call__(self, handler, event, data):
+        data['stepik_service'] = self.stepik_service
+        return await handler(event, data)
+
+
+class UsernameMiddleware(BaseMiddleware):
+    """
+    Попутно обновляет кэш имён пользователей из входящих апдейтов
+    """
+
+    def __init__(self, username_cache: UsernameCache):
+        self.username_cache = username_cache
+
+    async def __call__(self, handler, event, data):
+        user: User | None = data.get('event_from_user')
+        if user and not user.is_bot:
+            try:
+                await self.username_cache.remember(user)
+            except Exception as err:
+                logger_middl_outer.warning(f'Имя TG_ID:{user.id} не '
+                                           f'сохранено: {err}')
+        return await handler(event, data)
+
+
+# Уровни ответа скриптов троттлинга
+THROTTLE_PASS = 0
+THROTTLE_WARN = 1
+THROTTLE_DROP = 2
+# Сколько мс после предупреждения события пользователя молча удаляются
+# (режим ttl; в режиме gcra - сколько не повторяется предупреждение)
+THROTTLE_PENALTY_MS = 5000
+# Локальный фильтр: после ответа Redis о превышении события пользователя
+# отбрасываются в процессе, без Redis и Bot API, пока Redis их всё равно
+# отклонил бы (ожидание из ответа скрипта)
+THROTTLE_LOCAL_MAX = 10_000
+
+# Скрипты возвращают {уровень, сколько мс до пропуска события}.
+# Режим ttl. KEYS[1] - throttl_<id>, ARGV[1] - ttl, ARGV[2] - штраф (мс)
+# Ключ 1 - событие пропущено, 2 - пользователь предупреждён.
+THROTTLE_TTL_LUA = """
+local state = redis.call('GET', KEYS[1])
+if not state then
+    redis.call('SET', KEYS[1], 1, 'PX', ARGV[1])
+    return {0, 0}
+end
+if state == '1' then
+    redis.call('SET', KEYS[1], 2, 'PX', ARGV[2])
+    return {1, tonumber(ARGV[2])}
+end
+return {2, math.max(redis.call('PTTL', KEYS[1]), 0)}
+"""
+
+# Режим gcra. KEYS[1] - TAT (теоретическое время прихода, мс),
+# KEYS[2] - отметка предупреждения. ARGV[1] - интервал между событиями,
+# ARGV[2] - допустимый всплеск (мс), ARGV[3] - штраф (мс)
+THROTTLE_GCRA_LUA = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now)
+local wait = tat - now - tonumber(ARGV[2])
+if wait > 0 then
+    if redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[3]) then
+        return {1, wait}
+    end
+    return {2, wait}
+end
+tat = tat + interval
+redis.call('SET', KEYS[1], tat, 'PX', tat - now)
+return {0, 0}
+"""
+
+
 class ThrottlingMiddleware(BaseMiddleware):
     """A middleware for limiting the frequency of requests from a single user.
     Uses Redis to store information about request frequency. If the frequency
-    exceeds the set threshold, requests are blocked.
+    exceeds the set threshold, requests are blocked. The check and update are
+    done by one Lua script, in one round-trip and atomically.
+    Modes:
+        ttl: one event per ttl ms (the first excess warns, the rest in
+        THROTTLE_PENALTY_MS are dropped).
+        gcra: GCRA, up to burst events at once and rate_limit events per
+        period ms on average.
     Attributes:
         storage (RedisStorage): An object for interacting with Redis.
         ttl (int | None): The time-to-live for the key in milliseconds. If
-        None, rate limiting is disabled."""
-
-    def __init__(self, storage: RedisStorage, ttl: int | None = None):
+        None, rate limiting is disabled in ttl mode."""
+
+    def __init__(self,
+                 storage: RedisStorage,
+                 ttl: int | None = None,
+                 mode: str = 'ttl',
+                 rate_limit: int = 3,
+                 period: int = 2000,
+                 burst: int = 3):
         """
         Initializes the middleware for limiting the frequency of requests.
         Args: storage (RedisStorage): An object for interacting with Redis.
         ttl (int | None, optional): The time-to-live for the key in
         milliseconds. If None, rate limiting is disabled.
         :param storage: RedisStorage.
-        :param ttl:
+        :param ttl: Интервал режима ttl (мс); None - троттлинг выключен.
+        :param mode: ttl или gcra.
+        :param rate_limit: Событий за period в режиме gcra.
+        :param period: Окно режима gcra (мс).
+        :param burst: Допустимый всплеск событий в режиме gcra.
         """
+        if mode not in ('ttl', 'gcra'):
+            raise ValueError(f'Неизвестный режим троттлинга: {mode}')
+        # Интервал gcra period // rate_limit должен быть не меньше 1 мс
+        if rate_limit < 1 or burst < 1 or period < rate_limit:
+            raise ValueError(f'Троттлинг: нужны rate_limit >= 1, '
+                             f'burst >= 1 и period >= rate_limit мс, '
+                             f'получено rate_limit={rate_limit}, '
+                             f'period={period}, burst={burst}')
         self.storage = storage
         self.ttl = ttl
+        self.mode = mode
+        self.interval = period // rate_limit
+        self.burst_tolerance = self.interval * (burst - 1)
+        self._script = storage.redis.register_script(
+            THROTTLE_TTL_LUA if mode == 'ttl' else THROTTLE_GCRA_LUA)
+        # user_id -> момент (time.monotonic), до которого события
+        # отбрасываются локально; порядок - LRU
+        self._cooldowns: OrderedDict[int, float] = OrderedDict()
+        self.stats = {'checked': 0, 'warned': 0, 'dropped': 0,
+                      'dropped_locally': 0}
+
+    def _in_cooldown(self, user_id: int) -> bool:
+        until = self._cooldowns.get(user_id)
+        if until is None:
+            return False
+        if until <= time.monotonic():
+            del self._cooldowns[user_id]
+            return False
+        return True
+
+    def _start_cooldown(self, user_id: int, duration_ms: int) -> None:
+        self._cooldowns[user_id] = time.monotonic() + duration_ms / 1000
+        self._cooldowns.move_to_end(user_id)
+        if len(self._cooldowns) > THROTTLE_LOCAL_MAX:
+            self._cooldowns.popitem(last=False)
+
+    async def _check(self, user_id: int) -> tuple[int, int]:
+        """
+        :return: THROTTLE_PASS, THROTTLE_WARN или THROTTLE_DROP и сколько
+                 мс события пользователя будут отклоняться.
+        """
+        throttl_user_id = f'throttl_{user_id}'
+        if self.mode == 'ttl':
+            tier, wait_ms = await self._script(
+                keys=[throttl_user_id],
+                args=[self.ttl, THROTTLE_PENALTY_MS])
+        else:
+            tier, wait_ms = await self._script(
+                keys=[f'{throttl_user_id}:tat', f'{throttl_user_id}:warned'],
+                args=[self.interval, self.burst_tolerance,
+                      THROTTLE_PENALTY_MS])
+        return tier, wait_ms
 
     async def __call__(
         self,
@@ -80,57 +229,52 @@ class ThrottlingMiddleware(BaseMiddleware):
             return await handler(event, data)
 
         config: Config = data.get('config')
-        admins_id = config.tg_bot.id_admins.split()
-        logger_middl_outer.debug(f'{admins_id=}')
-
-        if str(event.from_user.id) in admins_id:
+        if config.is_admin(event.from_user.id):
             logger_middl_outer.debug('Exit')
             return await handler(event, data)
 
         state: FSMContext = data.get('state')
         msg_processor = MessageProcessor(event, state)
 
-        if self.ttl is None:
+        if self.mode == 'ttl' and self.ttl is None:
             logger_middl_outer.debug('Exit')
             return await handler(event, data)
 
         user: User = data.get('event_from_user')
-        throttl_user_id = f'throttl_{user.id}'
-        check_user = await self.storage.redis.get(name=throttl_user_id)
+        if self._in_cooldown(user.id):
+            self.stats['dropped_locally'] += 1
+            logger_middl_outer.debug('Exit')
+            return None
+
+        self.stats['checked'] += 1
+        tier, wait_ms = await self._check(user.id)
 
-        if check_user and int(check_user.decode()) == 1:
+        if tier == THROTTLE_WARN:
+            self.stats['warned'] += 1
+            self._start_cooldown(user.id, wait_ms)
             if isinstance(event, Message):
                 value = await event.answer(text=LexiconRu.text_antispam)
-                asyncio.create_task(
-                    msg_processor.deletes_msg_a_delay(value, 5)
-                )
+                await msg_processor.deletes_msg_a_delay(value, 5)
 
             if isinstance(event, CallbackQuery):
                 await event.answer()
 
-            asyncio.create_task(
-                msg_processor.deletes_msg_a_delay(event, 6, indication=True)
-            )
-            await self.storage.redis.set(
-                name=throttl_user_id, value=2, px=5000
-            )
+            await msg_processor.deletes_msg_a_delay(event, 6,
+                                                    indication=True)
 
             logger_middl_outer.warning(
-                f'Throttling:{await get_username(event)}:{throttl_user_id}'
+                f'Throttling:{await get_username(event)}:throttl_{user.id}'
             )
             logger_middl_outer.debug(f'Exit {__class__.__name__}')
             return None
 
-        elif check_user and int(check_user.decode()) == 2:
-            asyncio.create_task(msg_processor.deletes_msg_a_delay(event, 5))
+        elif tier == THROTTLE_DROP:
+            self.stats['dropped'] += 1
+            self._start_cooldown(user.id, wait_ms)
+            await msg_processor.deletes_msg_a_delay(event, 5)
             logger_middl_outer.debug('Exit')
             return None
 
-        if not check_user:
-            await self.storage.redis.set(
-                name=throttl_user_id, value=1, px=self.ttl
-            )
-
         logger_middl_outer.debug(f'Exit {__class__.__name__}')
 
         return await handler(event, data)
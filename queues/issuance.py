@@ -0,0 +1,341 @@
+import logging
+
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.types import Message
+from aiohttp import ConnectionTimeoutError
+from arq import ArqRedis
+
+from config_data.config import Config
+from keyboards.keyboards import kb_butt_quiz
+from lexicon import LexiconRu
+from utils.certificates import RenderedCertificate
+from utils.deletion import deletion_scheduler
+from utils.utils import MessageProcessor, StepikService
+
+logger_issuance = logging.getLogger(__name__)
+
+# Отдельная очередь и воркер: выдача не ждёт задачи рассылки
+ISSUE_QUEUE_NAME = 'arq:queue:issuance'
+ISSUE_MAX_JOBS = 5
+
+
+@dataclass(frozen=True)
+class IssueCertificateJob:
+    """
+    Данные анкеты для выдачи сертификата в фоне (задача arq).
+    flow — сценарий выдачи: 'user' или 'pragmatic'.
+    """
+    tg_user_id: int
+    chat_id: int
+    progress_message_id: int
+    tg_username: str
+    stepik_user_id: str
+    course_id: str
+    full_name: str
+    gender: str
+    flow: str = 'user'
+    bypass_cache: bool = False
+
+
+IssuedHook = Callable[[dict, IssueCertificateJob, FSMContext],
+                      Awaitable[None]]
+
+# flow -> (действие после выдачи, задержка запуска в секундах)
+_issued_hooks: dict[str, tuple[IssuedHook, float]] = {}
+
+
+def on_certificate_issued(
+        flow: str,
+        delay: float = 0) -> Callable[[IssuedHook], IssuedHook]:
+    """
+    Регистрирует действие сценария после доставки нового сертификата
+    (например, предложение скидки в сценарии Pragmatic). Действие
+    выполняется отдельной задачей arq, отложенной на delay секунд, и не
+    занимает слот задачи выдачи.
+    :param flow: Сценарий выдачи из IssueCertificateJob.flow.
+    :param delay: Задержка запуска действия после выдачи.
+    """
+    def decorator(hook: IssuedHook) -> IssuedHook:
+        _issued_hooks[flow] = (hook, delay)
+        return hook
+    return decorator
+
+
+def issue_job_id(tg_user_id: int, course_id: str) -> str:
+    """
+    Ключ идемпотентности: пока задача выдачи в очереди или выполняется,
+    повторная постановка с тем же ключом игнорируется arq.
+    """
+    return f'issue:{tg_user_id}:{course_id}'
+
+
+async def enqueue_issue_certificate(arq_pool: ArqRedis,
+                                    job: IssueCertificateJob) -> bool:
+    """
+    Ставит выдачу сертификата в очередь.
+    :return: False, если выдача по этому курсу уже идёт.
+    """
+    queued = await arq_pool.enqueue_job(
+        'issue_certificate',
+        job,
+        _job_id=issue_job_id(job.tg_user_id, job.course_id),
+        _queue_name=ISSUE_QUEUE_NAME)
+    return queued is not None
+
+
+async def _report_progress(bot: Bot,
+                           job: IssueCertificateJob,
+                           text: str) -> Message | None:
+    try:
+        message = await bot.edit_message_text(
+            text,
+            chat_id=job.chat_id,
+            message_id=job.progress_message_id)
+    except Exception as err:
+        logger_issuance.warning(f'Не удалось обновить статус выдачи '
+                                f'TG_ID:{job.tg_user_id}: {err}')
+        return None
+    return message if isinstance(message, Message) else None
+
+
+def _job_state(bot: Bot,
+               storage: BaseStorage,
+               job: IssueCertificateJob) -> FSMContext:
+    return FSMContext(storage=storage,
+                      key=StorageKey(bot_id=bot.id,
+                                     chat_id=job.chat_id,
+                                     user_id=job.tg_user_id))
+
+
+async def _report_error(bot: Bot,
+                        job: IssueCertificateJob,
+                        progress: Message | None) -> str:
+    value = await bot.send_message(
+        job.chat_id,
+        'Произошла ошибка😯\nПопробуйте '
+        'позже или обратитесь к администратору🤖')
+    if progress:
+        deletion_scheduler.schedule(progress, delay=2)
+    deletion_scheduler.schedule(value,
+                                delay=20,
+                                indication=True)
+    return 'error'
+
+
+async def _verify(stepik_service: StepikService,
+                  config: Config,
+                  job: IssueCertificateJob) -> bool | str:
+    """
+    Проверка сертификата на Stepik. При таймауте соединения сертификат
+    выдаётся без проверки.
+    """
+    try:
+        return await stepik_service.verify_certificate(
+            stepik_user_id=job.stepik_user_id,
+            course_id=job.course_id,
+            tg_username=job.tg_username,
+            config=config,
+            bypass_cache=job.bypass_cache)
+    except ConnectionTimeoutError as e:
+        logger_issuance.error(
+            f'Не удалось проверить сертификат на Stepik для'
+            f' TG_ID:{job.tg_user_id}:{job.tg_username},'
+            f' STEPIK_USER_ID:{job.stepik_user_id},'
+            f' COURSE_ID:{job.course_id}, '
+            f'из-за ошибки передачи данных! Сертификат выдан без проверки!,'
+            f' {e}')
+        return True
+
+
+async def _report_not_verified(bot: Bot,
+                               job: IssueCertificateJob,
+                               state: FSMContext,
+                               progress: Message | None,
+                               certificates: bool | str) -> str:
+    """
+    Сообщает, что сертификат не подтверждён: профиль закрыт
+    или сертификата на Stepik нет.
+    :return: Итог выдачи: private или not_found.
+    """
+    if certificates == 'PRIVATE':
+        value = await bot.send_message(
+            job.chat_id,
+            f'{job.tg_username},{LexiconRu.text_privacy_instructions}')
+        await MessageProcessor(value, state).save_msg_id(value,
+                                                         msgs_for_del=True)
+        if progress:
+            deletion_scheduler.schedule(progress, delay=1)
+        return 'private'
+
+    logger_issuance.info(f'Отсутствует серт на Stepik:'
+                         f'{job.tg_user_id}:{job.tg_username}')
+    value = await bot.send_message(
+        job.chat_id,
+        f'{job.tg_username}, у вас '
+        f'пока нет сертификата этого курса '
+        f'на Stepik🙁\n'
+        f'Наберите нужное для сертификата '
+        f'количество баллов, получите '
+        f'сертификат на платформе и приходите '
+        f'снова, за экземпляром от команды '
+        f'курса😉')
+    deletion_scheduler.schedule(value,
+                                delay=15,
+                                indication=True)
+    value = await bot.send_message(job.chat_id,
+                                   LexiconRu.text_survey,
+                                   reply_markup=kb_butt_quiz,
+                                   disable_web_page_preview=True)
+    await MessageProcessor(value, state).save_msg_id(value,
+                                                     msgs_for_del=True)
+    if progress:
+        deletion_scheduler.schedule(progress, delay=5)
+    return 'not_found'
+
+
+async def _reserve_number(stepik_service: StepikService,
+                          config: Config,
+                          job: IssueCertificateJob) -> str | None:
+    """
+    Выделяет номер сертификата (begin_issuance).
+    :return: Номер или None, если сертификат по курсу уже выдан.
+    """
+    if int(job.course_id) in config.courses_data.best_in_python_courses:
+        counter_key = 'end_number'
+    else:
+        counter_key = f'end_number_{job.course_id}'
+
+    status, number = await stepik_service.begin_issuance(
+        str(job.tg_user_id), job.course_id, counter_key)
+    if status == 'EXISTS':
+        logger_issuance.info(f'Сертификат уже выдан:{job.tg_user_id}:'
+                             f'{job.tg_username}:COURSE_ID:'
+                             f'{job.course_id}:{number}')
+        return None
+    if status == 'PENDING':
+        logger_issuance.info(f'Повторная выдача с номером {number}:'
+                             f'{job.tg_user_id}:{job.tg_username}')
+    return number
+
+
+async def _finalize(ctx: dict,
+                    job: IssueCertificateJob,
+                    progress: Message | None,
+                    certificate: RenderedCertificate,
+                    record: str) -> str:
+    """
+    Отправляет сертификат (данные сохраняются после доставки) и ставит
+    в очередь действие сценария после выдачи.
+    :return: Итог выдачи: issued или error.
+    """
+    bot: Bot = ctx['bot']
+    stepik_service: StepikService = ctx['stepik_service']
+    state = _job_state(bot, ctx['storage'], job)
+
+    if progress is None:
+        progress = await bot.send_message(job.chat_id, 'Отправляем '
+                                                       'сертификат📨')
+    delivered = await stepik_service.send_certificate(
+        message=progress,
+        tg_user_id=str(job.tg_user_id),
+        tg_username=job.tg_username,
+        certificate=certificate,
+        state=state,
+        course_id=job.course_id,
+        record=record)
+    deletion_scheduler.schedule(progress, delay=1)
+    if not delivered:
+        return 'error'
+
+    if job.flow in _issued_hooks:
+        _, delay = _issued_hooks[job.flow]
+        arq_pool: ArqRedis = ctx['redis']
+        await arq_pool.enqueue_job(
+            'run_issued_hook',
+            job,
+            _job_id=f'issued:{job.tg_user_id}:{job.course_id}',
+            _queue_name=ISSUE_QUEUE_NAME,
+            _defer_by=delay)
+    return 'issued'
+
+
+async def issue_certificate(ctx: dict, job: IssueCertificateJob) -> str:
+    """
+    Задача arq: проверка сертификата на Stepik, выделение номера
+    (begin_issuance), генерация и отправка PDF; данные сертификата
+    сохраняются после доставки. О ходе выдачи пользователь узнаёт из
+    сообщения, которое обновляется на каждом шаге.
+    :return: Итог выдачи: issued, exists, private, not_found или error.
+    """
+    logger_issuance.debug('Entry')
+
+    bot: Bot = ctx['bot']
+    config: Config = ctx['config']
+    stepik_service: StepikService = ctx['stepik_service']
+    state = _job_state(bot, ctx['storage'], job)
+
+    progress = await _report_progress(
+        bot, job, 'Проверяем сертификат на Stepik⌛')
+
+    # Номер ещё не выделен: при ошибке проверки ожидающей выдачи нет
+    try:
+        certificates = await _verify(stepik_service, config, job)
+    except Exception as err:
+        logger_issuance.error(f'Ошибка проверки сертификата на Stepik '
+                              f'TG_ID:{job.tg_user_id}: {err!r}',
+                              exc_info=True)
+        return await _report_error(bot, job, progress)
+
+    if certificates == 'PRIVATE' or not certificates:
+        return await _report_not_verified(bot, job, state, progress,
+                                          certificates)
+
+    try:
+        number = await _reserve_number(stepik_service, config, job)
+        if number is None:
+            if progress:
+                await progress.edit_text('Сертификат по этому курсу уже '
+                                         'выдан✅\nКопию можно получить '
+                                         'в меню выбора курса.')
+            return 'exists'
+
+        progress = await _report_progress(
+            bot, job, 'Сертификат найден✅\nГенерируем ваш сертификат📜')
+        logger_issuance.info(f'Генерация сертификата для:'
+                             f'{job.tg_user_id}:{job.tg_username}')
+        certificate, record = await stepik_service.create_certificate(
+            tg_user_id=str(job.tg_user_id),
+            course_id=job.course_id,
+            full_name=job.full_name,
+            gender=job.gender,
+            number=number.zfill(6),
+            w_text=config.w_text,
+            to_disk=config.cert_render_to_disk)
+    except Exception as err:
+        # Выделенный номер остаётся ожидающим и достанется повторной
+        # выдаче (begin_issuance вернёт PENDING)
+        logger_issuance.error(f'{err=}', exc_info=True)
+        return await _report_error(bot, job, progress)
+
+    result = await _finalize(ctx, job, progress, certificate, record)
+    logger_issuance.debug('Exit')
+    return result
+
+
+async def run_issued_hook(ctx: dict, job: IssueCertificateJob) -> None:
+    """
+    Задача arq: действие сценария после выдачи сертификата
+    (см. on_certificate_issued).
+    """
+    hook, _ = _issued_hooks[job.flow]
+    state = _job_state(ctx['bot'], ctx['storage'], job)
+    try:
+        await hook(ctx, job, state)
+    except Exception as err:
+        logger_issuance.error(f'{err=}', exc_info=True)
+        await state.clear()
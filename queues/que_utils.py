@@ -1,110 +1,398 @@
 import asyncio
 import logging
+import random
+
+from collections.abc import AsyncIterator, Iterable
+from uuid import uuid4
 
 from aiogram import Bot
 from aiogram.exceptions import (
     TelegramBadRequest,
+    TelegramForbiddenError,
     TelegramRetryAfter,
     TelegramUnauthorizedError,
 )
-from arq import Worker, create_pool
+from arq import ArqRedis, Worker
 from arq.connections import RedisSettings
+from arq.constants import (
+    in_progress_key_prefix,
+    job_key_prefix,
+    result_key_prefix,
+)
+from arq.worker import Retry, func
+from redis.asyncio import Redis
 
 from keyboards import kb_admin
 from lexicon import LexiconRu
+from queues.issuance import (
+    ISSUE_MAX_JOBS,
+    ISSUE_QUEUE_NAME,
+    issue_certificate,
+    run_issued_hook,
+)
+from utils.rate_limit import RedisTokenBucket
 
 queue_logger = logging.getLogger(__name__)
 
+# Рассылка (кампания) в DB 3:
+# mailing:<id> - hash состояния, mailing:<id>:queued - поставленные в
+# очередь получатели, mailing:<id>:recipients - итог по получателю,
+# mailings:active - незавершённые кампании
+MAILING_KEY_PREFIX = 'mailing:'
+MAILINGS_ACTIVE_KEY = 'mailings:active'
+MAILING_SCAN_CHUNK = 500
+# Сколько enqueue_job выполняется параллельно при постановке пачки
+MAILING_ENQUEUE_CONCURRENCY = 50
+MAILING_TTL = 7 * 86400
+MAILING_DRIVER_TIMEOUT = 3600
+
+# Общий лимит отправки сообщений рассылки (Telegram: ~30 сообщений/с)
+TG_SEND_RATE = 25
+TG_SEND_BURST = 30
+TG_SEND_MIN_RATE = 5
+# SEND_MAX_TRIES - попытки при ошибках отправки (счётчик в
+# send_failures:<job_id>); переносы из-за лимита и RetryAfter их не
+# расходуют и ограничены только SEND_JOB_MAX_TRIES запусков задачи arq
+SEND_MAX_TRIES = 5
+SEND_JOB_MAX_TRIES = 100
+SEND_RETRY_BACKOFF = 2
+SEND_FAILURES_KEY_PREFIX = 'send_failures:'
+SEND_FAILURES_TTL = 86400
+# Дольше ждать токен отправки слот воркера не должен: задача переносится
+SEND_LIMITER_MAX_WAIT = 1
+
+# Проверка завершения: обход получателей закончен и каждый поставленный
+# в очередь получатель учтён. HSETNX completed гарантирует, что
+# уведомление о завершении ставится один раз.
+_COMPLETION_CHECK_LUA = """
+local campaign = redis.call('HMGET', KEYS[1], 'scan_finished', 'enqueued',
+                            'done')
+if campaign[1] == '1' and campaign[2] == campaign[3] then
+    return redis.call('HSETNX', KEYS[1], 'completed', 1)
+end
+return 0
+"""
+
+# KEYS[1] - hash кампании, KEYS[2] - queued
+# ARGV[1] - курсор SCAN после пачки, ARGV[2] - TTL, ARGV[3..] - получатели
+# Возвращает 1, если кампания завершена этим вызовом.
+MAILING_CHECKPOINT_LUA = """
+local added = 0
+for i = 3, #ARGV do
+    added = added + redis.call('SADD', KEYS[2], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'enqueued', added)
+redis.call('HSET', KEYS[1], 'cursor', ARGV[1])
+if ARGV[1] ~= '0' then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'scan_finished', 1)
+""" + _COMPLETION_CHECK_LUA
+
+# KEYS[1] - hash кампании, KEYS[2] - recipients
+# ARGV[1] - получатель, ARGV[2] - итог (sent, blocked, failed), ARGV[3] - TTL
+# Возвращает -1, если получатель уже учтён, 1 - если кампания завершена
+# этим вызовом, иначе 0.
+MAILING_RECORD_LUA = """
+if redis.call('HSETNX', KEYS[2], ARGV[1], ARGV[2]) == 0 then
+    return -1
+end
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+redis.call('HINCRBY', KEYS[1], 'done', 1)
+""" + _COMPLETION_CHECK_LUA
+
+
+async def _send_message(ctx: dict, user_id: int, message: str) -> str:
+    """
+    Отправляет сообщение через общий для всех воркеров лимит отправки
+    (send_limiter). Если токена ждать дольше SEND_LIMITER_MAX_WAIT (пауза
+    после RetryAfter), при RetryAfter и временных ошибках задача не ждёт
+    в слоте воркера, а переносится arq (Retry). Попытки из SEND_MAX_TRIES
+    расходуют только ошибки отправки.
+    :return: Итог на последней попытке: sent, blocked (бот заблокирован,
+             чат недоступен) или failed.
+    """
+    bot: Bot = ctx['bot']
+    send_limiter: RedisTokenBucket = ctx['send_limiter']
+    job_try = ctx.get('job_try', 1)
+    last_try = job_try >= SEND_JOB_MAX_TRIES
+
+    wait = await send_limiter.acquire(max_wait=SEND_LIMITER_MAX_WAIT)
+    if wait:
+        if last_try:
+            return 'failed'
+        raise Retry(defer=wait + random.uniform(0, wait / 2))
+    try:
+        await bot.send_message(chat_id=user_id, text=message)
+
+    except TelegramRetryAfter as e:
+        await send_limiter.throttle(e.retry_after)
+        queue_logger.warning(f"Ограничение лимита для {user_id}, перенос "
+                             f"на {e.retry_after}s")
+        if last_try:
+            return 'failed'
+        raise Retry(defer=e.retry_after) from e
+
+    except (TelegramUnauthorizedError,
+            TelegramForbiddenError,
+            TelegramBadRequest) as e:
+        queue_logger.error(f"Постоянная ошибка для {user_id}: {e}")
+        return 'blocked'  # Нет смысла повторять при этих ошибках
+
+    except Exception as e:
+        failures = await _count_send_failure(ctx)
+        queue_logger.error(f"Попытка {failures}/{SEND_MAX_TRIES} не удача "
+                           f"{user_id}: {str(e)}",
+                           exc_info=True)
+        if last_try or failures >= SEND_MAX_TRIES:
+            return 'failed'
+        raise Retry(defer=SEND_RETRY_BACKOFF * 2 ** failures) from e
+
+    queue_logger.info(f"Message sent to {user_id}")
+    return 'sent'
+
+async def _count_send_failure(ctx: dict) -> int:
+    """
+    :return: Количество неудачных отправок задачи с учётом текущей.
+    """
+    key = f'{SEND_FAILURES_KEY_PREFIX}{ctx.get("job_id")}'
+    async with ctx['redis'].pipeline(transaction=True) as pipe:
+        pipe.incr(key)
+        pipe.expire(key, SEND_FAILURES_TTL)
+        failures, _ = await pipe.execute()
+    return failures
+
 async def safe_send_message(ctx: dict,
                             user_id: int,
-                            message: str,
-                            retries=3) -> bool:
-    """
-    Асинхронно отправляет сообщение с обработкой ошибок и повторными попытками.
-    """
-    queue_logger.debug('Entry')
-
-    bot = ctx['bot']
-
-    for attempt in range(1, retries + 1):
-        try:
-            await bot.send_message(chat_id=user_id, text=message)
-            queue_logger.info(f"Message sent to {user_id}")
-            return True
-
-        except TelegramRetryAfter as e:
-            wait_time = e.retry_after
-            queue_logger.warning(f"Ограничение лимита для {user_id}. "
-                                 f"Повтор {attempt}/{retries}. Ожидание "
-                                 f"{wait_time}s", exc_info=True)
-            await asyncio.sleep(wait_time)
-
-        except (TelegramUnauthorizedError, TelegramBadRequest) as e:
-            queue_logger.error(f"Постоянная ошибка для {user_id}: {e}",
-                               exc_info=True)
-            return False  # Нет смысла повторять при этих ошибках
-
-        except Exception as e:
-            queue_logger.error(
-                    f"Попытка {attempt}/{retries} не удача {user_id}:"
-                    f" {str(e)}",
-                    exc_info=True)
-            if attempt < retries:
-                await asyncio.sleep(2 ** attempt)  # Экспоненциальная задержка
-
-    queue_logger.error(f"Failed to send to {user_id} after {retries} attempts",
-                       exc_info=True)
-
-    queue_logger.debug('Exit False')
-    return False
-
-async def mass_mailing(redis_que: RedisSettings, user_ids: set[int],
-                       message: str, admin_ids: str, end_cert: str,  delay=0.1):
-    """
-    Массовая рассылка и отправка уведомления после завершения.
-    :param admin_ids:
-    :param end_cert:
-    :param delay:
-    :param redis_que:
-    :param user_ids:
-    :param message:
-    :return:
-    """
-    queue_logger.debug('Entry')
-    queue_logger.info(f"Рассылка началась для {len(user_ids)} юзеров")
-
-    queue = await create_pool(redis_que)
-    admins = set(map(int, admin_ids.split()))
-    successful = 0
-    fail = 0
-    tasks = []
-    for user_id in user_ids:
-        job = await queue.enqueue_job(function='safe_send_message',
-                               user_id=user_id,
-                               message=message)
-        tasks.append(job)
-        await asyncio.sleep(delay)
-
-    # Ожидание выполнения всех задач
-    for task in tasks:
-        try:
-            result = await task.result()
-            if result:
-                successful += 1
-        except Exception as e:
-            fail += 1
-            queue_logger.error(f"Ошибка при выполнении задачи: {e}")
-
-    # Добавляем задачу уведомления в очередь после завершения
-    # отправки всех сообщений
-    await queue.enqueue_job(function='on_mailing_completed',
-                            end_cert=end_cert, admins=admins,
-                            counter_users=successful, fail=fail)
-
-    queue_logger.debug('Exit')
+                            message: str) -> bool:
+    """
+    Задача arq: отправка одного сообщения с повторами через arq.
+    :return: True, если сообщение доставлено.
+    """
+    return await _send_message(ctx, user_id, message) == 'sent'
+
+def mailing_key(mailing_id: str) -> str:
+    """
+    Hash кампании: текст, статус, курсор обхода получателей, счётчики
+    enqueued, done, sent, blocked, failed и данные для итогового
+    уведомления (admins, end_cert).
+    """
+    return f'{MAILING_KEY_PREFIX}{mailing_id}'
+
+async def start_mailing_campaign(arq_pool: ArqRedis,
+                                 message: str,
+                                 admins: Iterable[int],
+                                 end_cert: str) -> str:
+    """
+    Создаёт кампанию рассылки всем пользователям бота и ставит в очередь
+    её обход (run_mailing_campaign). Управление возвращается сразу.
+    :param arq_pool: Пул arq.
+    :param message: Текст рассылки.
+    :param admins: ID администраторов для уведомления.
+    :param end_cert: Последний номер сертификата для админ-панели.
+    :return: ID кампании.
+    """
+    mailing_id = uuid4().hex
+    key = mailing_key(mailing_id)
+    async with arq_pool.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={'message': message,
+                                'status': 'running',
+                                'cursor': 0,
+                                'enqueued': 0,
+                                'done': 0,
+                                'sent': 0,
+                                'blocked': 0,
+                                'failed': 0,
+                                'admins': ' '.join(map(str, admins)),
+                                'end_cert': end_cert})
+        pipe.expire(key, MAILING_TTL)
+        pipe.sadd(MAILINGS_ACTIVE_KEY, mailing_id)
+        await pipe.execute()
+
+    await _enqueue_mailing_driver(arq_pool, mailing_id)
+    queue_logger.info(f'Рассылка {mailing_id} запущена')
+    return mailing_id
+
+async def _enqueue_mailing_driver(arq_pool: ArqRedis,
+                                  mailing_id: str) -> bool:
+    queued = await arq_pool.enqueue_job('run_mailing_campaign',
+                                        mailing_id,
+                                        _job_id=f'mailing_run:{mailing_id}')
+    return queued is not None
+
+async def resume_mailing_campaigns(arq_pool: ArqRedis) -> None:
+    """
+    После перезапуска ставит обход незавершённых кампаний в очередь; если
+    задача обхода ещё в очереди arq, повторно она не ставится.
+    """
+    for member in await arq_pool.smembers(MAILINGS_ACTIVE_KEY):
+        mailing_id = member.decode()
+        if not await arq_pool.exists(mailing_key(mailing_id)):
+            await arq_pool.srem(MAILINGS_ACTIVE_KEY, mailing_id)
+            continue
+        if await _enqueue_mailing_driver(arq_pool, mailing_id):
+            queue_logger.info(f'Рассылка {mailing_id} возобновлена')
+
+async def _enqueue_mailing_sends(arq_pool: ArqRedis,
+                                 mailing_id: str,
+                                 user_ids: list[str]) -> int:
+    """
+    Ставит отправки в очередь через enqueue_job, по
+    MAILING_ENQUEUE_CONCURRENCY параллельных вызовов. ID задачи
+    <mailing_id>:<tg_id> детерминирован: задачу, которая уже в очереди
+    или выполняется, arq повторно не ставит.
+    :return: Количество поставленных задач.
+    """
+    queued = 0
+    for start in range(0, len(user_ids), MAILING_ENQUEUE_CONCURRENCY):
+        batch = user_ids[start:start + MAILING_ENQUEUE_CONCURRENCY]
+        jobs = await asyncio.gather(
+            *(arq_pool.enqueue_job('send_mailing_message',
+                                   _job_id=f'{mailing_id}:{user_id}',
+                                   mailing_id=mailing_id,
+                                   user_id=int(user_id))
+              for user_id in batch))
+        queued += sum(job is not None for job in jobs)
+    return queued
+
+async def _requeue_lost_sends(arq_pool: ArqRedis, mailing_id: str) -> int:
+    """
+    Возвращает в очередь получателей кампании, которые поставлены в
+    очередь, но не учтены и чьей задачи нет ни в очереди, ни в работе
+    (например, задача истекла, пока воркеры были остановлены). Оставшиеся
+    от такой задачи ключ и результат удаляются, иначе enqueue_job её не
+    поставит.
+    :return: Количество возвращённых в очередь получателей.
+    """
+    key = mailing_key(mailing_id)
+    requeued = 0
+    async for chunk in _sscan_chunks(arq_pool, f'{key}:queued'):
+        async with arq_pool.pipeline(transaction=False) as pipe:
+            for user_id in chunk:
+                job_id = f'{mailing_id}:{user_id}'
+                pipe.hexists(f'{key}:recipients', user_id)
+                pipe.zscore(arq_pool.default_queue_name, job_id)
+                pipe.exists(in_progress_key_prefix + job_id)
+            results = await pipe.execute()
+        lost = [user_id for user_id, handled, queued, in_progress
+                in zip(chunk, results[::3], results[1::3], results[2::3],
+                       strict=True)
+                if not handled and queued is None and not in_progress]
+        if lost:
+            await arq_pool.delete(
+                *(f'{prefix}{mailing_id}:{user_id}'
+                  for user_id in lost
+                  for prefix in (job_key_prefix, result_key_prefix)))
+            requeued += await _enqueue_mailing_sends(arq_pool,
+                                                     mailing_id,
+                                                     lost)
+    return requeued
+
+async def _sscan_chunks(redis_client: Redis,
+                        name: str) -> AsyncIterator[list[str]]:
+    cursor = 0
+    while True:
+        cursor, members = await redis_client.sscan(
+            name, cursor=cursor, count=MAILING_SCAN_CHUNK)
+        if members:
+            yield [member.decode() for member in members]
+        if cursor == 0:
+            break
+
+async def run_mailing_campaign(ctx: dict, mailing_id: str) -> None:
+    """
+    Задача arq: обходит пользователей DB 2 через SCAN пачками, ставит
+    отправки пачки в очередь и после каждой пачки
+    сохраняет курсор. После перезапуска обход продолжается с сохранённого
+    курсора; получатель, уже поставленный в очередь, повторно не
+    учитывается. Если обход был закончен, в очередь возвращаются только
+    потерянные отправки.
+    """
+    arq_pool: ArqRedis = ctx['redis']
+    redis_data: Redis = ctx['redis_data']
+    key = mailing_key(mailing_id)
+    checkpoint = arq_pool.register_script(MAILING_CHECKPOINT_LUA)
+
+    status, cursor, scan_finished = await arq_pool.hmget(
+        key, 'status', 'cursor', 'scan_finished')
+    if status != b'running':
+        return
+    if scan_finished:
+        requeued = await _requeue_lost_sends(arq_pool, mailing_id)
+        queue_logger.info(f'Рассылка {mailing_id}: возвращено в очередь '
+                          f'{requeued} отправок')
+        return
+
+    cursor = int(cursor)
+    queue_logger.info(f'Рассылка {mailing_id}: обход с курсора {cursor}')
+    while True:
+        cursor, keys = await redis_data.scan(cursor=cursor,
+                                             count=MAILING_SCAN_CHUNK)
+        user_ids = [user_key for user_key in keys if user_key.isdigit()]
+        if user_ids:
+            await _enqueue_mailing_sends(arq_pool, mailing_id, user_ids)
+
+        completed = await checkpoint(
+            keys=[key, f'{key}:queued'],
+            args=[cursor, MAILING_TTL, *user_ids])
+        if completed:
+            await _finish_mailing_campaign(arq_pool, mailing_id)
+        if cursor == 0:
+            break
+
+async def send_mailing_message(ctx: dict,
+                               mailing_id: str,
+                               user_id: int) -> str | None:
+    """
+    Задача рассылки: отправляет текст кампании одному получателю и
+    записывает итог в кампанию. Получатель, уже учтённый в кампании
+    (повтор после перезапуска), пропускается.
+    :return: Итог отправки или None, если отправка пропущена.
+    """
+    arq_pool: ArqRedis = ctx['redis']
+    key = mailing_key(mailing_id)
+    recipients_key = f'{key}:recipients'
+    async with arq_pool.pipeline(transaction=False) as pipe:
+        pipe.hget(key, 'message')
+        pipe.hexists(recipients_key, user_id)
+        message, handled = await pipe.execute()
+    if message is None or handled:
+        return None
+
+    result = await _send_message(ctx, user_id, message.decode())
+
+    record = arq_pool.register_script(MAILING_RECORD_LUA)
+    completed = await record(keys=[key, recipients_key],
+                             args=[user_id, result, MAILING_TTL])
+    if completed == 1:
+        await _finish_mailing_campaign(arq_pool, mailing_id)
+    return result
+
+async def _finish_mailing_campaign(arq_pool: ArqRedis,
+                                   mailing_id: str) -> None:
+    key = mailing_key(mailing_id)
+    async with arq_pool.pipeline(transaction=True) as pipe:
+        pipe.hset(key, 'status', 'completed')
+        pipe.srem(MAILINGS_ACTIVE_KEY, mailing_id)
+        pipe.hmget(key, 'admins', 'end_cert', 'sent', 'blocked', 'failed')
+        results = await pipe.execute()
+    admin_ids, end_cert, sent, blocked, failed = results[-1]
+    queue_logger.info(f'Рассылка {mailing_id} завершена: sent={sent}, '
+                      f'blocked={blocked}, failed={failed}')
+    await arq_pool.enqueue_job(
+        'on_mailing_completed',
+        _job_id=f'mailing_done:{mailing_id}',
+        end_cert=end_cert.decode(),
+        admins=set(map(int, admin_ids.split())),
+        counter_users=int(sent),
+        fail=int(failed),
+        blocked=int(blocked))
 
 async def on_mailing_completed(ctx: dict, end_cert: str, admins: set[int],
-                               counter_users: int, fail: int):
+                               counter_users: int, fail: int,
+                               blocked: int = 0):
     """
     Callback-функция для уведомления администратора после завершения рассылки.
     """
@@ -117,6 +405,7 @@ async def on_mailing_completed(ctx: dict, end_cert: str, admins: set[int],
         await bot.send_message(chat_id=admin,
                 text=f"Произведена рассылка✅\n"
                      f"Удачных доставок: {counter_users}\n"
+                     f"Бот заблокирован: {blocked}\n"
                      f"Не удачных доставок: {fail}\n\n"
                 f"{LexiconRu.text_adm_panel.format(end_cert=end_cert)}",
                 reply_markup=kb_admin)
@@ -124,11 +413,52 @@ async def on_mailing_completed(ctx: dict, end_cert: str, admins: set[int],
 
     queue_logger.debug("Exit")
 
-async def run_arq_worker(redis_que: RedisSettings, bot: Bot):
-    async def startup(ctx):
+async def run_arq_worker(redis_que: RedisSettings, bot: Bot, **context):
+    """
+    :param context: Общие объекты для задач (config, stepik_service,
+     redis_data, storage), передаются в ctx.
+    """
+    async def startup(ctx: dict) -> None:
         ctx['bot'] = bot  # Передаем бота в контекст
+        ctx.update(context)
+
+    async def mailing_startup(ctx: dict) -> None:
+        await startup(ctx)
+        # Ведро в Redis очереди: лимит общий для всех воркеров
+        ctx['send_limiter'] = RedisTokenBucket(ctx['redis'],
+                                               name='telegram_send',
+                                               rate=TG_SEND_RATE,
+                                               capacity=TG_SEND_BURST,
+                                               min_rate=TG_SEND_MIN_RATE)
+        await resume_mailing_campaigns(ctx['redis'])
+
+    async def shutdown(ctx: dict) -> None:
+        queue_logger.info(f'Лимит отправки Telegram: '
+                          f'{await ctx["send_limiter"].stats()}')
 
-    worker = Worker(functions=[safe_send_message,   on_mailing_completed],
-                    redis_settings=redis_que, on_startup=startup, max_jobs=5,
-                    handle_signals=False, health_check_interval=15)
-    await worker.async_run()
+    mailing_worker = Worker(functions=[func(safe_send_message,
+                                            max_tries=SEND_JOB_MAX_TRIES),
+                                       func(send_mailing_message,
+                                            max_tries=SEND_JOB_MAX_TRIES),
+                                       func(run_mailing_campaign,
+                                            keep_result=0,
+                                            timeout=MAILING_DRIVER_TIMEOUT),
+                                       on_mailing_completed],
+                            redis_settings=redis_que,
+                            on_startup=mailing_startup,
+                            on_shutdown=shutdown, max_jobs=5,
+                            handle_signals=False, health_check_interval=15)
+    # Выдача сертификатов — в своей очереди и со своими слотами, чтобы
+    # не стоять за тысячами задач рассылки. Результат не хранится: после
+    # завершения задачи её ключ идемпотентности освобождается
+    issuance_worker = Worker(functions=[func(issue_certificate,
+                                             keep_result=0),
+                                        func(run_issued_hook,
+                                             keep_result=0)],
+                             queue_name=ISSUE_QUEUE_NAME,
+                             redis_settings=redis_que,
+                             on_startup=startup,
+                             max_jobs=ISSUE_MAX_JOBS,
+                             handle_signals=False, health_check_interval=15)
+    await asyncio.gather(mailing_worker.async_run(),
+                         issuance_worker.async_run())
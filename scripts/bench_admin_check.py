@@ -0,0 +1,108 @@
+"""
+Сравнение проверки администратора до и после TgBot.admins:
+  - ThrottlingMiddleware: раньше на каждый апдейт id_admins.split() и
+    сравнение строк, теперь config.is_admin (frozenset);
+  - фильтр IsAdmins: раньше поиск подстроки в строке ID_ADMIN, теперь
+    IsAdmins.__call__ с config.is_admin.
+Старые варианты воспроизведены по коду до изменения, новые вызываются
+из репозитория с заглушками апдейта и конфига.
+
+Запуск из корня репозитория:
+    python -m scripts.bench_admin_check
+"""
+import asyncio
+import dataclasses
+import datetime
+import logging
+import time
+
+from collections.abc import Awaitable, Callable
+
+from aiogram.types import Chat, Message, User
+
+from config_data.config import Config, TgBot
+from filters.filters import IsAdmins
+
+logger_bench = logging.getLogger('filters.filters')
+
+ID_ADMIN = '111111111 222222222 333333333 444444444 555555555'
+NUMBER = 200_000
+
+
+def old_middleware_is_admin(event: Message, config: Config) -> bool:
+    admins_id = config.tg_bot.id_admins.split()
+    logger_bench.debug(f'{admins_id=}')
+    return str(event.from_user.id) in admins_id
+
+
+def new_middleware_is_admin(event: Message, config: Config) -> bool:
+    return config.is_admin(event.from_user.id)
+
+
+async def old_is_admins(msg: Message, config: Config) -> bool:
+    logger_bench.debug('Entry')
+
+    user_id = str(msg.from_user.id)
+    admins_id = config.tg_bot.id_admins
+    logger_bench.debug(f'{admins_id=}')
+
+    logger_bench.debug('Exit')
+    return user_id in admins_id
+
+
+def stub_config() -> Config:
+    fields = {field.name: None for field in dataclasses.fields(Config)}
+    fields['tg_bot'] = TgBot(token='', id_admins=ID_ADMIN)
+    return Config(**fields)
+
+
+def stub_message(user_id: int) -> Message:
+    return Message.model_construct(
+        message_id=1,
+        date=datetime.datetime.now(),
+        chat=Chat.model_construct(id=user_id, type='private'),
+        from_user=User(id=user_id, is_bot=False, first_name='Bench'))
+
+
+def bench(check: Callable[[Message, Config], bool],
+          msg: Message, config: Config) -> float:
+    start = time.perf_counter()
+    for _ in range(NUMBER):
+        check(msg, config)
+    return (time.perf_counter() - start) / NUMBER * 1e9
+
+
+async def bench_filter(check: Callable[[Message, Config], Awaitable[bool]],
+                       msg: Message, config: Config) -> float:
+    start = time.perf_counter()
+    for _ in range(NUMBER):
+        await check(msg, config)
+    return (time.perf_counter() - start) / NUMBER * 1e9
+
+
+async def main() -> None:
+    config = stub_config()
+    is_admins = IsAdmins()
+    cases = {'последний администратор': 555555555,
+             'не администратор': 987654321}
+
+    for title, user_id in cases.items():
+        msg = stub_message(user_id)
+        old = bench(old_middleware_is_admin, msg, config)
+        new = bench(new_middleware_is_admin, msg, config)
+        print(f'middleware, {title}: split {old:.0f} нс, '
+              f'is_admin {new:.0f} нс')
+        old = await bench_filter(old_is_admins, msg, config)
+        new = await bench_filter(is_admins, msg, config)
+        print(f'IsAdmins, {title}: подстрока {old:.0f} нс, '
+              f'is_admin {new:.0f} нс')
+
+    # Подстрока ID администратора проходила старый фильтр
+    msg = stub_message(11111)
+    print(f'TG_ID:11111 администратор? старый фильтр: '
+          f'{await old_is_admins(msg, config)}, '
+          f'IsAdmins: {await is_admins(msg, config)}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1 +1,6 @@
+from .certificates import *
+from .deletion import *
+from .rate_limit import *
+from .render_pool import *
+from .usernames import *
 from .utils import *
@@ -0,0 +1,368 @@
+import io
+import logging
+import os
+import threading
+
+from dataclasses import dataclass, field
+
+from aiogram.types import BufferedInputFile, FSInputFile
+from PyPDF2 import PageObject, PdfReader, PdfWriter
+from reportlab.lib.colors import Color
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+from config_data.config import CertificateLayout, Course
+
+logger_certs = logging.getLogger(__name__)
+
+FONT_NAME = 'BitterReg'
+FONT_FILE = 'Bitter-Regular.ttf'
+
+
+def get_certificate_data_dir() -> str:
+    """
+    Возвращает каталог с шаблонами сертификатов и шрифтом.
+    :return: Значение CERTIFICATE_DATA_DIR или локальная папка static.
+    """
+    local_path = os.path.abspath(
+        os.path.join(os.path.dirname(__file__), '..', 'static'))
+    return os.getenv('CERTIFICATE_DATA_DIR', local_path)
+
+
+@dataclass(frozen=True)
+class RenderRequest:
+    """
+    Заказ на генерацию сертификата (передаётся в процесс рендеринга).
+    """
+    course: Course
+    template_name: str
+    user_name: str
+    number: str
+    w_text: bool = False
+    to_disk: bool = False
+
+
+@dataclass
+class RenderedCertificate:
+    """
+    Результат генерации сертификата.
+    По умолчанию PDF хранится в памяти (data); в отладочном режиме
+    CERT_RENDER_TO_DISK он пишется в файл на диске (path).
+    cache_stats — счётчики кэша шаблонов процесса, выполнившего генерацию
+    (worker_pid): кэш живёт в процессах пула, и родитель узнаёт о нём
+    только из результатов.
+    """
+    filename: str
+    data: bytes | None = None
+    path: str | None = None
+    worker_pid: int | None = None
+    cache_stats: dict[str, int] = field(default_factory=dict)
+
+    @classmethod
+    def from_writer(cls,
+                    writer: PdfWriter,
+                    filename: str,
+                    base_dir: str,
+                    to_disk: bool = False) -> 'RenderedCertificate':
+        """
+        Сериализует PdfWriter в память или, если to_disk, в файл.
+        :param writer: Готовый документ.
+        :param filename: Имя файла для Telegram.
+        :param base_dir: Каталог для файла в режиме to_disk.
+        :param to_disk: Флаг записи файла на диск.
+        :return: RenderedCertificate.
+        """
+        if to_disk:
+            path = os.path.join(base_dir, filename)
+            with open(path, 'wb') as fh:
+                writer.write(fh)
+            return cls(filename=filename, path=path)
+
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        return cls(filename=filename, data=buffer.getvalue())
+
+    def as_input_file(self) -> BufferedInputFile | FSInputFile:
+        """
+        :return: Объект для отправки через Bot API.
+        """
+        if self.data is not None:
+            return BufferedInputFile(self.data, filename=self.filename)
+        return FSInputFile(self.path, filename=self.filename)
+
+    def cleanup(self) -> None:
+        """
+        Удаляет файл с диска, если сертификат был записан в файл.
+        """
+        if not self.path:
+            return
+        try:
+            os.remove(self.path)
+            logger_certs.debug(f'Файл {self.path} удалён.')
+        except Exception as err:
+            logger_certs.error(
+                f'Ошибка при удалении файла {self.path}: '
+                f'{err.__class__.__name__}', exc_info=True)
+
+
+@dataclass
+class CachedTemplate:
+    """
+    Распарсенный PDF-шаблон.
+    PdfReader читает объекты лениво из общего потока, поэтому копирование
+    страниц из него выполняется под lock.
+    """
+    reader: PdfReader
+    mtime: float
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    renderers: dict[CertificateLayout, 'CertificateRenderer'] = field(
+        default_factory=dict)
+
+
+class CertificateRenderer:
+    """
+    Движок генерации сертификата по распарсенному шаблону.
+    Всё, что не зависит от ФИО и номера (таблица размеров шрифта, цвета),
+    вычисляется один раз на шаблон. На вызов render строится один оверлей,
+    который накладывается на все страницы шаблона.
+    """
+
+    def __init__(self,
+                 template: CachedTemplate,
+                 layout: CertificateLayout,
+                 font_name: str = FONT_NAME) -> None:
+        self._template = template
+        self._layout = layout
+        self._font_name = font_name
+        self._font_sizes = self._build_font_sizes(layout.name_font_ladder)
+        self._font_fallback = layout.name_font_fallback
+        self._number_color = Color(*(c / 255 for c in layout.number_color))
+        self._watermark_color = Color(0.3, 0, 0, alpha=0.7)
+
+    @staticmethod
+    def _build_font_sizes(ladder: tuple[tuple[int, int], ...]) -> list[int]:
+        """
+        Разворачивает лесенку размеров в таблицу: индекс — длина ФИО.
+        """
+        font_sizes: list[int] = []
+        for max_length, font_size in ladder:
+            font_sizes.extend([font_size] * (max_length + 1 - len(font_sizes)))
+        return font_sizes
+
+    def font_size_for(self, name: str) -> int:
+        """
+        :param name: ФИО.
+        :return: Размер шрифта для ФИО данной длины.
+        """
+        if len(name) < len(self._font_sizes):
+            return self._font_sizes[len(name)]
+        return self._font_fallback
+
+    def _build_overlay(self,
+                       name: str,
+                       number: str,
+                       watermark: bool) -> PageObject:
+        layout = self._layout
+        packet = io.BytesIO()
+        can = canvas.Canvas(packet, pagesize=layout.page_size)
+
+        font_size = self.font_size_for(name)
+        text_width = pdfmetrics.stringWidth(name, self._font_name, font_size)
+        can.setFont(self._font_name, font_size)
+        can.drawString(layout.name_center_x - text_width / 2,
+                       layout.name_y,
+                       name)
+
+        can.setFont(self._font_name, layout.number_font_size)
+        can.setFillColor(self._number_color)
+        can.drawString(layout.number_x, layout.number_y, number)
+
+        if watermark:
+            can.setFillColor(self._watermark_color)
+            can.setFont('Helvetica', layout.watermark_font_size)
+            can.rotate(layout.watermark_angle)
+            can.drawString(layout.watermark_x,
+                           layout.watermark_y,
+                           layout.watermark_text)
+
+        can.showPage()
+        can.save()
+        packet.seek(0)
+        return PdfReader(packet).pages[0]
+
+    def render(self,
+               name: str,
+               number: str,
+               watermark: bool = False) -> PdfWriter:
+        """
+        Накладывает ФИО и номер на все страницы шаблона.
+        :param name: ФИО получателя.
+        :param number: Номер сертификата.
+        :param watermark: Флаг для добавления водяного знака.
+        :return: Готовый документ.
+        """
+        overlay = self._build_overlay(name, number, watermark)
+        writer = PdfWriter()
+        # Страницы клонируются в writer, кэшированный шаблон не меняется
+        with self._template.lock:
+            for page in self._template.reader.pages:
+                writer.add_page(page)
+
+        for page in writer.pages:
+            page.merge_page(overlay)
+        return writer
+
+
+@dataclass
+class TemplateCache:
+    """
+    Процессный кэш распарсенных PDF-шаблонов и зарегистрированного шрифта.
+    Ключ шаблона — (base_dir, template_name, mtime файла): если шаблон на
+    томе CERTIFICATE_DATA_DIR заменён, он будет перечитан при следующем
+    обращении, а устаревшая запись удалена.
+    """
+    hits: int = 0
+    misses: int = 0
+    _templates: dict[tuple[str, str, float], CachedTemplate] = field(
+        default_factory=dict)
+    _font_key: tuple[str, float] | None = None
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get_template(self,
+                     base_dir: str,
+                     template_name: str) -> CachedTemplate:
+        """
+        Возвращает распарсенный шаблон, читая файл только при промахе.
+        :param base_dir: Каталог с шаблонами.
+        :param template_name: Имя файла шаблона.
+        :return: CachedTemplate.
+        :raises: FileNotFoundError, если шаблона нет на диске.
+        """
+        path = os.path.join(base_dir, template_name)
+        mtime = os.path.getmtime(path)
+        key = (base_dir, template_name, mtime)
+
+        with self._lock:
+            cached = self._templates.get(key)
+            if cached:
+                self.hits += 1
+                return cached
+
+            self.misses += 1
+            for stale_key in [k for k in self._templates if k[:2] == key[:2]]:
+                del self._templates[stale_key]
+                logger_certs.info(
+                    f'Шаблон {template_name} изменён, перечитываем')
+
+            reader = PdfReader(path)
+            # Разбираем дерево страниц сразу, а не при первой генерации
+            _ = len(reader.pages)
+            cached = CachedTemplate(reader=reader, mtime=mtime)
+            self._templates[key] = cached
+            logger_certs.debug(f'Шаблон {template_name} загружен в кэш')
+            return cached
+
+    def register_font(self, base_dir: str) -> str:
+        """
+        Регистрирует шрифт Bitter в ReportLab один раз на процесс
+        (повторно — только если файл шрифта изменился).
+        :param base_dir: Каталог со шрифтом.
+        :return: Имя зарегистрированного шрифта.
+        :raises: FileNotFoundError, если файла шрифта нет.
+        """
+        font_path = os.path.join(base_dir, FONT_FILE)
+        if not os.path.exists(font_path):
+            raise FileNotFoundError(f'Файл шрифта не найден: {font_path}')
+
+        font_key = (font_path, os.path.getmtime(font_path))
+        with self._lock:
+            if self._font_key != font_key:
+                pdfmetrics.registerFont(TTFont(FONT_NAME, font_path))
+                self._font_key = font_key
+                logger_certs.debug(f'Шрифт {FONT_NAME} зарегистрирован')
+        return FONT_NAME
+
+    def get_renderer(self,
+                     base_dir: str,
+                     template_name: str,
+                     layout: CertificateLayout) -> CertificateRenderer:
+        """
+        Возвращает движок для шаблона и разметки; движок создаётся один раз
+        на версию шаблона и сбрасывается вместе с ним.
+        :param base_dir: Каталог с шаблонами.
+        :param template_name: Имя файла шаблона.
+        :param layout: Разметка шаблона из config.yaml.
+        :return: CertificateRenderer.
+        """
+        font_name = self.register_font(base_dir)
+        template = self.get_template(base_dir, template_name)
+        renderer = template.renderers.get(layout)
+        if renderer is None:
+            renderer = CertificateRenderer(template, layout, font_name)
+            template.renderers[layout] = renderer
+        return renderer
+
+    def preload(self,
+                courses: dict[int, Course],
+                base_dir: str | None = None) -> None:
+        """
+        Прогревает кэш шаблонами всех курсов из config.yaml и шрифтом.
+        Ошибки отдельных шаблонов логируются и не прерывают запуск бота.
+        :param courses: Курсы из конфигурации.
+        :param base_dir: Каталог с шаблонами, по умолчанию
+         CERTIFICATE_DATA_DIR.
+        """
+        base_dir = base_dir or get_certificate_data_dir()
+        try:
+            self.register_font(base_dir)
+        except Exception as err:
+            logger_certs.error(f'Не удалось зарегистрировать шрифт: {err}')
+
+        for course_id, course in courses.items():
+            for template_name in set(course.templates.values()):
+                try:
+                    self.get_renderer(base_dir, template_name, course.layout)
+                except Exception as err:
+                    logger_certs.warning(
+                        f'Шаблон {template_name} курса {course_id} не '
+                        f'загружен в кэш: {err}')
+        logger_certs.info(f'Кэш шаблонов прогрет: {self.stats()}')
+
+    def stats(self) -> dict[str, int]:
+        """
+        Счётчики кэша.
+        :return: hits, misses и количество шаблонов в кэше.
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'templates': len(self._templates)}
+
+
+template_cache = TemplateCache()
+
+
+def render_certificate(request: RenderRequest) -> RenderedCertificate:
+    """
+    Синхронная генерация PDF для новых сертификатов и копий. Выполняется
+    в пуле процессов рендеринга или, если он не запущен, в отдельном потоке.
+    :param request: Курс, шаблон, ФИО, номер и флаги генерации.
+    :return: Сгенерированный сертификат со счётчиками кэша шаблонов.
+    """
+    base_dir = get_certificate_data_dir()
+    renderer = template_cache.get_renderer(base_dir,
+                                           request.template_name,
+                                           request.course.layout)
+    writer = renderer.render(request.user_name,
+                             request.number,
+                             watermark=request.w_text)
+
+    course_name = request.course.name.replace(' ', '_')
+    certificate = RenderedCertificate.from_writer(
+        writer,
+        f'{course_name}_{request.number}.pdf',
+        base_dir,
+        to_disk=request.to_disk)
+    certificate.worker_pid = os.getpid()
+    certificate.cache_stats = template_cache.stats()
+    return certificate
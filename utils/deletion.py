@@ -0,0 +1,177 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+
+from collections import defaultdict
+
+from aiogram import Bot
+from aiogram.types import Message
+
+logger_deletion = logging.getLogger(__name__)
+
+# Bot API deleteMessages принимает до 100 сообщений за вызов
+DELETE_MESSAGES_LIMIT = 100
+# Сообщения со сроком в пределах окна удаляются одной пачкой
+DELETE_COALESCE_WINDOW = 0.25
+
+
+async def delete_messages_batched(bot: Bot,
+                                  chat_id: int,
+                                  message_ids: list[int]) -> int:
+    """
+    Удаляет сообщения чата пачками через delete_messages (до
+    DELETE_MESSAGES_LIMIT за вызов). Если пачка не удалилась, её
+    сообщения удаляются по одному, чтобы одно неудаляемое сообщение не
+    оставляло в чате остальные.
+    :param bot: Экземпляр бота.
+    :param chat_id: ID чата.
+    :param message_ids: ID сообщений.
+    :return: Количество удалённых сообщений.
+    """
+    deleted = 0
+    for start in range(0, len(message_ids), DELETE_MESSAGES_LIMIT):
+        batch = message_ids[start:start + DELETE_MESSAGES_LIMIT]
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=batch)
+        except Exception as e:
+            logger_deletion.debug(f'Пачка {batch} в чате {chat_id} не '
+                                  f'удалена, удаляем по одному: {e}')
+        else:
+            deleted += len(batch)
+            continue
+        for message_id in batch:
+            try:
+                await bot.delete_message(chat_id=chat_id,
+                                         message_id=message_id)
+            except Exception as e:
+                logger_deletion.warning(f'Failed to delete message '
+                                        f'ID:{message_id}:{e}')
+            else:
+                deleted += 1
+    return deleted
+
+
+class DeletionScheduler:
+    """
+    Отложенное удаление сообщений одним таймером на процесс.
+    schedule() не ждёт: сообщение попадает в кучу по сроку удаления, а
+    фоновая задача в срок удаляет накопившиеся сообщения пачками по чатам
+    (delete_messages). Обратный отсчёт (indication) — одна правка текста
+    со сроком удаления вместо правки каждую секунду.
+    """
+
+    def __init__(self) -> None:
+        # (срок по time.monotonic, порядковый номер, bot, chat_id, msg_id)
+        self._heap: list[tuple[float, int, Bot, int, int]] = []
+        self._counter = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        # (chat_id, msg_id) -> правка текста со сроком удаления, ещё
+        # не завершённая
+        self._announcements: dict[tuple[int, int], asyncio.Task] = {}
+        self.stats = {'scheduled': 0, 'deleted': 0, 'failed': 0}
+
+    @property
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def schedule(self,
+                 message: Message,
+                 delay: float = 1,
+                 indication: bool = False) -> None:
+        """
+        Ставит сообщение на удаление через delay секунд.
+        :param message: Сообщение бота или пользователя.
+        :param delay: Задержка в секундах.
+        :param indication: Дописать к сообщению срок удаления.
+        """
+        if not isinstance(message, Message):
+            logger_deletion.debug(f'Не сообщение, удаление пропущено: '
+                                  f'{type(message).__name__}')
+            return
+        self._ensure_started()
+        heapq.heappush(self._heap, (time.monotonic() + delay,
+                                    next(self._counter),
+                                    message.bot,
+                                    message.chat.id,
+                                    message.message_id))
+        self.stats['scheduled'] += 1
+        if indication:
+            key = (message.chat.id, message.message_id)
+            task = asyncio.create_task(self._announce(message, delay))
+            self._announcements[key] = task
+            task.add_done_callback(
+                lambda done: self._forget_announcement(key, done))
+        self._wakeup.set()
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    @staticmethod
+    async def _announce(message: Message, delay: float) -> None:
+        try:
+            await message.edit_text(
+                f'{message.text}\n\nУдалится через {delay:g} сек.')
+        except Exception as e:
+            logger_deletion.warning(f'Не удалось отредактировать '
+                                    f'сообщение: {e}')
+
+    def _forget_announcement(self,
+                             key: tuple[int, int],
+                             task: asyncio.Task) -> None:
+        if self._announcements.get(key) is task:
+            del self._announcements[key]
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            timeout = self._heap[0][0] - time.monotonic()
+            if timeout > 0:
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                continue
+            await self._delete_due(time.monotonic() + DELETE_COALESCE_WINDOW)
+
+    def _pop_due(self, now: float) -> dict[tuple[Bot, int], list[int]]:
+        due: dict[tuple[Bot, int], list[int]] = defaultdict(list)
+        while self._heap and self._heap[0][0] <= now:
+            _, _, bot, chat_id, message_id = heapq.heappop(self._heap)
+            due[(bot, chat_id)].append(message_id)
+        return due
+
+    async def _delete_due(self, now: float) -> None:
+        due = self._pop_due(now)
+        # Правка сообщения не должна прийти после его удаления; ждём только
+        # правки удаляемых сообщений
+        announcements = [
+            self._announcements[(chat_id, message_id)]
+            for (_, chat_id), message_ids in due.items()
+            for message_id in message_ids
+            if (chat_id, message_id) in self._announcements]
+        if announcements:
+            await asyncio.gather(*announcements, return_exceptions=True)
+        for (bot, chat_id), message_ids in due.items():
+            deleted = await delete_messages_batched(bot, chat_id, message_ids)
+            self.stats['deleted'] += deleted
+            self.stats['failed'] += len(message_ids) - deleted
+
+    async def shutdown(self) -> None:
+        """
+        Останавливает таймер и сразу удаляет все ожидающие сообщения.
+        """
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self._delete_due(float('inf'))
+        logger_deletion.info(f'Отложенное удаление: {self.stats}')
+
+
+deletion_scheduler = DeletionScheduler()
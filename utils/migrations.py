@@ -0,0 +1,186 @@
+import asyncio
+import logging
+
+from redis.asyncio import Redis
+
+from config_data.config import load_config
+from utils.utils import (
+    COURSE_HOLDERS_KEY_PREFIX,
+    STEPIK_OWNERS_KEY,
+    USERNAMES_SEEN_KEY,
+    course_holders_key,
+)
+
+logger_migrations = logging.getLogger(__name__)
+
+MIGRATION_KEY_PREFIX = 'migration:'
+SCAN_BATCH_SIZE = 500
+# Срок метки 'running': если экземпляр упал посреди миграции, метка
+# истечёт и миграция (все они идемпотентны) запустится заново
+MIGRATION_LOCK_TTL = 15 * 60
+
+
+async def build_stepik_owner_index(redis_data: Redis) -> dict[str, int]:
+    """
+    Строит индекс stepik_user_id -> tg_id по хэшам пользователей.
+    Идемпотентна: записи добавляются через HSETNX, существующие
+    не перезаписываются. Конфликты (один Stepik ID у нескольких TG_ID)
+    логируются, индекс закрепляет ID за первым найденным пользователем.
+    :param redis_data: Redis клиент DB 2 (decode_responses=True).
+    :return: Счётчики indexed, skipped, conflicts.
+    """
+    counters = {'indexed': 0, 'skipped': 0, 'conflicts': 0}
+    cursor = 0
+    while True:
+        cursor, keys = await redis_data.scan(cursor=cursor,
+                                             count=SCAN_BATCH_SIZE)
+        user_keys = [key for key in keys if key.isdigit()]
+        if user_keys:
+            async with redis_data.pipeline(transaction=False) as pipe:
+                for user_key in user_keys:
+                    pipe.hget(user_key, 'stepik_user_id')
+                stepik_ids = await pipe.execute()
+
+            bound = [(user_key, stepik_id)
+                     for user_key, stepik_id in zip(user_keys,
+                                                    stepik_ids,
+                                                    strict=True)
+                     if stepik_id]
+            counters['skipped'] += len(user_keys) - len(bound)
+
+            async with redis_data.pipeline(transaction=False) as pipe:
+                for user_key, stepik_id in bound:
+                    pipe.hsetnx(STEPIK_OWNERS_KEY, stepik_id, user_key)
+                    pipe.hget(STEPIK_OWNERS_KEY, stepik_id)
+                results = await pipe.execute()
+
+            owners = results[1::2]
+            for (user_key, stepik_id), owner in zip(bound, owners,
+                                                    strict=True):
+                if owner == user_key:
+                    counters['indexed'] += 1
+                else:
+                    counters['conflicts'] += 1
+                    logger_migrations.warning(
+                        f'STEPIK ID:{stepik_id} привязан к TG_ID:{user_key},'
+                        f' но в индексе закреплён за TG_ID:{owner}')
+        if cursor == 0:
+            break
+
+    logger_migrations.info(f'Индекс владельцев Stepik ID построен: '
+                           f'{counters}')
+    return counters
+
+
+async def build_course_holders_index(redis_data: Redis) -> dict[str, int]:
+    """
+    Заполняет course_holders:<course_id> по хэшам пользователей: поле
+    хэша из цифр — ID курса с выданным сертификатом. Идемпотентна (SADD).
+    :param redis_data: Redis клиент DB 2 (decode_responses=True).
+    :return: Счётчики users и certificates.
+    """
+    counters = {'users': 0, 'certificates': 0}
+    cursor = 0
+    while True:
+        cursor, keys = await redis_data.scan(cursor=cursor,
+                                             count=SCAN_BATCH_SIZE)
+        user_keys = [key for key in keys if key.isdigit()]
+        if user_keys:
+            async with redis_data.pipeline(transaction=False) as pipe:
+                for user_key in user_keys:
+                    pipe.hkeys(user_key)
+                fields = await pipe.execute()
+
+            async with redis_data.pipeline(transaction=False) as pipe:
+                for user_key, user_fields in zip(user_keys, fields,
+                                                 strict=True):
+                    course_ids = [field for field in user_fields
+                                  if field.isdigit()]
+                    for course_id in course_ids:
+                        pipe.sadd(course_holders_key(course_id), user_key)
+                    counters['users'] += bool(course_ids)
+                    counters['certificates'] += len(course_ids)
+                await pipe.execute()
+        if cursor == 0:
+            break
+
+    logger_migrations.info(f'Индекс получателей по курсам построен: '
+                           f'{counters}')
+    return counters
+
+
+async def seed_usernames_refresh(redis_data: Redis) -> dict[str, int]:
+    """
+    Ставит в очередь фонового обновления имён (usernames_seen с меткой 0)
+    получателей сертификатов, чьих имён ещё нет в кэше.
+    :param redis_data: Redis клиент DB 2 (decode_responses=True).
+    :return: Счётчик queued.
+    """
+    holders: set[str] = set()
+    async for key in redis_data.scan_iter(
+            match=f'{COURSE_HOLDERS_KEY_PREFIX}*', count=SCAN_BATCH_SIZE):
+        holders |= await redis_data.smembers(key)
+
+    queued = 0
+    holders = sorted(holders)
+    for start in range(0, len(holders), SCAN_BATCH_SIZE):
+        batch = holders[start:start + SCAN_BATCH_SIZE]
+        queued += await redis_data.zadd(
+            USERNAMES_SEEN_KEY, dict.fromkeys(batch, 0), nx=True)
+
+    logger_migrations.info(f'Имена получателей поставлены на обновление: '
+                           f'{queued}')
+    return {'queued': queued}
+
+
+MIGRATIONS = {
+    'stepik_owners': build_stepik_owner_index,
+    'course_holders': build_course_holders_index,
+    'usernames_seen': seed_usernames_refresh,
+}
+
+
+async def run_migrations(redis_data: Redis) -> None:
+    """
+    Выполняет ещё не применённые миграции данных DB 2.
+    Применённая миграция отмечается ключом migration:<name> = 'done'.
+    До запуска ключ ставится через SET NX со значением 'running' и сроком
+    MIGRATION_LOCK_TTL, поэтому при нескольких экземплярах бота миграция
+    выполняется один раз, а метка упавшего экземпляра не блокирует её
+    навсегда.
+    :param redis_data: Redis клиент DB 2.
+    """
+    for name, migration in MIGRATIONS.items():
+        marker = f'{MIGRATION_KEY_PREFIX}{name}'
+        if not await redis_data.set(marker, 'running', nx=True,
+                                    ex=MIGRATION_LOCK_TTL):
+            state = await redis_data.get(marker)
+            logger_migrations.debug(f'Миграция {name}: {state}')
+            continue
+
+        logger_migrations.info(f'Применяем миграцию {name}')
+        try:
+            await migration(redis_data)
+        except Exception:
+            await redis_data.delete(marker)
+            logger_migrations.exception(f'Ошибка миграции {name}')
+            raise
+        # SET без срока снимает TTL: 'done' хранится бессрочно
+        await redis_data.set(marker, 'done')
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    config = load_config()
+    redis_data = Redis(host=config.redis_host,
+                       port=6379,
+                       db=2,
+                       decode_responses=True)
+    try:
+        await run_migrations(redis_data)
+    finally:
+        await redis_data.aclose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import random
+
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+
+from redis.asyncio import Redis
+
+logger_rate_limit = logging.getLogger(__name__)
+
+# Доля исходной скорости, возвращаемая с каждым выданным токеном после
+# снижения (throttle)
+RATE_RECOVERY = 0.001
+
+# KEYS[1] - hash ведра (tokens, ts), KEYS[2] - момент окончания паузы (мс)
+# ARGV[1] - скорость пополнения (токенов/с), ARGV[2] - ёмкость ведра
+# Возвращает 0, если токен выдан, иначе сколько мс ждать до следующего.
+TOKEN_BUCKET_LUA = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local blocked_until = tonumber(redis.call('GET', KEYS[2]) or '0')
+if blocked_until > now then
+    return blocked_until - now
+end
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return wait
+"""
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Разбирает заголовок Retry-After: число секунд или HTTP-дата.
+    :return: Пауза в секундах или None, если заголовка нет.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(UTC)).total_seconds(), 0)
+
+
+class RedisTokenBucket:
+    """
+    Token bucket в Redis, общий для всех реплик бота.
+    Токен берётся Lua-скриптом за один запрос; время берётся из Redis, а не
+    с часов реплик. После ответа 429 ведро закрывается на Retry-After
+    для всех реплик (pause).
+    """
+
+    def __init__(self,
+                 redis_client: Redis,
+                 name: str,
+                 rate: float,
+                 capacity: int,
+                 min_rate: float | None = None) -> None:
+        """
+        :param rate: Скорость пополнения, токенов/с.
+        :param capacity: Ёмкость ведра (допустимый всплеск).
+        :param min_rate: Нижняя граница скорости для throttle; без неё
+                         скорость не снижается.
+        """
+        self.redis_client = redis_client
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate
+        self.capacity = capacity
+        self.bucket_key = f'rate_limit:{name}'
+        self.pause_key = f'rate_limit:{name}:pause'
+        self.acquired = 0
+        self.throttled = 0
+        self.paused = 0
+        self._script = redis_client.register_script(TOKEN_BUCKET_LUA)
+
+    async def acquire(self, max_wait: float | None = None) -> float:
+        """
+        Ждёт токен. Ожидание дополняется случайной задержкой, чтобы
+        ожидающие запросы не просыпались одновременно.
+        :param max_wait: Не ждать дольше: если до токена (или до конца
+                         паузы) больше max_wait секунд, токен не берётся.
+        :return: 0, если токен получен, иначе сколько секунд ждать.
+        """
+        while True:
+            wait_ms = await self._script(
+                keys=[self.bucket_key, self.pause_key],
+                args=[self.rate, self.capacity])
+            if not wait_ms:
+                self.acquired += 1
+                if self.rate < self.max_rate:
+                    self.rate = min(self.max_rate,
+                                    self.rate + self.max_rate * RATE_RECOVERY)
+                return 0
+            self.throttled += 1
+            wait = wait_ms / 1000
+            if max_wait is not None and wait > max_wait:
+                return wait
+            await asyncio.sleep(wait + random.uniform(0, wait / 2))
+
+    async def pause(self, seconds: float) -> None:
+        """
+        Останавливает выдачу токенов на всех репликах.
+        :param seconds: Длительность паузы (обычно из Retry-After).
+        """
+        self.paused += 1
+        pause_ms = int(seconds * 1000)
+        if pause_ms <= 0:
+            return
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.time()
+            pipe.pttl(self.pause_key)
+            now, current_ttl = await pipe.execute()
+        if current_ttl >= pause_ms:
+            return
+        now_ms = now[0] * 1000 + now[1] // 1000
+        await self.redis_client.set(self.pause_key,
+                                    now_ms + pause_ms,
+                                    px=pause_ms)
+        logger_rate_limit.warning(f'{self.bucket_key}: пауза {seconds:.1f}c')
+
+    async def throttle(self, seconds: float) -> None:
+        """
+        Реакция на превышение лимита (429, RetryAfter): пауза для всех
+        реплик и снижение скорости этой реплики вдвое, но не ниже
+        min_rate. Скорость восстанавливается с каждым выданным токеном.
+        :param seconds: Пауза из ответа сервиса.
+        """
+        self.rate = max(self.min_rate, self.rate / 2)
+        logger_rate_limit.warning(f'{self.bucket_key}: скорость снижена до '
+                                  f'{self.rate:.1f}/c')
+        await self.pause(seconds)
+
+    async def stats(self) -> dict[str, float | int]:
+        """
+        :return: Остаток бюджета (без учёта пополнения с последнего
+                 запроса), пауза в мс и счётчики этой реплики.
+        """
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hget(self.bucket_key, 'tokens')
+            pipe.pttl(self.pause_key)
+            tokens, pause_ttl = await pipe.execute()
+        return {'budget': (float(tokens) if tokens is not None
+                           else float(self.capacity)),
+                'pause_ms': max(pause_ttl, 0),
+                'rate': self.rate,
+                'acquired': self.acquired,
+                'throttled': self.throttled,
+                'paused': self.paused}
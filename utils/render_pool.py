@@ -0,0 +1,228 @@
+import asyncio
+import logging
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config_data.config import CertRender, Course
+from utils.certificates import (
+    RenderedCertificate,
+    RenderRequest,
+    render_certificate,
+    template_cache,
+)
+
+logger_render_pool = logging.getLogger(__name__)
+
+
+class RenderQueueFullError(RuntimeError):
+    """Очередь на генерацию сертификатов переполнена."""
+
+
+def _init_worker(courses: dict[int, Course]) -> None:
+    """
+    Инициализатор процесса: шрифт и шаблоны загружаются до первого заказа.
+    """
+    template_cache.preload(courses)
+
+
+def _ping() -> bool:
+    return True
+
+
+class RenderPool:
+    """
+    Пул процессов для генерации PDF.
+    PyPDF2 и ReportLab держат GIL, поэтому генерация в потоках при
+    наплыве запросов тормозит polling. Пул выносит её в отдельные процессы
+    с прогретым кэшем шаблонов, ограничивает очередь ожидания и время
+    генерации. Пока пул не запущен, генерация идёт в asyncio.to_thread.
+    """
+
+    def __init__(self) -> None:
+        self.workers = 0
+        self.queue_size = 0
+        self.timeout: float | None = None
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self._courses: dict[int, Course] = {}
+        self._executor: ProcessPoolExecutor | None = None
+        # Номер экземпляра executor: пересоздаёт пул только первый
+        # заказ, заставший его сломанным
+        self._generation = 0
+        self._slots: asyncio.Semaphore | None = None
+        self._waiting = 0
+        self._in_flight = 0
+        # pid процесса -> счётчики его кэша шаблонов из последнего заказа
+        self._cache_stats: dict[int, dict[str, int]] = {}
+
+    @property
+    def started(self) -> bool:
+        return self._executor is not None
+
+    @property
+    def queue_depth(self) -> int:
+        """Количество заказов, ожидающих свободный процесс."""
+        return self._waiting
+
+    async def start(self,
+                    settings: CertRender,
+                    courses: dict[int, Course]) -> None:
+        """
+        Запускает и прогревает процессы пула.
+        :param settings: Настройки из env (CERT_RENDER_*).
+        :param courses: Курсы из config.yaml для прогрева шаблонов.
+        """
+        if not settings.workers:
+            logger_render_pool.info(
+                'Пул рендеринга отключён, генерация в потоках')
+            return
+        if settings.queue_size < 1:
+            raise ValueError(f'CERT_RENDER_QUEUE_SIZE должен быть не меньше '
+                             f'1, получено {settings.queue_size}')
+
+        self.workers = settings.workers
+        self.queue_size = settings.queue_size
+        self.timeout = settings.timeout
+        self._slots = asyncio.Semaphore(self.workers)
+        self._courses = courses
+        self._executor = self._create_executor()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _ping)
+                               for _ in range(self.workers)))
+        logger_render_pool.info(
+            f'Пул рендеринга запущен: workers={self.workers}, '
+            f'queue_size={self.queue_size}, timeout={self.timeout}s')
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   initializer=_init_worker,
+                                   initargs=(self._courses,))
+
+    def _restart_executor(self, generation: int) -> None:
+        """
+        Заменяет сломанный пул (процесс упал, BrokenProcessPool) новым;
+        процессы прогреваются тем же _init_worker.
+        :param generation: Номер executor, на котором случилась ошибка.
+        """
+        if generation != self._generation or self._executor is None:
+            return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._create_executor()
+        self._generation += 1
+        self._cache_stats.clear()
+        self.restarts += 1
+        logger_render_pool.warning(f'Пул рендеринга пересоздан после сбоя '
+                                   f'процесса, перезапусков: {self.restarts}')
+
+    async def render(self, request: RenderRequest) -> RenderedCertificate:
+        """
+        Генерирует сертификат в пуле процессов. Если процесс пула упал,
+        пул пересоздаётся и заказ повторяется один раз.
+        :param request: Курс, шаблон, ФИО, номер и флаги генерации.
+        :return: Сгенерированный сертификат.
+        :raises: RenderQueueFullError, если очередь ожидания заполнена;
+                 TimeoutError, если генерация не уложилась в timeout.
+        """
+        if not self.started:
+            certificate = await asyncio.to_thread(render_certificate, request)
+            self._record_cache_stats(certificate)
+            return certificate
+
+        if self._waiting >= self.queue_size:
+            self.rejected += 1
+            raise RenderQueueFullError(
+                f'Очередь генерации заполнена: {self._waiting} заказов')
+
+        generation = self._generation
+        try:
+            certificate = await self._render_in_pool(request)
+        except BrokenProcessPool as err:
+            logger_render_pool.error(f'Процесс пула рендеринга упал при '
+                                     f'генерации {request.number}: {err}')
+            self._restart_executor(generation)
+            certificate = await self._render_in_pool(request)
+
+        self.completed += 1
+        self._record_cache_stats(certificate)
+        return certificate
+
+    async def _render_in_pool(self,
+                              request: RenderRequest) -> RenderedCertificate:
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+
+        self._in_flight += 1
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._executor.submit(render_certificate, request)
+        except Exception:
+            self._release_slot()
+            raise
+        # Слот занят, пока процесс не закончит генерацию: после таймаута
+        # процесс продолжает работу, и новый заказ не должен его ждать
+        future.add_done_callback(
+            lambda _: self._release_slot_threadsafe(loop))
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future),
+                                          timeout=self.timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            logger_render_pool.error(
+                f'Генерация сертификата {request.number} превысила '
+                f'{self.timeout}s')
+            raise
+
+    def _record_cache_stats(self, certificate: RenderedCertificate) -> None:
+        if certificate.worker_pid is not None:
+            self._cache_stats[certificate.worker_pid] = certificate.cache_stats
+
+    def template_cache_stats(self) -> dict[str, int]:
+        """
+        Счётчики кэша шаблонов, суммированные по процессам, которые уже
+        выполняли заказы.
+        :return: hits, misses, templates и количество процессов.
+        """
+        totals = {'hits': 0, 'misses': 0, 'templates': 0}
+        for stats in self._cache_stats.values():
+            for key in totals:
+                totals[key] += stats.get(key, 0)
+        return {**totals, 'processes': len(self._cache_stats)}
+
+    def _release_slot(self) -> None:
+        self._in_flight -= 1
+        self._slots.release()
+
+    def _release_slot_threadsafe(self,
+                                 loop: asyncio.AbstractEventLoop) -> None:
+        # Колбэк Future вызывается из служебного потока пула
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self._release_slot)
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: Размер очереди и счётчики пула.
+        """
+        return {'workers': self.workers,
+                'queue_depth': self._waiting,
+                'in_flight': self._in_flight,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'restarts': self.restarts}
+
+    def shutdown(self) -> None:
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            logger_render_pool.info(f'Пул рендеринга остановлен: '
+                                    f'{self.stats()}')
+
+
+render_pool = RenderPool()
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+
+from collections.abc import Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import User
+from redis.asyncio import Redis
+
+from utils.utils import (
+    USERNAMES_KEY,
+    USERNAMES_SEEN_KEY,
+    course_holders_key,
+    get_username,
+)
+
+logger_usernames = logging.getLogger(__name__)
+
+# Имя старше USERNAME_TTL обновляется фоном через get_chat
+USERNAME_TTL = 7 * 86400
+# Не чаще раза за интервал одна реплика пишет имя активного пользователя
+USERNAME_TOUCH_INTERVAL = 3600
+USERNAME_LOCAL_MAX = 10_000
+USERNAME_REFRESH_BATCH = 100
+USERNAME_REFRESH_INTERVAL = 3600
+USERNAME_REFRESH_DELAY = 0.1
+
+
+class UsernameCache:
+    """
+    Кэш отображаемых имён пользователей (usernames в DB 2) для отчётов и
+    рассылок. Имена обновляются попутно из входящих апдейтов (remember),
+    устаревшие — фоновой задачей пачками через Bot API (run_refresher).
+    Фоном обновляются только имена получателей сертификатов (они нужны
+    отчёту); устаревшие имена остальных пользователей удаляются.
+    """
+
+    def __init__(self,
+                 redis_client: Redis,
+                 course_ids: Iterable[int],
+                 ttl: int = USERNAME_TTL,
+                 touch_interval: int = USERNAME_TOUCH_INTERVAL) -> None:
+        self.redis_client = redis_client
+        self.course_ids = list(course_ids)
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        # tg_id -> (имя, время записи в Redis); гасит повторные записи
+        self._local: dict[int, tuple[str, float]] = {}
+        self._refresher_task: asyncio.Task | None = None
+        self.stats = {'writes': 0, 'skipped': 0, 'refreshed': 0,
+                      'refresh_errors': 0, 'evicted': 0}
+
+    async def remember(self, user: User) -> None:
+        """
+        Сохраняет имя пользователя из апдейта. В Redis пишется только новое
+        или изменившееся имя, либо не обновлявшееся дольше touch_interval.
+        :param user: Автор апдейта (event_from_user).
+        """
+        username = await get_username(user)
+        now = time.time()
+        cached = self._local.get(user.id)
+        if (cached and cached[0] == username
+                and now - cached[1] < self.touch_interval):
+            self.stats['skipped'] += 1
+            return
+
+        await self._store({str(user.id): username}, now)
+        if len(self._local) >= USERNAME_LOCAL_MAX:
+            self._local.clear()
+        self._local[user.id] = (username, now)
+        self.stats['writes'] += 1
+
+    async def _store(self, usernames: dict[str, str], now: float) -> None:
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(USERNAMES_KEY, mapping=usernames)
+            pipe.zadd(USERNAMES_SEEN_KEY,
+                      dict.fromkeys(usernames, now))
+            await pipe.execute()
+
+    async def _course_holders(self, user_ids: list[str]) -> set[str]:
+        """
+        :return: Те из user_ids, у кого есть сертификат хотя бы одного курса.
+        """
+        if not user_ids or not self.course_ids:
+            return set()
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for course_id in self.course_ids:
+                pipe.smismember(course_holders_key(course_id), user_ids)
+            memberships = await pipe.execute()
+        return {user_id
+                for user_id, *flags in zip(user_ids, *memberships,
+                                           strict=True)
+                if any(flags)}
+
+    async def _evict(self, user_ids: list[str]) -> None:
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hdel(USERNAMES_KEY, *user_ids)
+            pipe.zrem(USERNAMES_SEEN_KEY, *user_ids)
+            await pipe.execute()
+        for user_id in user_ids:
+            self._local.pop(int(user_id), None)
+        self.stats['evicted'] += len(user_ids)
+
+    async def refresh_stale(self,
+                            bot: Bot,
+                            batch_size: int = USERNAME_REFRESH_BATCH) -> int:
+        """
+        Обрабатывает пачку имён старше ttl: имена получателей сертификатов
+        обновляет через get_chat, остальные удаляет — при следующем апдейте
+        пользователя имя запишет remember. Если чат получателя недоступен
+        (бот заблокирован, аккаунт удалён), остаётся прежнее имя, а
+        следующая попытка будет через ttl.
+        :param bot: Экземпляр бота.
+        :param batch_size: Сколько имён обновить за вызов.
+        :return: Количество обработанных пользователей.
+        """
+        now = time.time()
+        stale = await self.redis_client.zrangebyscore(
+            USERNAMES_SEEN_KEY, '-inf', now - self.ttl,
+            start=0, num=batch_size)
+        holders = await self._course_holders(stale)
+        evicted = [user_id for user_id in stale if user_id not in holders]
+        if evicted:
+            await self._evict(evicted)
+
+        usernames: dict[str, str] = {}
+        checked: list[str] = []
+        for user_id in stale:
+            if user_id not in holders:
+                continue
+            try:
+                chat = await bot.get_chat(int(user_id))
+                usernames[user_id] = await get_username(chat)
+            except TelegramRetryAfter as err:
+                logger_usernames.warning(f'Обновление имён прервано, '
+                                         f'RetryAfter {err.retry_after}c')
+                break
+            except Exception as err:
+                self.stats['refresh_errors'] += 1
+                logger_usernames.debug(f'Имя TG_ID:{user_id} не обновлено: '
+                                       f'{err}')
+            checked.append(user_id)
+            await asyncio.sleep(USERNAME_REFRESH_DELAY)
+
+        if usernames:
+            await self._store(usernames, now)
+        missed = [user_id for user_id in checked if user_id not in usernames]
+        if missed:
+            await self.redis_client.zadd(
+                USERNAMES_SEEN_KEY, dict.fromkeys(missed, now))
+        self.stats['refreshed'] += len(usernames)
+        return len(checked) + len(evicted)
+
+    async def run_refresher(self, bot: Bot) -> None:
+        """
+        Фоновая задача: обновляет устаревшие имена пачками, пока они есть,
+        затем ждёт USERNAME_REFRESH_INTERVAL.
+        """
+        while True:
+            try:
+                while await self.refresh_stale(bot) == USERNAME_REFRESH_BATCH:
+                    pass
+            except Exception as err:
+                logger_usernames.error(f'Ошибка фонового обновления имён: '
+                                       f'{err}', exc_info=True)
+            await asyncio.sleep(USERNAME_REFRESH_INTERVAL)
+
+    def start_refresher(self, bot: Bot) -> None:
+        self._refresher_task = asyncio.create_task(self.run_refresher(bot))
+
+    async def close(self) -> None:
+        if self._refresher_task:
+            self._refresher_task.cancel()
+        logger_usernames.info(f'Кэш имён пользователей: {self.stats}')
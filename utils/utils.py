@@ -1,73 +1,206 @@
 import asyncio
-import io
 import logging
-import os
-import re
+import random
+import time
 
-from dataclasses import dataclass
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 
-from aiogram.client.session import aiohttp
+import aiohttp
+
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.types import (
     CallbackQuery,
     ChatFullInfo,
-    FSInputFile,
     LinkPreviewOptions,
     Message,
     Update,
+    User,
 )
-from PyPDF2 import PdfReader, PdfWriter
 from redis.asyncio import Redis
-from reportlab.lib.colors import Color
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfgen import canvas
+from redis.exceptions import LockError, RedisError
 
 from config_data.config import Config, Course
+from utils.certificates import RenderedCertificate, RenderRequest
+from utils.deletion import delete_messages_batched, deletion_scheduler
+from utils.rate_limit import RedisTokenBucket, parse_retry_after
+from utils.render_pool import render_pool
 
 logger_utils = logging.getLogger(__name__)
 
-# Создаем пул потоков для выполнения синхронных операций
-# executor = ThreadPoolExecutor(max_workers=4)
+CERT_CAPTION = ('Ваш сертификат готов! 🎉\n'
+                'Желаем удачи в дальнейшем обучении!🤓')
+
+STEPIK_CONNECTIONS_LIMIT = 20
+STEPIK_KEEPALIVE_TIMEOUT = 30
+STEPIK_DNS_CACHE_TTL = 300
+STEPIK_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10)
+
+STEPIK_TOKEN_KEY = 'stepik_token'
+STEPIK_TOKEN_LOCK_KEY = 'stepik_token_lock'
+# Токен обновляется фоном за 10 минут до истечения
+STEPIK_TOKEN_REFRESH_AHEAD = 600
+STEPIK_TOKEN_EXPIRY_MARGIN = 60
+STEPIK_TOKEN_CHECK_INTERVAL = 3600
+
+STEPIK_API_URL = 'https://stepik.org/api'
+# Ответы, после которых запрос к Stepik повторяется
+STEPIK_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+STEPIK_RETRY_BACKOFF = 1
+# Кэш ID курсов с сертификатами ученика (set в DB 2)
+STEPIK_CERTS_KEY_PREFIX = 'stepik_certs:'
+STEPIK_CERTS_TTL = 600
+# Кэш приватности аккаунта из /api/users (1 - приватный, 0 - публичный)
+STEPIK_USER_KEY_PREFIX = 'stepik_user:'
+STEPIK_USER_TTL = 120
+STEPIK_PRIVATE_USER_TTL = 30
+# Сколько страниц сертификатов запрашивается параллельно
+STEPIK_PAGE_PREFETCH = 3
+
+# Кэш результата проверки verify:<stepik_id>:<course_id>
+# (1 - сертификат есть, 0 - нет, PRIVATE - аккаунт приватный)
+VERIFY_KEY_PREFIX = 'verify:'
+VERIFY_POSITIVE_TTL = 86400
+VERIFY_NEGATIVE_TTL = 120
+VERIFY_PRIVATE_TTL = 30
+
+# Индексы для отчёта администратора: получатели по курсам и их имена
+COURSE_HOLDERS_KEY_PREFIX = 'course_holders:'
+USERNAMES_KEY = 'usernames'
+# Когда имя в usernames обновлялось (zset tg_id -> unix time)
+USERNAMES_SEEN_KEY = 'usernames_seen'
+TG_MESSAGE_LIMIT = 4096
+
+# Кэш подписки на канал member:<chat_id>:<tg_id>
+MEMBER_KEY_PREFIX = 'member:'
+MEMBER_POSITIVE_TTL = 300
+MEMBER_NEGATIVE_TTL = 10
+
+# Обратный индекс stepik_user_id -> tg_id (hash в DB 2)
+STEPIK_OWNERS_KEY = 'stepik_owners'
+
+# KEYS[1] - индекс владельцев, KEYS[2] - хэш пользователя
+# ARGV[1] - stepik_user_id, ARGV[2] - tg_id
+# Возвращает {статус, значение}: OK - Stepik ID закреплён за пользователем,
+# BOUND - у пользователя другой Stepik ID, TAKEN - Stepik ID занят.
+CLAIM_STEPIK_ID_LUA = """
+local bound = redis.call('HGET', KEYS[2], 'stepik_user_id')
+if bound then
+    if bound ~= ARGV[1] then
+        return {'BOUND', bound}
+    end
+    redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2])
+    return {'OK', ARGV[2]}
+end
+local owner = redis.call('HGET', KEYS[1], ARGV[1])
+if owner and owner ~= ARGV[2] then
+    return {'TAKEN', owner}
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('HSET', KEYS[2], 'stepik_user_id', ARGV[1])
+return {'OK', ARGV[2]}
+"""
+
+# KEYS[1] - хэш пользователя, KEYS[2] - счётчик номеров
+# ARGV[1] - course_id, ARGV[2] - поле ожидающей выдачи
+# Возвращает {EXISTS, запись} или {NEW | PENDING, номер}.
+BEGIN_ISSUANCE_LUA = """
+local record = redis.call('HGET', KEYS[1], ARGV[1])
+if record then
+    return {'EXISTS', record}
+end
+local pending = redis.call('HGET', KEYS[1], ARGV[2])
+if pending then
+    return {'PENDING', pending}
+end
+local number = redis.call('INCR', KEYS[2])
+redis.call('HSET', KEYS[1], ARGV[2], number)
+return {'NEW', tostring(number)}
+"""
+
+def membership_key(chat_id: int, user_id: int) -> str:
+    """
+    Ключ кэша подписки пользователя на канал/группу (1 - подписан, 0 - нет).
+    """
+    return f'{MEMBER_KEY_PREFIX}{chat_id}:{user_id}'
+
+async def cache_membership(redis_client: Redis,
+                           chat_id: int,
+                           user_id: int,
+                           is_member: bool) -> None:
+    """
+    Сохраняет статус подписки в кэш (из get_chat_member или из событий
+    входа/выхода в группе). Кэш необязателен: ошибка Redis логируется и
+    не прерывает обработку.
+    """
+    try:
+        await redis_client.set(membership_key(chat_id, user_id),
+                               int(is_member),
+                               ex=(MEMBER_POSITIVE_TTL if is_member
+                                   else MEMBER_NEGATIVE_TTL))
+    except RedisError as err:
+        logger_utils.warning(f'Статус подписки TG_ID:{user_id} на {chat_id}'
+                             f' не закэширован: {err}')
 
 async def check_user_in_group(_type_update: Message | CallbackQuery,
-                              tg_target_channel: int) -> bool:
+                              tg_target_channel: int,
+                              redis_client: Redis | None = None) -> bool:
+    """
+    Проверяет подписку пользователя на канал. С redis_client результат
+    берётся из кэша (подписка на MEMBER_POSITIVE_TTL, её отсутствие — на
+    MEMBER_NEGATIVE_TTL, чтобы только что подписавшийся не ждал).
+    Ошибки Bot API не кэшируются; при недоступном Redis подписка
+    проверяется через get_chat_member.
+    :param _type_update: Message или CallbackQuery пользователя.
+    :param tg_target_channel: ID канала.
+    :param redis_client: Redis клиент DB 2 для кэша.
+    :return: True, если пользователь подписан.
+    """
     logger_utils.debug('Entry')
-    
+
     target_chat = tg_target_channel
     user_id = _type_update.from_user.id
     logger_utils.debug(f'{user_id=}')
-    try:
-        chat_member = await _type_update.bot.get_chat_member(target_chat, user_id)
-        # logger_utils.debug(f'{chat_member=}')
+    if redis_client is not None:
         try:
-            status: bool = chat_member.is_member
-            logger_utils.debug(f'{status=}')
-        except Exception:
-            status = chat_member.status in {'member',
-                                            'administrator',
-                                            'creator'}
-            logger_utils.debug(f'{status=}')
-        else:
-            logger_utils.debug('Exit')
-            return status
+            cached = await redis_client.get(membership_key(target_chat,
+                                                           user_id))
+        except RedisError as err:
+            # Без кэша проверяем подписку напрямую через Bot API
+            logger_utils.warning(f'Кэш подписки недоступен: {err}')
+            cached = None
+        if cached is not None:
+            logger_utils.debug(f'Exit: из кэша {cached=}')
+            return cached == '1'
 
+    try:
+        chat_member = await _type_update.bot.get_chat_member(target_chat,
+                                                             user_id)
     except Exception as err:
-        logger_utils.debug(f'{err=}')
+        logger_utils.warning(f'Не удалось проверить подписку TG_ID:{user_id}'
+                             f' на {target_chat}: {err}')
         return False
 
-    else:
-        logger_utils.debug('Exit')
-        return status
+    # is_member есть только у ChatMemberRestricted
+    status = getattr(chat_member, 'is_member', None)
+    if status is None:
+        status = chat_member.status in {'member', 'administrator', 'creator'}
+    logger_utils.debug(f'{status=}')
 
-async def get_username(_type_update: Message | CallbackQuery | ChatFullInfo) -> str:
+    if redis_client is not None:
+        await cache_membership(redis_client, target_chat, user_id, status)
+    logger_utils.debug('Exit')
+    return status
+
+async def get_username(_type_update: Message | CallbackQuery | ChatFullInfo
+                       | User) -> str:
     """
 
     """
-    if isinstance(_type_update, ChatFullInfo):
+    if isinstance(_type_update, (ChatFullInfo, User)):
         if username := _type_update.username:
             return f'@{username}'
         elif first_name := _type_update.first_name:
@@ -80,41 +213,199 @@ async def get_username(_type_update: Message | CallbackQuery | ChatFullInfo) ->
         return first_name
     return str(_type_update.from_user.id)
 
+def file_id_key(course_id: str) -> str:
+    """
+    Поле хэша пользователя с Telegram file_id выданного сертификата.
+    :param course_id: ID курса на Stepik.
+    """
+    return f'file_id:{course_id}'
+
+def pending_issue_key(course_id: str) -> str:
+    """
+    Поле хэша пользователя с номером сертификата, который выделен, но ещё
+    не доставлен.
+    :param course_id: ID курса на Stepik.
+    """
+    return f'pending:{course_id}'
+
+def course_holders_key(course_id: int | str) -> str:
+    """
+    Set с TG_ID получивших сертификат курса (индекс для отчётов).
+    :param course_id: ID курса на Stepik.
+    """
+    return f'{COURSE_HOLDERS_KEY_PREFIX}{course_id}'
+
+def create_stepik_session() -> aiohttp.ClientSession:
+    """
+    Создаёт HTTP-клиент Stepik API на всё время работы бота: keep-alive
+    соединения к stepik.org переиспользуются между запросами.
+    :return: aiohttp.ClientSession с пулом соединений.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=STEPIK_CONNECTIONS_LIMIT,
+        limit_per_host=STEPIK_CONNECTIONS_LIMIT,
+        keepalive_timeout=STEPIK_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=STEPIK_DNS_CACHE_TTL)
+    return aiohttp.ClientSession(connector=connector, timeout=STEPIK_TIMEOUT)
+
 @dataclass
 class StepikService:
+    """
+    Клиент Stepik API и генерация сертификатов. Создаётся один раз в
+    main.py и передаётся в хэндлеры через StepikMiddleware.
+    """
     client_id: str
     client_secret: str
     redis_client: Redis
     courses: dict[int, Course]
+    session: aiohttp.ClientSession
+    rate_limiter: RedisTokenBucket
+    max_retries: int = 3
+    _token_lock: asyncio.Lock = field(default_factory=asyncio.Lock,
+                                      init=False,
+                                      repr=False)
+    _refresher_task: asyncio.Task | None = field(default=None,
+                                                 init=False,
+                                                 repr=False)
+    verify_stats: dict[str, int] = field(
+        default_factory=lambda: {'hits': 0, 'misses': 0, 'bypassed': 0},
+        init=False)
+    # None - не проверено, False - Stepik игнорирует фильтр course
+    _course_filter_supported: bool | None = field(default=None,
+                                                  init=False,
+                                                  repr=False)
+
+    def __post_init__(self) -> None:
+        self._claim_stepik_id_script = self.redis_client.register_script(
+            CLAIM_STEPIK_ID_LUA)
+        self._begin_issuance_script = self.redis_client.register_script(
+            BEGIN_ISSUANCE_LUA)
+
+    async def close(self) -> None:
+        if self._refresher_task:
+            self._refresher_task.cancel()
+        await self.session.close()
+        logger_utils.info(f'Лимит запросов Stepik: '
+                          f'{await self.rate_limiter.stats()}')
+        logger_utils.info(f'Кэш проверок Stepik: '
+                          f'{self.verification_stats()}')
+
+    def _retry_delay(self,
+                     response: aiohttp.ClientResponse | None,
+                     attempt: int) -> float:
+        """
+        :return: Пауза перед повтором: Retry-After из ответа или
+                 экспоненциальная задержка со случайной добавкой.
+        """
+        if response is not None:
+            retry_after = parse_retry_after(
+                response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return retry_after + random.uniform(0, 1)
+        backoff = STEPIK_RETRY_BACKOFF * 2 ** (attempt - 1)
+        return backoff + random.uniform(0, backoff)
+
+    @asynccontextmanager
+    async def _request(self,
+                       method: str,
+                       url: str,
+                       **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        Все запросы к Stepik идут через этот метод: перед каждым берётся
+        токен из общего для реплик rate_limiter, на 429 и 5xx запрос
+        повторяется (до max_retries) с учётом Retry-After; 429 ставит на
+        паузу всех. Последний ответ отдаётся вызывающему коду как есть.
+        :param method: HTTP-метод.
+        :param url: Адрес запроса.
+        :param kwargs: Параметры aiohttp.ClientSession.request.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            await self.rate_limiter.acquire()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except (aiohttp.ClientConnectionError, TimeoutError) as err:
+                if attempt > self.max_retries:
+                    raise
+                delay = self._retry_delay(None, attempt)
+                logger_utils.warning(f'Ошибка соединения со Stepik: {err!r}.'
+                                     f' Повтор {attempt}/{self.max_retries}'
+                                     f' через {delay:.1f}c')
+            else:
+                if (response.status not in STEPIK_RETRY_STATUSES
+                        or attempt > self.max_retries):
+                    try:
+                        yield response
+                    finally:
+                        response.release()
+                    return
+
+                delay = self._retry_delay(response, attempt)
+                response.release()
+                if response.status == 429:
+                    await self.rate_limiter.pause(delay)
+                logger_utils.warning(f'Stepik ответил {response.status}.'
+                                     f' Повтор {attempt}/{self.max_retries}'
+                                     f' через {delay:.1f}c')
+            await asyncio.sleep(delay)
+
+    async def _get_cached_privacy(self, stepik_user_id: str) -> bool | None:
+        """
+        :return: Приватность аккаунта из кэша или None, если кэша нет.
+        """
+        cached = await self.redis_client.get(
+            f'{STEPIK_USER_KEY_PREFIX}{stepik_user_id}')
+        return None if cached is None else cached == '1'
+
+    async def is_private_account(self,
+                                 stepik_user_id: str,
+                                 access_token: str | None = None):
+        """
+        Проверяет приватность аккаунта на Stepik. Ответ /api/users
+        кэшируется в Redis на STEPIK_USER_TTL.
+        :param stepik_user_id: ID пользователя на Stepik.
+        :param access_token: Токен доступа; если не передан, берётся из кэша.
+        :return: True/False или None, если статус определить не удалось.
+        """
+        cached = await self._get_cached_privacy(stepik_user_id)
+        if cached is not None:
+            return cached
 
-    async def is_private_account(self, stepik_user_id: str):
         logger_utils.info(f'Проверка Stepik-аккаунта юзера на приватность:'
                           f'Stepik_ID:{stepik_user_id}')
         url = f'https://stepik.org/api/users/{stepik_user_id}'
         try:
-            access_token = await self.get_stepik_access_token()
+            access_token = (access_token
+                            or await self.get_stepik_access_token())
             headers = {'Authorization': f'Bearer {access_token}'}
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 200:
-                        response_data = await response.json()
-                        users = response_data.get('users')
-                        logger_utils.debug(f'{users=}')
-                        if users:
-                            is_private = users[0]['is_private']
-                            logger_utils.info(f'Stepik_ID:{stepik_user_id}:'
-                                              f'{'Приватный' if is_private
-                                              else 'Публичный'}')
-                            return True if is_private else False
-                        else:
-                            logger_utils.warning(
-                                f'Данные юзера не найдены для'
-                                f' stepik_id:{stepik_user_id} из-за '
-                                f'приватности аккаунта.')
+            async with self._request('GET',
+                                     url,
+                                     headers=headers) as response:
+                if response.status == 200:
+                    response_data = await response.json()
+                    users = response_data.get('users')
+                    logger_utils.debug(f'{users=}')
+                    if users:
+                        is_private = users[0]['is_private']
+                        logger_utils.info(f'Stepik_ID:{stepik_user_id}:'
+                                          f'{'Приватный' if is_private
+                                          else 'Публичный'}')
+                        await self.redis_client.set(
+                            f'{STEPIK_USER_KEY_PREFIX}{stepik_user_id}',
+                            1 if is_private else 0,
+                            ex=(STEPIK_PRIVATE_USER_TTL if is_private
+                                else STEPIK_USER_TTL))
+                        return True if is_private else False
                     else:
-                        logger_utils.error(
-                            f'Неожиданный статус ответа: {response.status}',
-                                exc_info=True)
+                        logger_utils.warning(
+                            f'Данные юзера не найдены для'
+                            f' stepik_id:{stepik_user_id} из-за '
+                            f'приватности аккаунта.')
+                else:
+                    logger_utils.error(
+                        f'Неожиданный статус ответа: {response.status}',
+                            exc_info=True)
         except Exception as err:
             logger_utils.error(f'Ошибка при проверке приватности аккаунта'
                                f' пользователя: {err}', exc_info=True)
@@ -125,40 +416,96 @@ class StepikService:
         :return str: Токен доступа
         :raises: RuntimeError, если не удалось получить токен.
         """
-        cached_token = await self.redis_client.get('stepik_token')
-        url = 'https://stepik.org/oauth2/token/'
-
+        cached_token = await self.redis_client.get(STEPIK_TOKEN_KEY)
         if cached_token:
             logger_utils.info('Используется кэшированный токен из Redis.')
             return cached_token
 
+        return await self.refresh_stepik_access_token()
+
+    async def refresh_stepik_access_token(self, force: bool = False) -> str:
+        """
+        Обновляет токен так, чтобы при одновременных промахах запрос к
+        /oauth2/token/ выполнялся один раз: внутри процесса вызовы ждут
+        asyncio.Lock, между репликами бота — блокировку в Redis. После
+        получения блокировок токен перечитывается из Redis, так как его мог
+        уже обновить другой вызов.
+        :param force: Обновить токен, даже если он ещё есть в Redis
+         (фоновое обновление перед истечением).
+        :return str: Токен доступа
+        :raises: RuntimeError, если не удалось получить токен.
+        """
+        async with self._token_lock:
+            if token := await self._get_fresh_token(force):
+                return token
+            lock = self.redis_client.lock(STEPIK_TOKEN_LOCK_KEY,
+                                          timeout=30,
+                                          blocking_timeout=35)
+            if not await lock.acquire():
+                # Владелец блокировки мог уже сохранить новый токен
+                if token := await self._get_fresh_token(force):
+                    return token
+                logger_utils.warning('Блокировка обновления токена не '
+                                     'получена, запрашиваем токен.')
+                return await self._request_access_token()
+            try:
+                if token := await self._get_fresh_token(force):
+                    return token
+                return await self._request_access_token()
+            finally:
+                try:
+                    await lock.release()
+                except LockError as err:
+                    logger_utils.warning(f'Блокировка обновления токена '
+                                         f'истекла до освобождения: {err}')
+
+    async def _get_fresh_token(self, force: bool) -> str | None:
+        """
+        :param force: Считать токен устаревшим, если до истечения осталось
+         меньше STEPIK_TOKEN_REFRESH_AHEAD.
+        :return: Токен из Redis или None, если его нужно обновить.
+        """
+        if not force:
+            return await self.redis_client.get(STEPIK_TOKEN_KEY)
+
+        ttl = await self.redis_client.ttl(STEPIK_TOKEN_KEY)
+        if ttl > STEPIK_TOKEN_REFRESH_AHEAD:
+            return await self.redis_client.get(STEPIK_TOKEN_KEY)
+        return None
+
+    async def _request_access_token(self) -> str:
+        url = 'https://stepik.org/oauth2/token/'
         data = {
                 'grant_type': 'client_credentials',
                 'client_id': self.client_id,
                 'client_secret': self.client_secret}
 
         try:
-            async with (aiohttp.ClientSession() as session):
-                async with session.post(url,
-                                        data=data,
-                                        allow_redirects=True) as resp:
-                    if resp.status != 200:
-                        error_message = await resp.text()
-                        logger_utils.error(
-                            f'Ошибка при запросе токена: {error_message}',
-                            exc_info=True)
-                        raise RuntimeError(
-                            f'Не удалось получить токен: {error_message}')
-                    response = await resp.json()
-                    access_token = response.get('access_token')
-                    if not access_token:
-                        raise RuntimeError('Токен не найден в ответе API.')
-                    # Сохраняем токен в Redis с TTL
-                    await self.redis_client.set('stepik_token', access_token,
-                                                ex=35000)
-                    logger_utils.info(
-                        'Токен успешно получен и сохранён в Redis.')
-                    return access_token
+            async with self._request('POST',
+                                     url,
+                                     data=data,
+                                     allow_redirects=True) as resp:
+                if resp.status != 200:
+                    error_message = await resp.text()
+                    logger_utils.error(
+                        f'Ошибка при запросе токена: {error_message}',
+                        exc_info=True)
+                    raise RuntimeError(
+                        f'Не удалось получить токен: {error_message}')
+                response = await resp.json()
+                access_token = response.get('access_token')
+                if not access_token:
+                    raise RuntimeError('Токен не найден в ответе API.')
+                # Сохраняем токен в Redis с TTL из ответа API
+                expires_in = int(response.get('expires_in', 36000))
+                ttl = max(expires_in - STEPIK_TOKEN_EXPIRY_MARGIN,
+                          STEPIK_TOKEN_EXPIRY_MARGIN)
+                await self.redis_client.set(STEPIK_TOKEN_KEY,
+                                            access_token,
+                                            ex=ttl)
+                logger_utils.info(
+                    f'Токен успешно получен и сохранён в Redis на {ttl}c.')
+                return access_token
 
         except aiohttp.ClientError as err:
             logger_utils.error(f'Ошибка сети при запросе токена: {err}',
@@ -170,6 +517,28 @@ class StepikService:
                                exc_info=True)
             raise RuntimeError(f'Неожиданная ошибка: {err}')
 
+    async def run_token_refresher(self) -> None:
+        """
+        Фоновая задача: обновляет токен до истечения TTL, чтобы запросы
+        пользователей не попадали на промах кэша.
+        """
+        while True:
+            try:
+                ttl = await self.redis_client.ttl(STEPIK_TOKEN_KEY)
+                if ttl <= STEPIK_TOKEN_REFRESH_AHEAD:
+                    await self.refresh_stepik_access_token(force=True)
+                    ttl = await self.redis_client.ttl(STEPIK_TOKEN_KEY)
+                delay = min(max(ttl - STEPIK_TOKEN_REFRESH_AHEAD, 60),
+                            STEPIK_TOKEN_CHECK_INTERVAL)
+            except Exception as err:
+                logger_utils.error(f'Ошибка фонового обновления токена: '
+                                   f'{err}', exc_info=True)
+                delay = 60
+            await asyncio.sleep(delay)
+
+    def start_token_refresher(self) -> None:
+        self._refresher_task = asyncio.create_task(self.run_token_refresher())
+
     async def check_cert_in_user(self,
                                  tg_user_id: str,
                                  course_id: str) -> bool | str:
@@ -186,6 +555,22 @@ class StepikService:
                                                    f'{course_id}')
         return certificate if certificate else False
 
+    async def claim_stepik_id(self,
+                              tg_user_id: str,
+                              stepik_user_id: str) -> tuple[str, str]:
+        """
+        Закрепляет Stepik ID за пользователем за один запрос к Redis.
+        :param tg_user_id: TG_ID пользователя.
+        :param stepik_user_id: ID пользователя на Stepik.
+        :return: ('OK', tg_id) — Stepik ID закреплён за пользователем;
+                 ('BOUND', stepik_id) — у пользователя уже другой Stepik ID;
+                 ('TAKEN', tg_id) — Stepik ID занят другим пользователем.
+        """
+        status, value = await self._claim_stepik_id_script(
+            keys=[STEPIK_OWNERS_KEY, tg_user_id],
+            args=[stepik_user_id, tg_user_id])
+        return status, value
+
     async def save_certificate_number(self, user_id: str, course_id: str):
         """
         Сохраняет номер сертификата в Redis.
@@ -200,88 +585,258 @@ class StepikService:
             logger_utils.error(f'Ошибка при сохранении данных в Redis: {err}',
                                exc_info=True)
 
+    async def _get_certificates_page(self,
+                                     access_token: str,
+                                     **params: int | str) -> dict:
+        """
+        Запрашивает одну страницу /api/certificates.
+        :param access_token: Токен доступа Stepik API.
+        :param params: Фильтры запроса (user, course, page).
+        :return: Ответ API.
+        """
+        async with self._request(
+                'GET',
+                f'{STEPIK_API_URL}/certificates',
+                params=params,
+                headers={'Authorization': 'Bearer ' + access_token}) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def _find_course_certificate(self,
+                                       stepik_user_id: str,
+                                       course_id: int,
+                                       access_token: str) -> bool | None:
+        """
+        Ищет сертификат курса одним запросом с фильтром course на стороне
+        Stepik.
+        :return: True/False или None, если API проигнорировал фильтр и
+                 нужен полный обход страниц.
+        """
+        data = await self._get_certificates_page(access_token,
+                                                 user=stepik_user_id,
+                                                 course=course_id)
+        certificates = data['certificates']
+        if any(cert['course'] != course_id for cert in certificates):
+            self._course_filter_supported = False
+            logger_utils.warning('Stepik API игнорирует фильтр course в '
+                                 '/api/certificates, используем полный '
+                                 'обход страниц')
+            return None
+        return bool(certificates)
+
+    async def _fetch_certified_courses(self,
+                                       stepik_user_id: str,
+                                       access_token: str) -> set[int]:
+        """
+        Собирает ID курсов всех сертификатов пользователя. Первая страница
+        запрашивается отдельно (у большинства учеников она единственная),
+        остальные — окнами по STEPIK_PAGE_PREFETCH параллельных запросов.
+        Окно может выйти за последнюю страницу: ошибки (404) страниц после
+        has_next=False не учитываются.
+        :return: Множество ID курсов.
+        """
+        data = await self._get_certificates_page(access_token,
+                                                 user=stepik_user_id,
+                                                 page=1)
+        courses = {cert['course'] for cert in data['certificates']}
+        has_next = data['meta']['has_next']
+        page_number = 2
+        while has_next:
+            pages = range(page_number, page_number + STEPIK_PAGE_PREFETCH)
+            results = await asyncio.gather(
+                *(self._get_certificates_page(access_token,
+                                              user=stepik_user_id,
+                                              page=page)
+                  for page in pages),
+                return_exceptions=True)
+            for data in results:
+                if isinstance(data, BaseException):
+                    raise data
+                courses.update(cert['course'] for cert in data['certificates'])
+                has_next = data['meta']['has_next']
+                if not has_next:
+                    break
+            page_number += STEPIK_PAGE_PREFETCH
+        return courses
+
+    async def _cache_certified_courses(self,
+                                       stepik_user_id: str,
+                                       courses: set[int]) -> None:
+        if not courses:
+            return
+        cache_key = f'{STEPIK_CERTS_KEY_PREFIX}{stepik_user_id}'
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.sadd(cache_key, *courses)
+            pipe.expire(cache_key, STEPIK_CERTS_TTL)
+            await pipe.execute()
+
     async def check_cert_in_stepik(self,
                                    stepik_user_id: str,
                                    course_id: str,
                                    access_token: str,
                                    tg_username: str,
-                                   config: Config) -> bool | str:
+                                   config: Config) -> bool:
         """
          Проверяет наличие сертификата у пользователя на Stepik.
+         Курсы, собранные полным обходом страниц, кэшируются в Redis
+         (stepik_certs:<stepik_id>, STEPIK_CERTS_TTL), поэтому проверка
+         другого курса из этого списка не обходит страницы заново.
+         Отсутствие курса в кэше всегда перепроверяется на Stepik.
         :param config:
         :param tg_username:
         :param stepik_user_id: ID пользователя на Stepik.
         :param course_id: ID курса, сертификат которого надо проверить на
                наличие у ученика.
         :param access_token: Токен доступа Stepik API.
+        :return: True, если сертификат найден, иначе False.
+        """
+        course_id = int(course_id)
+        try:
+            found = bool(await self.redis_client.sismember(
+                f'{STEPIK_CERTS_KEY_PREFIX}{stepik_user_id}', course_id))
+
+            if not found and self._course_filter_supported is not False:
+                found = await self._find_course_certificate(stepik_user_id,
+                                                            course_id,
+                                                            access_token)
+
+            # Фильтр не поддерживается: обходим все страницы
+            if not found and self._course_filter_supported is False:
+                courses = await self._fetch_certified_courses(stepik_user_id,
+                                                              access_token)
+                await self._cache_certified_courses(stepik_user_id, courses)
+                found = course_id in courses
+        except Exception as err:
+            logger_utils.error(f'Ошибка при запросе сертификатов: {err}',
+                               exc_info=True)
+            raise
+
+        if found:
+            course_data = config.courses_data.courses.get(course_id)
+            logger_utils.info(f'У STEPIK_ID:{stepik_user_id},'
+                              f'TG_USERNAME:{tg_username} '
+                              f'cертификат курса {course_data.name}'
+                              f':{course_id} имеется на Stepik')
+        return found
+
+    async def verify_certificate(self,
+                                 stepik_user_id: str,
+                                 course_id: str,
+                                 tg_username: str,
+                                 config: Config,
+                                 bypass_cache: bool = False) -> bool | str:
+        """
+        Проверка ученика для выдачи сертификата с кэшем результата по
+        (stepik_id, course_id): положительный ответ хранится
+        VERIFY_POSITIVE_TTL, отрицательный — VERIFY_NEGATIVE_TTL,
+        PRIVATE — VERIFY_PRIVATE_TTL, поэтому повторные нажатия «Готово»
+        без сертификата не обращаются к Stepik.
+        :param stepik_user_id: ID пользователя на Stepik.
+        :param course_id: ID курса.
+        :param tg_username: Имя пользователя в Telegram для логов.
+        :param config: Конфигурация бота.
+        :param bypass_cache: Сбросить кэши ученика и проверить на Stepik
+         (для администраторов).
         :return: 'PRIVATE' если аккаунт ученика на Stepik приватный;
                   True, если сертификат найден, иначе False.
         """
-        if await self.is_private_account(stepik_user_id):
+        cache_key = f'{VERIFY_KEY_PREFIX}{stepik_user_id}:{course_id}'
+        if bypass_cache:
+            self.verify_stats['bypassed'] += 1
+            await self.invalidate_verification(stepik_user_id)
+        else:
+            cached = await self.redis_client.get(cache_key)
+            if cached is not None:
+                self.verify_stats['hits'] += 1
+                logger_utils.debug(f'Результат проверки из кэша: '
+                                   f'{cache_key}={cached}')
+                return cached if cached == 'PRIVATE' else cached == '1'
+            self.verify_stats['misses'] += 1
+
+        result = await self._verify_on_stepik(stepik_user_id,
+                                              course_id,
+                                              tg_username,
+                                              config)
+        if result == 'PRIVATE':
+            value, ttl = 'PRIVATE', VERIFY_PRIVATE_TTL
+        elif result:
+            value, ttl = '1', VERIFY_POSITIVE_TTL
+        else:
+            value, ttl = '0', VERIFY_NEGATIVE_TTL
+        await self.redis_client.set(cache_key, value, ex=ttl)
+        return result
+
+    async def _verify_on_stepik(self,
+                                stepik_user_id: str,
+                                course_id: str,
+                                tg_username: str,
+                                config: Config) -> bool | str:
+        """
+        Наличие сертификата курса на Stepik и приватность аккаунта. Токен
+        берётся один раз. Сначала ищется сертификат: если он найден,
+        приватность не важна и /api/users не запрашивается. Приватность
+        проверяется (с кэшем STEPIK_USER_TTL) только без сертификата или
+        при ошибке поиска — чтобы отличить приватный аккаунт.
+        """
+        access_token = await self.get_stepik_access_token()
+        if await self._get_cached_privacy(stepik_user_id):
             return 'PRIVATE'
 
-        page_number = 1
-        while True:
-            try:
-                api_url = (f'https://stepik.org/api/certificates?user='
-                           f'{stepik_user_id}&page={page_number}')
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                            api_url,
-                            headers={'Authorization': 'Bearer ' + access_token}) as response:
-                        if response.status == 429:
-                            logger_utils.warning(
-                                'Превышен лимит запросов. Ожидание… 10c')
-                            await asyncio.sleep(10)
-                        response.raise_for_status()
-                        data = await response.json()
-                        # logger_utils.debug(f'{data['certificates']}')
-
-                        # Проверяем сертификаты на текущей странице
-                        course_data = config.courses_data.courses.get(
-                            int(course_id))
-                        for certificate in data['certificates']:
-                            if certificate['course'] == int(course_id):
-                                logger_utils.info(
-                                    f'У STEPIK_ID:{stepik_user_id},'
-                                    f'TG_USERNAME:{tg_username} '
-                                    f'cертификат курса {course_data.name}'
-                                    f':{course_id} имеется на Stepik')
-                                return True  # Сертификат за курс найден
-
-                        # Если есть следующая страница, переходим к ней
-                        if data['meta']['has_next']:
-                            page_number += 1
-                            await asyncio.sleep(1)  # Задержка между запросами
-                        else:
-                            break  # Больше страниц нет
-            except Exception as err:
-                logger_utils.error(f'Ошибка при запросе сертификатов: {err}',
-                                   exc_info=True)
-                raise
-        return False  # Сертификат за курс не найден
+        try:
+            found = await self.check_cert_in_stepik(
+                stepik_user_id=stepik_user_id,
+                course_id=course_id,
+                access_token=access_token,
+                tg_username=tg_username,
+                config=config)
+        except Exception:
+            if await self.is_private_account(stepik_user_id, access_token):
+                return 'PRIVATE'
+            raise
 
-    def sync_generate_certificate(self,
-                                  data: dict[str, str],
-                                  w_text: bool = False) -> tuple[str, str] | None:
+        if found:
+            return True
+        if await self.is_private_account(stepik_user_id, access_token):
+            return 'PRIVATE'
+        return False
+
+    async def invalidate_verification(self, stepik_user_id: str) -> int:
         """
-        Синхронная функция для генерации сертификата.
-        :param data: Данные для генерации сертификата.
-        :param w_text: Флаг для добавления водяного знака.
-        :return: Путь к сгенерированному файлу сертификата.
+        Сбрасывает закэшированные результаты проверок ученика, список его
+        сертификатов и приватность аккаунта.
+        :param stepik_user_id: ID пользователя на Stepik.
+        :return: Количество удалённых ключей.
         """
-        logger_utils.debug('Entry')
+        keys = [f'{VERIFY_KEY_PREFIX}{stepik_user_id}:{course_id}'
+                for course_id in self.courses]
+        keys.append(f'{STEPIK_CERTS_KEY_PREFIX}{stepik_user_id}')
+        keys.append(f'{STEPIK_USER_KEY_PREFIX}{stepik_user_id}')
+        deleted = await self.redis_client.delete(*keys)
+        logger_utils.info(f'Кэш проверок STEPIK_ID:{stepik_user_id} сброшен,'
+                          f' удалено ключей: {deleted}')
+        return deleted
+
+    def verification_stats(self) -> dict[str, int | float]:
+        """
+        :return: Попадания, промахи и обходы кэша проверок этой реплики и
+                 доля попаданий.
+        """
+        lookups = self.verify_stats['hits'] + self.verify_stats['misses']
+        hit_rate = self.verify_stats['hits'] / lookups if lookups else 0.0
+        return {**self.verify_stats, 'hit_rate': round(hit_rate, 3)}
 
+    def get_template_name(self, data: dict[str, str]) -> str | None:
+        """
+        Выбирает шаблон нового сертификата по курсу и полу из анкеты.
+        :param data: Данные анкеты.
+        :return: Имя файла шаблона или None, если данные некорректны.
+        """
         try:
-            # 1. Извлечение данных из data
-            user_name = data.get('full_name')
-            number = data.get('end_number')
             course_id = int(data.get('course'))
             gender = data.get('gender')
 
             # Проверка значений gender
             if gender not in ('female', 'male'):
-                logger_utils.error(f'Неизвестное значение gender: {gender}')
                 raise ValueError(f'Неизвестное значение gender: {gender}')
 
         except (KeyError, TypeError, ValueError) as err:
@@ -290,266 +845,179 @@ class StepikService:
                 exc_info=True)
             return None
 
-        # 2. Определение путей к файлам
-        try:
-            local_path = os.path.abspath(
-                os.path.join(os.path.dirname(__file__), '..', 'static'))
-            base_dir = os.getenv('CERTIFICATE_DATA_DIR', local_path)
-
-            course_config = self.courses.get(course_id)
-            if not course_config:
-                logger_utils.error(f'Конфигурация для курса {course_id} не найдена.')
-                raise ValueError(f'Неизвестный ID курса: {course_id}')
-
-            template_name = course_config.templates.get(gender)
-            if not template_name:
-                logger_utils.error(f'Шаблон для курса {course_id} и'
-                                   f' гендера {gender} не найден.')
-                raise ValueError(f'Шаблон не найден для gender={gender},'
-                                 f' course={course_id}')
-
-            # Проверка, что template_name не равен None
-            if template_name is None:
-                logger_utils.error(
-                    f'Не удалось определить шаблон для gender={gender},'
-                    f' course={course_id}')
-                raise ValueError("Имя шаблона не может быть None")
-
-            logger_utils.debug(f'Выбран шаблон: {template_name}')
-
-            font_path = os.path.join(base_dir, 'Bitter-Regular.ttf')
-            template_file = os.path.join(base_dir, template_name)
-
-            course_name = course_config.name.replace(' ', '_')
-            output_file = os.path.join(base_dir, f'{course_name}_{number}.pdf')
-
-            if not os.path.exists(font_path):
-                raise FileNotFoundError(f'Файл шрифта не найден: {font_path}')
-
-        except FileNotFoundError as err:
-            logger_utils.error(f'Ошибка при определении путей: {err}',
-                               exc_info=True)
-            return None
-        except Exception as err:
-            logger_utils.error(
-                f'Неизвестная ошибка при определении путей: {err}',
-                exc_info=True)
-            return None
-
-        # 3. Регистрация шрифта
-        try:
-            pdfmetrics.registerFont(TTFont('BitterReg', font_path))
-        except Exception as err:
-            logger_utils.error(f'Ошибка при регистрации шрифта: {err}',
-                               exc_info=True)
+        course_config = self.courses.get(course_id)
+        if not course_config:
+            logger_utils.error(f'Конфигурация для курса {course_id} не найдена.')
             return None
 
-        # 4. Работа с PDF
-        try:
-            light_gray = Color(230 / 255, 230 / 255, 230 / 255)
-            watermark_text = 'TEST VERSION'
-            reader = PdfReader(template_file)
-            writer = PdfWriter()
-
-            for page_num in range(len(reader.pages)):
-                page = reader.pages[page_num]
-                packet = io.BytesIO()
-                can = canvas.Canvas(packet, pagesize=letter)
-                font_size = 16
-
-                if len(user_name) in (24, 25):
-                    font_size = 15
-                elif len(user_name) in (26, 27):
-                    font_size = 14
-                elif len(user_name) in (28, 29, 30):
-                    font_size = 13
-
-                text_width = can.stringWidth(user_name, 'BitterReg', font_size)
-                can.setFont('BitterReg', font_size)
-                page_width = letter[0]
-                x_position = (page_width - text_width) / 2 + 155
-                can.drawString(x_position, 306, user_name)
-                can.setFont('BitterReg', 21)
-                can.setFillColor(light_gray)
-                can.drawString(440, 373, number)
-
-                if w_text:
-                    can.setFillColor(Color(0.3, 0, 0, alpha=0.7))
-                    can.setFont('Helvetica', 50)
-                    can.rotate(45)
-                    can.drawString(110, 60, watermark_text)
-
-                can.showPage()
-                can.save()
-                packet.seek(0)
-                new_pdf = PdfReader(packet)
-                page.merge_page(new_pdf.pages[0])
-                writer.add_page(page)
-
-            with open(output_file, 'wb') as fh:
-                writer.write(fh)
-
-        except Exception as err:
-            logger_utils.error(f'Ошибка при работе с PDF: {err}',
-                               exc_info=True)
+        template_name = course_config.templates.get(gender)
+        if not template_name:
+            logger_utils.error(f'Шаблон для курса {course_id} и'
+                               f' гендера {gender} не найден.')
             return None
 
-        # 5. Возврат результата
-        return output_file, template_name
+        logger_utils.debug(f'Выбран шаблон: {template_name}')
+        return template_name
 
-    def sync_exists_certificate(self,
-                                data: dict[str, str],
-                                w_text: bool = False):
-        logger_utils.debug('Entry')
-        logger_utils.debug(f'{data=}')
-
-        try:
-            local_path = os.path.abspath(
-                    os.path.join(os.path.dirname(__file__), '..', 'static'))
-            base_dir = os.getenv('CERTIFICATE_DATA_DIR', local_path)
-
-            template_name = data.get('template_name')
-            user_name = data.get('full_name')
-            cert_number = data.get('cert_number')
-
-            font_path = os.path.join(base_dir, 'Bitter-Regular.ttf')
-            template_file = os.path.join(base_dir, template_name)
-            course_id = int(data.get('course'))
-            course_data = self.courses.get(course_id)
-            course_name = course_data.name.replace(' ', '_')
-            output_file = os.path.join(base_dir, f'{course_name}_{cert_number}.pdf')
-
-            if not os.path.exists(font_path):
-                raise FileNotFoundError(f'Файл шрифта не найден: {font_path}')
-        except FileNotFoundError as err:
-            logger_utils.error(f'Ошибка при определении путей: {err}',
-                               exc_info=True)
-            return None
-        except Exception as err:
-            logger_utils.error(
-                    f'Неизвестная ошибка при определении путей: {err}',
-                    exc_info=True)
+    async def render_certificate(
+            self,
+            course_id: int,
+            template_name: str,
+            user_name: str,
+            number: str,
+            w_text: bool = False,
+            to_disk: bool = False) -> RenderedCertificate | None:
+        """
+        Общая точка генерации PDF для новых сертификатов и копий.
+        Генерация выполняется в пуле процессов render_pool.
+        :param course_id: ID курса.
+        :param template_name: Имя файла шаблона.
+        :param user_name: ФИО получателя.
+        :param number: Номер сертификата.
+        :param w_text: Флаг для добавления водяного знака.
+        :param to_disk: Флаг записи PDF в файл (для отладки).
+        :return: Сгенерированный сертификат или None при ошибке.
+        """
+        course_config = self.courses.get(course_id)
+        if not course_config:
+            logger_utils.error(f'Конфигурация для курса {course_id} не найдена.')
             return None
 
-        # 3. Регистрация шрифта
         try:
-            pdfmetrics.registerFont(TTFont('BitterReg', font_path))
+            return await render_pool.render(RenderRequest(
+                course=course_config,
+                template_name=template_name,
+                user_name=user_name,
+                number=number,
+                w_text=w_text,
+                to_disk=to_disk))
         except Exception as err:
-            logger_utils.error(f'Ошибка при регистрации шрифта: {err}',
+            logger_utils.error(f'Ошибка при работе с PDF: {err!r}',
                                exc_info=True)
             return None
 
-        # 4. Работа с PDF
-        try:
-            light_gray = Color(230 / 255, 230 / 255, 230 / 255)
-            watermark_text = 'TEST VERSION'
-            reader = PdfReader(template_file)
-            writer = PdfWriter()
-
-            for page_num in range(len(reader.pages)):
-                page = reader.pages[page_num]
-                packet = io.BytesIO()
-                can = canvas.Canvas(packet, pagesize=letter)
-                font_size = 16
-
-                if len(user_name) in (24, 25):
-                    font_size = 15
-                elif len(user_name) in (26, 27):
-                    font_size = 14
-                elif len(user_name) in (28, 29, 30):
-                    font_size = 13
-
-                text_width = can.stringWidth(user_name, 'BitterReg', font_size)
-                can.setFont('BitterReg', font_size)
-                page_width = letter[0]
-                x_position = (page_width - text_width) / 2 + 155
-                can.drawString(x_position, 306, user_name)
-                can.setFont('BitterReg', 21)
-                can.setFillColor(light_gray)
-                can.drawString(440, 373, cert_number)
-
-                if w_text:
-                    can.setFillColor(Color(0.3, 0, 0, alpha=0.7))
-                    can.setFont('Helvetica', 50)
-                    can.rotate(45)
-                    can.drawString(110, 60, watermark_text)
-
-                can.showPage()
-                can.save()
-                packet.seek(0)
-                new_pdf = PdfReader(packet)
-                page.merge_page(new_pdf.pages[0])
-                writer.add_page(page)
-
-            with open(output_file, 'wb') as fh:
-                writer.write(fh)
-        except Exception as err:
-            logger_utils.error(f"Ошибка при работе с PDF: {err}", exc_info=True)
-            return None
-        # 5. Возврат результата
-        return output_file
-
     async def generate_certificate(
             self,
-            state_data: FSMContext,
-            type_update,
+            type_update: CallbackQuery,
             w_text: bool = False,
-            exist_cert=False):
+            to_disk: bool = False) -> RenderedCertificate | None:
         """
-        Асинхронная обёртка для генерации сертификата.
-        :param type_update: Тип апдэйта.
-        :param exist_cert: Флаг существования сертификата.
-        :param state_data: Данные для генерации сертификата.
+        Генерирует копию выданного сертификата по данным из хэша
+        пользователя.
+        :param type_update: CallbackQuery с ID курса в data.
         :param w_text: Флаг для добавления водяного знака.
-        :return: Путь к сгенерированному файлу сертификата.
+        :param to_disk: Флаг записи PDF в файл (для отладки).
+        :return: Сгенерированный сертификат.
         """
         logger_utils.debug('Entry')
 
-        data = await state_data.get_data()
         user_tg_id = str(type_update.from_user.id)
+        course_id = str(type_update.data)
+        try:
+            user_data = await self.redis_client.hget(user_tg_id, course_id)
+            logger_utils.debug(f'{user_data=}')
 
-        if exist_cert:
-            course_id = str(type_update.data)
-            try:
-                user_data = await self.redis_client.hget(user_tg_id, course_id)
-                logger_utils.debug(f'{user_data=}')
-
-                cert_number, full_name, template = user_data.split(':')
-                logger_utils.debug(f'{cert_number}-{full_name}-{template}')
-                data.update({'template_name': template,
-                             'cert_number': cert_number,
-                             'full_name': full_name,
-                             'course': course_id})
-
-            except Exception:
-                logger_utils.error('Не удалось получить данные пользователя '
-                                   'из Redis хранилища', exc_info=True)
-                raise
-            output_file = await asyncio.to_thread(
-                self.sync_exists_certificate, data, w_text)
-            logger_utils.debug('Exit')
-            return output_file
+            cert_number, full_name, template = user_data.split(':')
+            logger_utils.debug(f'{cert_number}-{full_name}-{template}')
+
+        except Exception:
+            logger_utils.error('Не удалось получить данные пользователя '
+                               'из Redis хранилища', exc_info=True)
+            raise
+        certificate = await self.render_certificate(int(course_id),
+                                                    template,
+                                                    full_name,
+                                                    cert_number,
+                                                    w_text=w_text,
+                                                    to_disk=to_disk)
+        logger_utils.debug('Exit')
+        return certificate
 
-        course_id = data.get('course')
+    async def begin_issuance(self,
+                             tg_user_id: str,
+                             course_id: str,
+                             counter_key: str) -> tuple[str, str]:
+        """
+        Начинает выдачу за один запрос к Redis: проверяет, нет ли у
+        пользователя сертификата курса, и выделяет номер, записывая его
+        как ожидающий доставки. Номер незавершённой выдачи используется
+        повторно, поэтому сбой генерации или отправки не сжигает номера.
+        :param tg_user_id: TG_ID пользователя.
+        :param course_id: ID курса на Stepik.
+        :param counter_key: Счётчик номеров (end_number или
+         end_number_<course_id>).
+        :return: ('EXISTS', запись сертификата) — сертификат уже выдан;
+                 ('NEW' | 'PENDING', номер) — номер для генерации.
+        """
+        status, value = await self._begin_issuance_script(
+            keys=[tg_user_id, counter_key],
+            args=[course_id, pending_issue_key(course_id)])
+        return status, value
+
+    async def finalize_issuance(self,
+                                tg_user_id: str,
+                                tg_username: str,
+                                course_id: str,
+                                record: str,
+                                file_id: str) -> None:
+        """
+        Завершает выдачу после доставки: сохраняет запись сертификата
+        (номер:ФИО:шаблон) и file_id, снимает отметку ожидания и добавляет
+        пользователя в индексы отчёта (course_holders, usernames).
+        """
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(tg_user_id, mapping={course_id: record,
+                                           file_id_key(course_id): file_id})
+            pipe.hdel(tg_user_id, pending_issue_key(course_id))
+            pipe.sadd(course_holders_key(course_id), tg_user_id)
+            pipe.hset(USERNAMES_KEY, tg_user_id, tg_username)
+            pipe.zadd(USERNAMES_SEEN_KEY, {tg_user_id: time.time()})
+            await pipe.execute()
+        logger_utils.debug(f'Данные сохранены в Redis: '
+                           f'user_tg_id={tg_user_id},'
+                           f' course_id={course_id}')
+
+    async def create_certificate(self,
+                                 tg_user_id: str,
+                                 course_id: str,
+                                 full_name: str,
+                                 gender: str,
+                                 number: str,
+                                 w_text: bool = False,
+                                 to_disk: bool = False,
+                                 ) -> tuple[RenderedCertificate, str]:
+        """
+        Генерирует новый сертификат. Данные сертификата сохраняются в хэш
+        пользователя только после доставки (finalize_issuance).
+        :param tg_user_id: TG_ID пользователя.
+        :param course_id: ID курса на Stepik.
+        :param full_name: ФИО получателя.
+        :param gender: Пол из анкеты (female, male).
+        :param number: Номер сертификата.
+        :param w_text: Флаг для добавления водяного знака.
+        :param to_disk: Флаг записи PDF в файл (для отладки).
+        :return: Сгенерированный сертификат и запись для хэша пользователя
+                 (номер:ФИО:шаблон).
+        :raises: ValueError, если шаблон не найден; RuntimeError, если
+                 генерация не удалась.
+        """
         try:
-            # Выполняем синхронную операцию в отдельном потоке
-            output_file, template_name = await asyncio.to_thread(
-                    self.sync_generate_certificate, data, w_text)
-            cert_number = await state_data.get_value('end_number')
-            full_name = await state_data.get_value('full_name')
-
-            # Сохраняем данные в Redis
-            await self.redis_client.hset(name=user_tg_id,
-                                         key=course_id,
-                                         value=f'{cert_number}:'
-                                               f'{full_name}:'
-                                               f'{template_name}')
-            logger_utils.debug(f'Данные сохранены в Redis: '
-                f'user_tg_id={user_tg_id},'
-                f' course_id={course_id}')
+            template_name = self.get_template_name({'course': course_id,
+                                                    'gender': gender})
+            if not template_name:
+                raise ValueError(f'Шаблон не найден для {course_id=}')
+
+            certificate = await self.render_certificate(int(course_id),
+                                                        template_name,
+                                                        full_name,
+                                                        number,
+                                                        w_text=w_text,
+                                                        to_disk=to_disk)
+            if not certificate:
+                raise RuntimeError('Не удалось сгенерировать сертификат')
 
             logger_utils.debug('Exit')
-            return output_file
+            return certificate, f'{number}:{full_name}:{template_name}'
 
         except Exception as err:
             logger_utils.error(f'{err=}', exc_info=True)
@@ -557,63 +1025,112 @@ class StepikService:
             raise
 
     async def send_certificate(self,
-                               clbk: CallbackQuery,
-                               output_file: str,
+                               message: Message,
+                               tg_user_id: str,
+                               tg_username: str,
+                               certificate: RenderedCertificate | None,
                                state: FSMContext,
                                course_id: str,
-                               is_copy=False) -> None:
+                               is_copy=False,
+                               record: str | None = None) -> bool:
         """
-        Отправляет сертификат пользователю, и удаляет файл после отправки.
+        Отправляет сертификат пользователю. Если сертификат был записан на
+        диск, файл удаляется после отправки. Для нового сертификата
+        (record) после доставки завершается выдача (finalize_issuance).
+        :param message: Сообщение в чате пользователя, в который
+         отправляется сертификат.
+        :param tg_user_id: TG_ID пользователя.
+        :param tg_username: Имя пользователя для логов.
         :param course_id: IG курса на Stepik
         :param is_copy: Флаг True, если отправляется копия.
         :param state: Контекст состояний.
-        :param clbk: CallbackQuery от пользователя.
-        :param output_file: Путь к файлу сертификата.
+        :param certificate: Сгенерированный сертификат.
+        :param record: Запись нового сертификата (номер:ФИО:шаблон).
+        :return: True, если сертификат доставлен.
         """
-        msg_processor = MessageProcessor(clbk, state)
-        try:
-            if not output_file:
-                logger_utils.error("Получен пустой путь к файлу сертификата.")
-                await clbk.message.answer('Проблем при отправке сертификата.\n'
-                                          'Обратитесь к администратору.')
-                return
-
-            # Проверяем, существует ли файл
-            if not os.path.exists(output_file):
-                logger_utils.error(f"Файл {output_file} не найден.")
-                return
-
-            pdf_file = FSInputFile(output_file)
+        msg_processor = MessageProcessor(message, state)
+        if not certificate:
+            logger_utils.error("Получен пустой сертификат.")
+            await message.answer('Проблем при отправке сертификата.\n'
+                                 'Обратитесь к администратору.')
+            return False
 
+        try:
             # Отправка файла пользователю
-            await clbk.message.answer_document(pdf_file,
-                                               caption='Ваш сертификат готов! 🎉\n'
-                                               'Желаем удачи в дальнейшем'
-                                               ' обучении!🤓')
-            user_data = await self.redis_client.hget(str(
-                    clbk.from_user.id), course_id)
-            user_info_data = (f'TG_ID:{clbk.from_user.id}:'
-                              f'{await get_username(clbk)}:{user_data}')
+            msg = await message.answer_document(
+                certificate.as_input_file(), caption=CERT_CAPTION)
+            # file_id позволяет выдавать копии без генерации и загрузки PDF
+            if record:
+                await self.finalize_issuance(tg_user_id,
+                                             tg_username,
+                                             course_id,
+                                             record,
+                                             msg.document.file_id)
+            else:
+                await self.redis_client.hset(tg_user_id,
+                                             file_id_key(course_id),
+                                             msg.document.file_id)
+            user_data = await self.redis_client.hget(tg_user_id, course_id)
+            user_info_data = (f'TG_ID:{tg_user_id}:'
+                              f'{tg_username}:{user_data}')
             if is_copy:
                 logger_utils.info(f'Выдана копия для {user_info_data}')
             else:
                 logger_utils.info(f'Выдан сертификат {user_info_data}')
+            return True
 
         except Exception as err:
             logger_utils.error(f"Ошибка при отправке файла: {err=}",
                                exc_info=True)
-            value = await clbk.message.answer('Что-то пошло не так, сообщите'
-                                      ' администратору.')
+            value = await message.answer('Что-то пошло не так, сообщите'
+                                         ' администратору.')
             await msg_processor.save_msg_id(value, msgs_for_del=True)
+            return False
         finally:
-            # Удаляем файл после отправки
+            certificate.cleanup()
+
+    async def send_certificate_copy(self,
+                                    clbk: CallbackQuery,
+                                    state: FSMContext,
+                                    course_id: str,
+                                    w_text: bool = False,
+                                    to_disk: bool = False) -> None:
+        """
+        Отправляет копию выданного сертификата по сохранённому file_id.
+        Генерация и загрузка PDF выполняются только если file_id ещё нет
+        или Telegram его отклонил.
+        :param clbk: CallbackQuery от пользователя.
+        :param state: Контекст состояний.
+        :param course_id: ID курса на Stepik.
+        :param w_text: Флаг для добавления водяного знака.
+        :param to_disk: Флаг записи PDF в файл (для отладки).
+        """
+        tg_id = str(clbk.from_user.id)
+        file_id = await self.redis_client.hget(tg_id, file_id_key(course_id))
+        if file_id:
             try:
-                os.remove(output_file)
-                logger_utils.debug(f"Файл {output_file} удалён.")
-            except Exception as err:
-                logger_utils.error(
-                    f"Ошибка при удалении файла {output_file}: "
-                    f"{err.__class__.__name__}", exc_info=True)
+                await clbk.message.answer_document(file_id,
+                                                   caption=CERT_CAPTION)
+                logger_utils.info(
+                    f'Выдана копия по file_id для TG_ID:{tg_id}:'
+                    f'{await get_username(clbk)}:COURSE_ID:{course_id}')
+                return
+            except TelegramBadRequest as err:
+                logger_utils.warning(
+                    f'file_id сертификата отклонён Telegram, генерируем '
+                    f'заново: TG_ID:{tg_id}:COURSE_ID:{course_id}:{err}')
+                await self.redis_client.hdel(tg_id, file_id_key(course_id))
+
+        certificate = await self.generate_certificate(clbk,
+                                                      w_text=w_text,
+                                                      to_disk=to_disk)
+        await self.send_certificate(clbk.message,
+                                    tg_id,
+                                    await get_username(clbk),
+                                    certificate,
+                                    state,
+                                    is_copy=True,
+                                    course_id=course_id)
 
 @dataclass
 class MessageProcessor:
@@ -658,34 +1175,29 @@ class MessageProcessor:
                         "Update does not contain a valid chat or message.")
                 return
 
-        kwargs: dict = {
-                'msgs_for_del': msgs_for_del,
-                'msgs_remove_kb': msgs_remove_kb}
+        if not (msgs_for_del or msgs_remove_kb):
+            logger_utils.debug('Exit')
+            return
 
-        keys = None
-        try:
-            keys = [key for key, val in kwargs.items() if val]
-        except Exception as err:
-            logger_utils.error(f'{err.__class__.__name__}', exc_info=True)
-        logger_utils.debug(f'{keys=}')
+        # Одно чтение и одна запись состояния на вызов
+        data = await self._state.get_data()
+        cleared: dict[str, list] = {}
 
         if msgs_remove_kb:
-            await self.removes_inline_kb(chat_id=chat_id)
-
-        if keys:
-            for key in keys:
-                msgs_ids: list = dict(await self._state.get_data()).get(key, [])
-                logger_utils.debug('Starting to delete messages…')
-
-                for msg_id in set(msgs_ids):
-                    try:
-                        await self._type_update.bot.delete_message(
-                                chat_id=chat_id, message_id=msg_id)
-                    except Exception as err:
-                        logger_utils.warning(
-                                f'Failed to delete message ID:{msg_id}:{err}')
-                await self._state.update_data({key: []})
-
+            await self._remove_inline_kbs(
+                chat_id, data.get('msgs_remove_kb', []))
+            cleared['msgs_remove_kb'] = []
+
+        if msgs_for_del:
+            logger_utils.debug('Starting to delete messages…')
+            msgs_ids = sorted({int(msg_id)
+                               for msg_id in data.get('msgs_for_del', [])})
+            await delete_messages_batched(self._type_update.bot,
+                                          chat_id,
+                                          msgs_ids)
+            cleared['msgs_for_del'] = []
+
+        await self._state.update_data(cleared)
         logger_utils.debug('Exit')
 
     async def save_msg_id(
@@ -739,6 +1251,12 @@ class MessageProcessor:
         logger_utils.debug('Entry')
 
         msgs: list = dict(await self._state.get_data()).get(key, [])
+        await self._remove_inline_kbs(chat_id, msgs)
+        await self._state.update_data({key: []})
+
+        logger_utils.debug('Exit')
+
+    async def _remove_inline_kbs(self, chat_id, msgs: list) -> None:
         for msg_id in set(msgs):
             try:
                 await self._type_update.bot.edit_message_reply_markup(
@@ -747,9 +1265,6 @@ class MessageProcessor:
             except TelegramBadRequest as err:
                 logger_utils.error(f'{err}', stack_info=True)
             logger_utils.debug(f'Keyboard removed for id:{msg_id}')
-        await self._state.update_data({key: []})
-
-        logger_utils.debug('Exit')
 
     async def delete_message(self, key='msg_del_on_key') -> None:
         """
@@ -791,33 +1306,14 @@ class MessageProcessor:
     @staticmethod
     async def deletes_msg_a_delay(value: Message,
                                   delay: int = 1, indication=False) -> None:
-        if not indication:
-            await asyncio.sleep(delay)
-            await value.delete()
-            return
-
-        # Сохраняем оригинальный текст сообщения
-        original_text = value.text
-        try:
-            if indication:
-                # Обратный отсчет от delay до 1
-                for remaining in range(delay, 0, -1):
-                    try:
-                        # Обновляем текст сообщения с оставшимся временем
-                        await value.edit_text(
-                            f"{original_text}\n\nУдалится через: {remaining} сек...")
-                    except Exception as e:
-                        logger_utils.warning(
-                            f"Не удалось отредактировать сообщение: {e}")
-                    await asyncio.sleep(1)
-        except Exception as e:
-            logger_utils.error(f"Ошибка в deletes_msg_a_delay: {e}",
-                               exc_info=True)
-        finally:
-            try:
-                await value.delete()
-            except Exception as e:
-                logger_utils.warning(f"Не удалось удалить сообщение: {e}")
+        """
+        Ставит сообщение на отложенное удаление (deletion_scheduler) и сразу
+        возвращает управление.
+        :param value: Сообщение для удаления.
+        :param delay: Задержка в секундах.
+        :param indication: Показать в сообщении срок удаления.
+        """
+        deletion_scheduler.schedule(value, delay, indication)
 
     async def send_message_with_delay(self,
                                       chat_id: int,
@@ -859,35 +1355,61 @@ async def shifts_the_date_forward(days: int = 10):
     return f'{expire_date.day} {months[expire_date.month]}'
 
 
-async def get_data_users(clbk: CallbackQuery, redis_data: Redis):
-    cursor = '0'
-    user_ids = []
-    while cursor:
-        cursor, keys = await redis_data.scan(cursor, match='*')
-        user_ids.extend([key for key in keys if re.match(r'^\d{9,10}$', key)])
-    logger_utils.debug(f'{user_ids=}')
-
-    courses: dict = {'214271': 1, '221885': 2, '227627': 3, '241971': 4}
-    data_users: dict[int, list] = {}
-    for user in user_ids:
-        chat_data = await clbk.bot.get_chat(int(user))
-        username = await get_username(chat_data)
-        _, data = await redis_data.hscan(user)
-        logger_utils.debug(f'{data=}')
-        try:
-            keys = data.keys()
-            logger_utils.debug(f'{keys=}')
-        except Exception as err:
-            logger_utils.error(f'Ошибка чтения ключа:DB-№2 {err}',
-                               exc_info=True)
-        else:
-            for key in keys:
-                data_users.setdefault(key, []).append(username)
-    logger_utils.debug(f'{data_users=}')
+async def get_data_users(redis_data: Redis,
+                         courses: dict[int, Course]) -> list[str]:
+    """
+    Отчёт администратору: кто получил сертификаты по курсам. Читает
+    индексы course_holders:<course_id> и таблицу имён usernames —
+    несколько запросов к Redis на весь отчёт, без обхода базы и Bot API.
+    :param redis_data: Redis клиент DB 2.
+    :param courses: Курсы из config.yaml.
+    :return: Текст отчёта, разбитый на сообщения не длиннее
+             TG_MESSAGE_LIMIT.
+    """
+    async with redis_data.pipeline(transaction=False) as pipe:
+        for course_id in courses:
+            pipe.smembers(course_holders_key(course_id))
+        holders = await pipe.execute()
+
+    user_ids = sorted(set().union(*holders), key=int) if holders else []
+    names = (await redis_data.hmget(USERNAMES_KEY, user_ids)
+             if user_ids else [])
+    usernames = dict(zip(user_ids, names, strict=True))
+
     text = ''
-    for num_course, users in data_users.items():
-        qt_users = len(users)
-        user_names = '\n'.join(users)
-        text += (f'<code>Курс №{courses[num_course]} прошли {qt_users}:</code>\n'
+    for (course_id, course), course_holders in zip(courses.items(), holders,
+                                                   strict=True):
+        if not course_holders:
+            continue
+        user_names = '\n'.join(usernames.get(user_id) or user_id
+                               for user_id in sorted(course_holders, key=int))
+        text += (f'<code>{course.name} ({course_id}) прошли '
+                 f'{len(course_holders)}:</code>\n'
                  f'{user_names}\n\n')
-    return text
+    return split_message(text or 'Сертификаты ещё не выдавались.')
+
+
+def split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> list[str]:
+    """
+    Разбивает текст на части не длиннее limit по границам строк.
+    :param text: Текст сообщения.
+    :param limit: Максимальная длина одного сообщения.
+    :return: Список частей.
+    """
+    pages: list[str] = []
+    page = ''
+    for text_line in text.splitlines(keepends=True):
+        line = text_line
+        while len(line) > limit:
+            if page:
+                pages.append(page)
+                page = ''
+            pages.append(line[:limit])
+            line = line[limit:]
+        if len(page) + len(line) > limit:
+            pages.append(page)
+            page = ''
+        page += line
+    if page.strip():
+        pages.append(page)
+    return pages